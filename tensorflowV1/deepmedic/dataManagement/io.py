@@ -72,6 +72,43 @@ def saveImgToNiiWithOriginalHdr(imgToSave,
         
         
         
+def saveImgToNiiWithAffine(imgToSave,
+                           filepathTarget,
+                           affine,
+                           npDtype = np.dtype(np.float32),
+                           log=None):
+    # For images without an original file to copy the header from (eg given as arrays to the server).
+    # affine: 4x4 np array, voxel to world coordinates. Voxel sizes (zooms) are taken from it. None for identity.
+    newImg = nib.Nifti1Image(imgToSave, affine if affine is not None else np.eye(4))
+    newImg.set_data_dtype(npDtype)
+
+    filepathTarget = os.path.abspath(filepathTarget)
+    if not filepathTarget.endswith(".nii.gz") :
+        filepathTarget = filepathTarget + ".nii.gz"
+    if not os.path.exists(os.path.dirname(filepathTarget)):
+        os.makedirs(os.path.dirname(filepathTarget))
+    nib.save(newImg, filepathTarget)
+
+    if log!=None :
+        log.print3("Image saved at: " + str(filepathTarget))
+    else :
+        print("Image saved at: " + str(filepathTarget))
+
+
+def makeFilepathForSavingPred(nameForSavingPred, suffixToAdd):
+    # Filepath where a prediction (segmentation or prob map) is saved, given the name for the case and the suffix.
+    filepathTarget = "PLACEHOLDER"
+    if os.path.isdir(nameForSavingPred) : # Only if names not given and it's only 1 case (see testSessionParams)
+        filepathTarget = nameForSavingPred + "/" + suffixToAdd + ".nii.gz"
+    elif nameForSavingPred.endswith(".nii.gz") :
+        filepathTarget = nameForSavingPred[:-7] + "_" + suffixToAdd + ".nii.gz"
+    elif nameForSavingPred.endswith(".nii") :
+        filepathTarget = nameForSavingPred[:-4] + "_" + suffixToAdd + ".nii.gz"
+    else :
+        filepathTarget = nameForSavingPred + "_" + suffixToAdd + ".nii.gz"
+    return filepathTarget
+
+
 def savePredImgToNiiWithOriginalHdr(labelImageCreatedByPredictions,
                                     namesForSavingPreds,
                                     listOfFilepathsToEachChannelOfEachPatient,
@@ -89,16 +126,7 @@ def savePredImgToNiiWithOriginalHdr(labelImageCreatedByPredictions,
         
     filepathOriginToCopyHeader = listOfFilepathsToEachChannelOfEachPatient[case_i][0]
     
-    filepathTarget = "PLACEHOLDER"
-    nameForSavingPred = namesForSavingPreds[case_i]
-    if os.path.isdir(nameForSavingPred) : # Only if names not given and it's only 1 case (see testSessionParams)
-        filepathTarget = nameForSavingPred + "/" + suffixToAdd + ".nii.gz"
-    elif nameForSavingPred.endswith(".nii.gz") :
-        filepathTarget = nameForSavingPred[:-7] + "_" + suffixToAdd + ".nii.gz"
-    elif nameForSavingPred.endswith(".nii") :
-        filepathTarget = nameForSavingPred[:-4] + "_" + suffixToAdd + ".nii.gz"
-    else :
-        filepathTarget = nameForSavingPred + "_" + suffixToAdd + ".nii.gz"
+    filepathTarget = makeFilepathForSavingPred(namesForSavingPreds[case_i], suffixToAdd)
         
     saveImgToNiiWithOriginalHdr(labelImageCreatedByPredictions,
                                 filepathTarget,
@@ -8,6 +8,7 @@
 from __future__ import absolute_import, division
 
 import numpy as np
+import math
 import time
 
 
@@ -112,6 +113,67 @@ def unpad_3d_img(img, padding_left_right_per_axis):
     return unpadded_img
 
 
+# ============= Cropping to the ROI =======================
+
+def calc_crop_coords_of_roi(roi_mask, unpred_margin, stride, pad_input_imgs, context_of_tile=None):
+    # Bounding box of the ROI, extended by the receptive field's margin, so that all ROI voxels can be predicted.
+    # It is further extended to the grid of tiles of the whole image, so that the tiles of the crop are the same ...
+    # ... as those of the whole image, and so are their predictions in the ROI.
+    # Subsampled pathways take input from further out than the margin (context_of_tile). The crop is extended by ...
+    # ... whole tiles to include it, up to the end of the (padded) image. Context beyond that is filled as when ...
+    # ... tiling the whole image, if the border intensity of the whole image is given. See get_subsampl_segment.
+    # roi_mask: 3D array. Must have at least one voxel > 0.
+    # unpred_margin: [[pre-x, post-x], [pre-y, post-y], [pre-z, post-z]], number voxels not predicted
+    # stride: Predicted dims of a tile [x, y, z]. pad_input_imgs: Whether the image would be padded (by the margin).
+    # context_of_tile: [[pre-x, post-x], ...] voxels before/after a tile that subsampled pathways read. None if none.
+    #                  See sampling.calc_context_of_subsampl_segments.
+    # Returns:
+    # crop_coords: [[low-x, high-x], [low-y, high-y], [low-z, high-z]], high exclusive. Within the image.
+    # margin_out_of_img: [[pre-x, post-x], ...] part of the crop that falls outside the image, in its padding.
+    crop_coords = []
+    margin_out_of_img = []
+    for axis in range(3):
+        other_axes = tuple([a for a in range(3) if a != axis])
+        idxs_roi_axis = np.where(np.any(roi_mask > 0, axis=other_axes))[0]
+        (margin_pre, margin_post) = unpred_margin[axis]
+        (context_pre, context_post) = context_of_tile[axis] if context_of_tile is not None else (0, 0)
+        grid_origin = -margin_pre if pad_input_imgs else 0  # Low of first tile of the whole image.
+        grid_end = roi_mask.shape[axis] + (margin_post if pad_input_imgs else 0)  # Where its last tile ends.
+        low = grid_origin + ((int(idxs_roi_axis[0]) - margin_pre - grid_origin) // stride[axis]) * stride[axis]
+        n_tiles = int(math.ceil((int(idxs_roi_axis[-1]) + 1 - (low + margin_pre)) / stride[axis]))
+        high = low + margin_pre + n_tiles * stride[axis] + margin_post
+        # Not beyond the end of the (padded) image, where the last tile of the whole image ends.
+        high = min(high, grid_end)
+        # Whole tiles, to stay on the grid. Their predictions are not in the ROI.
+        low -= int(math.ceil(context_pre / stride[axis])) * stride[axis]
+        high += int(math.ceil(context_post / stride[axis])) * stride[axis]
+        low = max(low, grid_origin)
+        high = min(high, grid_end)
+        crop_coords.append([max(0, low), min(roi_mask.shape[axis], high)])
+        margin_out_of_img.append([max(0, -low), max(0, high - roi_mask.shape[axis])])
+    return crop_coords, margin_out_of_img
+
+def crop_3d_img(img, crop_coords):
+    # In the 3 last axes. Which means it can take a 4-dim image, eg [n_chans,x,y,z]. Deals with None.
+    # Returns a copy, not a view, so that the full image can be released.
+    if img is None:
+        return None
+    return img[..., crop_coords[0][0]:crop_coords[0][1],
+                    crop_coords[1][0]:crop_coords[1][1],
+                    crop_coords[2][0]:crop_coords[2][1]].copy()
+
+def paste_crop_in_3d_img(img_crop, crop_coords, full_dims):
+    # Inverse of crop_3d_img for a 3D image. Voxels outside the crop are 0.
+    # If crop_coords is None, the image was not cropped and is returned as is. Deals with None.
+    if img_crop is None or crop_coords is None:
+        return img_crop
+    img_full = np.zeros(full_dims, dtype=img_crop.dtype)
+    img_full[crop_coords[0][0]:crop_coords[0][1],
+             crop_coords[1][0]:crop_coords[1][1],
+             crop_coords[2][0]:crop_coords[2][1]] = img_crop
+    return img_full
+
+
 # ============================ (below) Intensity Normalization. ==================================
 # Could make classes? class Normalizer and children? (zscore)
 
@@ -604,7 +604,53 @@ def sample_idxs_of_segments(log,
     return idxs_of_sampled_centers
 
 
-def get_subsampl_segment(rec_field_hr_path, channels, segment_hr_slice_coords, subs_factor, dims_lr_segm):
+def calc_bounds_of_subsampl_segment(rec_field_hr_path, segment_hr_slice_coords, subs_factor):
+    # Where get_subsampl_segment takes the voxels of the down-sampled context from, for a high-resolution segment.
+    # segment_hr_slice_coords: [[low-x, high-x], ...] of the high-res segment, high inclusive.
+    # Returns: low, high_non_incl. Lists, per axis. Can be out of the image's boundaries.
+    dims_hr_segm = [segment_hr_slice_coords[d][1] - segment_hr_slice_coords[d][0] + 1 for d in range(3)]
+    dims_outp_hr_path = [dims_hr_segm[d] - rec_field_hr_path[d] + 1 for d in range(3)] # Assumes no stride.
+    n_vox_before = [None, None, None]
+    centre_of_downsampl_kernel = [None, None, None]
+    for d in range(3):
+        if subs_factor[d] % 2 == 1: # Odd
+            n_vox_before[d] = ((subs_factor[d] - 1) // 2) * rec_field_hr_path[d] # TODO: Should be rec_field_lr_path
+            centre_of_downsampl_kernel[d] = subs_factor[d] // 2 # 3 ==> 1
+        else:
+            n_vox_before[d] = (subs_factor[d] - 2) // 2 * rec_field_hr_path[d] + rec_field_hr_path[d] // 2
+            centre_of_downsampl_kernel[d] = subs_factor[d] // 2 - 1 # One pixel closer to the beginning of dim.
+
+    # This is where to start taking voxels from the subsampled image: From the beginning of the hr_segment...
+    # ... go forward a few steps to the voxel that is like the "central" in this subsampled (eg 3x3) area.
+    # ...Then go backwards -Patchsize to find the first voxel of the subsampled.
+    low = [segment_hr_slice_coords[d][0] + centre_of_downsampl_kernel[d] - n_vox_before[d] for d in range(3)]
+    # If the rec_field is 17x17, I want a 17x17 subsampled Patch. BUT if the segment is 25x25 (9voxClass),
+    # I want 3 voxels in my subsampled-segment to cover this area!
+    # That is what the last term below is taking care of.
+    high_non_incl = [int(low[d] + subs_factor[d] * rec_field_hr_path[d] + (
+            math.ceil(dims_outp_hr_path[d] / subs_factor[d]) - 1) * subs_factor[d]) for d in range(3)]
+
+    return low, high_non_incl
+
+
+def calc_context_of_subsampl_segments(cnn3d, dims_hr_segm):
+    # Number of voxels before and after a high-res segment (eg tile) of dims_hr_segm, that the subsampled pathways ...
+    # ... take their input from (the largest over them). Zero where within the segment, or if no subsampled pathway.
+    # Returns: [[before-x, after-x], [before-y, after-y], [before-z, after-z]]
+    context = [[0, 0], [0, 0], [0, 0]]
+    segment_hr_slice_coords = [[0, dims_hr_segm[d] - 1] for d in range(3)]
+    for pathway in cnn3d.pathways:
+        if pathway.pType() != pt.SUBS:
+            continue
+        (low, high_non_incl) = calc_bounds_of_subsampl_segment(cnn3d.pathways[0].rec_field()[0],
+                                                               segment_hr_slice_coords, pathway.subs_factor())
+        for d in range(3):
+            context[d] = [max(context[d][0], -low[d]), max(context[d][1], high_non_incl[d] - dims_hr_segm[d])]
+    return context
+
+
+def get_subsampl_segment(rec_field_hr_path, channels, segment_hr_slice_coords, subs_factor, dims_lr_segm,
+                         border_int_per_chan=None):
     """
     Given the segment_hr_slice_coords, which has the coordinates where the high-resolution image segment starts and
     ends (inclusive), this returns the corresponding image segment of down-sampled context for the parallel path(s).
@@ -624,34 +670,16 @@ def get_subsampl_segment(rec_field_hr_path, channels, segment_hr_slice_coords, s
     the subfactor, eg 10 central-voxels, I get 3+1 central voxels in the subsampled-segment.
     When the cnn is convolving them, they will get repeated to 4(last-layer-neurons)*3(factor) = 12,
     and will get sliced down to 10, in order to have same dimension with the 1st pathway.
+
+    border_int_per_chan: Intensity per channel to fill the segment with, where out of the image. If None, that of
+    the border of channels. Given when channels are a crop of the image, to fill as for the whole image.
     """
-    dims_hr_segm = [segment_hr_slice_coords[d][1] - segment_hr_slice_coords[d][0] + 1 for d in range(3)]
-    dims_outp_hr_path = [dims_hr_segm[d] - rec_field_hr_path[d] + 1 for d in range(3)] # Assumes no stride.
     dims_img = channels.shape[1:] # Channels: [batch, X, Y, Z]
 
     segment_lr = np.ones((channels.shape[0], dims_lr_segm[0], dims_lr_segm[1], dims_lr_segm[2]), dtype='float32')
 
-    n_vox_before = [None, None, None]
-    centre_of_downsampl_kernel = [None, None, None]
-    for d in range(3):
-        if subs_factor[d] % 2 == 1: # Odd
-            n_vox_before[d] = ((subs_factor[d] - 1) // 2) * rec_field_hr_path[d] # TODO: Should be rec_field_lr_path
-            centre_of_downsampl_kernel[d] = subs_factor[d] // 2 # 3 ==> 1
-        else:
-            n_vox_before[d] = (subs_factor[d] - 2) // 2 * rec_field_hr_path[d] + rec_field_hr_path[d] // 2
-            centre_of_downsampl_kernel[d] = subs_factor[d] // 2 - 1 # One pixel closer to the beginning of dim.
-
-    # This is where to start taking voxels from the subsampled image: From the beginning of the hr_segment...
-    # ... go forward a few steps to the voxel that is like the "central" in this subsampled (eg 3x3) area.
-    # ...Then go backwards -Patchsize to find the first voxel of the subsampled.
-
     # These indices can run out of image boundaries. I ll correct them afterwards.
-    low = [segment_hr_slice_coords[d][0] + centre_of_downsampl_kernel[d] - n_vox_before[d] for d in range(3)]
-    # If the rec_field is 17x17, I want a 17x17 subsampled Patch. BUT if the segment is 25x25 (9voxClass),
-    # I want 3 voxels in my subsampled-segment to cover this area!
-    # That is what the last term below is taking care of.
-    high_non_incl = [int(low[d] + subs_factor[d] * rec_field_hr_path[d] + (
-            math.ceil(dims_outp_hr_path[d] / subs_factor[d]) - 1) * subs_factor[d]) for d in range(3)]
+    (low, high_non_incl) = calc_bounds_of_subsampl_segment(rec_field_hr_path, segment_hr_slice_coords, subs_factor)
 
     low_corrected = [max(low[d], 0) for d in range(3)]
     high_non_incl_corrected = [min(high_non_incl[d], dims_img[d]) for d in range(3)]
@@ -662,7 +690,8 @@ def get_subsampl_segment(rec_field_hr_path, channels, segment_hr_slice_coords, s
 
     # I now have exactly where to get the slice from and where to put it in the new array.
     for channel_i in range(len(channels)):
-        segment_lr[channel_i] *= calc_border_int_of_3d_img(channels[channel_i]) # Make black
+        segment_lr[channel_i] *= calc_border_int_of_3d_img(channels[channel_i]) if border_int_per_chan is None \
+                                 else border_int_per_chan[channel_i] # Make black
 
         chan_slice_lr = channels[channel_i,
                                  low_corrected[0]: high_non_incl_corrected[0]: subs_factor[0],
@@ -771,61 +800,70 @@ def extractSegmentGivenSliceCoords(train_val_or_test,
 
 # TODO: This is very similar to sample_idxs_of_segments() I believe, which is used for training.
 #       Consider way to merge them.
+def calc_tile_lows_along_axis(segment_dim, stride, inp_chan_dim):
+    # Returns the low (inclusive) boundary of every tile along one axis, in order.
+    # Tiles are placed every 'stride' voxels. The last one is shifted back to end exactly at the volume's border.
+    # Once a tile reaches the border, the central part of the axis has been fully predicted and tiling stops.
+    n_tiles = max(0, int(math.ceil((inp_chan_dim - segment_dim) / stride))) + 1
+    far_boundaries = np.minimum(np.arange(n_tiles) * stride + segment_dim, inp_chan_dim)  # Excluding.
+    return far_boundaries - segment_dim
+
+
+def calc_summed_area_table_3d(mask):
+    # Summed-area table of the non-zero voxels of a 3D mask, with a leading row of zeros per axis.
+    # sat[r, c, z] = number of non-zero voxels in mask[:r, :c, :z].
+    sat = np.zeros([dim + 1 for dim in mask.shape], dtype="int64")
+    sat[1:, 1:, 1:] = np.cumsum(np.cumsum(np.cumsum(mask != 0, axis=0, dtype="int64"), axis=1), axis=2)
+    return sat
+
+
+def count_nonzero_in_boxes_3d(sat, box_lows, box_highs):
+    # sat: summed-area table from calc_summed_area_table_3d()
+    # box_lows, box_highs: int arrays [n_boxes, 3]. Lows inclusive, highs exclusive.
+    # Returns: int array [n_boxes], with the number of non-zero voxels in each box.
+    (r0, c0, z0) = box_lows.T
+    (r1, c1, z1) = np.maximum(box_highs, box_lows).T  # Empty boxes count 0.
+    return (sat[r1, c1, z1] - sat[r0, c1, z1] - sat[r1, c0, z1] - sat[r1, c1, z0]
+            + sat[r0, c0, z1] + sat[r0, c1, z0] + sat[r1, c0, z0] - sat[r0, c0, z0])
+
+
 def get_slice_coords_of_all_img_tiles(log,
                                       segment_hr_dims, # xyz dims of input to primary pathway (normal)
                                       strideOfSegmentsPerDimInVoxels,
-                                      batch_size,
                                       inp_chan_dims,
-                                      roi_mask
+                                      roi_mask,
+                                      unpred_margin=None
                                       ):
     # inp_chan_dims: Dimensions of the (padded) input channels. [x, y, z]
+    # unpred_margin: [[before, after]] * 3, the margin of a tile that the network does not predict.
+    #     If given (with roi_mask), a tile is kept only if the ROI overlaps the central part that it predicts.
+    #     If None, a tile is kept if the ROI overlaps any part of its input, receptive field included.
     log.print3("Starting to (tile) extract Segments from the images of the subject for Segmentation...")
 
-    sliceCoordsOfSegmentsToReturn = []
-
-    zLowBoundaryNext = 0
-    zAxisCentralPartPredicted = False
-    while not zAxisCentralPartPredicted:
-        zFarBoundary = min(zLowBoundaryNext + segment_hr_dims[2], inp_chan_dims[2])  # Excluding.
-        zLowBoundary = zFarBoundary - segment_hr_dims[2]
-        zLowBoundaryNext = zLowBoundaryNext + strideOfSegmentsPerDimInVoxels[2]
-        zAxisCentralPartPredicted = False if zFarBoundary < inp_chan_dims[2] else True  # IMPORTANT CRITERION
-
-        cLowBoundaryNext = 0
-        cAxisCentralPartPredicted = False
-        while not cAxisCentralPartPredicted:
-            cFarBoundary = min(cLowBoundaryNext + segment_hr_dims[1], inp_chan_dims[1])  # Excluding.
-            cLowBoundary = cFarBoundary - segment_hr_dims[1]
-            cLowBoundaryNext = cLowBoundaryNext + strideOfSegmentsPerDimInVoxels[1]
-            cAxisCentralPartPredicted = False if cFarBoundary < inp_chan_dims[1] else True
-
-            rLowBoundaryNext = 0
-            rAxisCentralPartPredicted = False
-            while not rAxisCentralPartPredicted:
-                rFarBoundary = min(rLowBoundaryNext + segment_hr_dims[0], inp_chan_dims[0])  # Excluding.
-                rLowBoundary = rFarBoundary - segment_hr_dims[0]
-                rLowBoundaryNext = rLowBoundaryNext + strideOfSegmentsPerDimInVoxels[0]
-                rAxisCentralPartPredicted = False if rFarBoundary < inp_chan_dims[0] else True
-
-                # In case I pass a brain-mask, I ll use it to only predict inside it. Otherwise, whole image.
-                if isinstance(roi_mask, np.ndarray):
-                    if not np.any(roi_mask[rLowBoundary:rFarBoundary,
-                                           cLowBoundary:cFarBoundary,
-                                           zLowBoundary:zFarBoundary]
-                                  ):  # all of it is out of the brain so skip it.
-                        continue
-
-                sliceCoordsOfSegmentsToReturn.append([[rLowBoundary, rFarBoundary - 1],
-                                                      [cLowBoundary, cFarBoundary - 1],
-                                                      [zLowBoundary, zFarBoundary - 1]])
-
-    # I need to have a total number of image-parts that can be exactly-divided by the 'batch_size'.
-    # For this reason, I add in the far end of the list multiple copies of the last element.
-    total_number_of_image_parts = len(sliceCoordsOfSegmentsToReturn)
-    number_of_imageParts_missing_for_exact_division = \
-        batch_size - total_number_of_image_parts % batch_size if total_number_of_image_parts % batch_size != 0 else 0
-    for extra_useless_image_part_i in range(number_of_imageParts_missing_for_exact_division):
-        sliceCoordsOfSegmentsToReturn.append(sliceCoordsOfSegmentsToReturn[-1])
+    # Low boundaries of the tiles per axis. The grid is ordered with z slowest and r fastest.
+    lows_per_axis = [calc_tile_lows_along_axis(segment_hr_dims[axis],
+                                               strideOfSegmentsPerDimInVoxels[axis],
+                                               inp_chan_dims[axis]) for axis in range(3)]
+    (z_lows, c_lows, r_lows) = np.meshgrid(lows_per_axis[2], lows_per_axis[1], lows_per_axis[0], indexing='ij')
+    tile_lows = np.stack([r_lows.ravel(), c_lows.ravel(), z_lows.ravel()], axis=1)  # [n_tiles, 3]
+    tile_highs = tile_lows + np.asarray(segment_hr_dims)  # Excluding.
+
+    # In case I pass a brain-mask, I ll use it to only predict inside it. Otherwise, whole image.
+    if isinstance(roi_mask, np.ndarray):
+        sat = calc_summed_area_table_3d(roi_mask)
+        if unpred_margin is None:
+            box_lows, box_highs = tile_lows, tile_highs
+        else:
+            box_lows = tile_lows + np.asarray([margin[0] for margin in unpred_margin])
+            box_highs = tile_highs - np.asarray([margin[1] for margin in unpred_margin])
+        tiles_in_roi = count_nonzero_in_boxes_3d(sat, box_lows, box_highs) > 0
+        log.print3("Tiles skipped because they do not overlap the ROI: " + str(len(tiles_in_roi) - np.sum(tiles_in_roi)))
+        tile_lows = tile_lows[tiles_in_roi]
+        tile_highs = tile_highs[tiles_in_roi]
+
+    # numberOfSegments x 3(rcz) x 2 (lower and upper limit of the segment, INCLUSIVE both sides)
+    sliceCoordsOfSegmentsToReturn = np.stack([tile_lows, tile_highs - 1], axis=2).tolist()
+    # The list is not padded to a multiple of the batch size. The last batch is smaller instead.
 
     # I think that since the parts are acquired in a certain order and are sorted this way in the list, it is easy
     # to know which part of the image they came from, as it depends only on the stride-size and the imagePart size.
@@ -843,9 +881,11 @@ def extractSegmentsGivenSliceCoords(cnn3d,
                                     sliceCoordsOfSegmentsToExtract,
                                     channelsOfImageNpArray,
                                     inp_shapes_per_path,
-                                    outp_pred_dims):
+                                    outp_pred_dims,
+                                    border_int_per_chan=None):
     # sliceCoordsOfSegmentsToExtract: list of length num_segments. Each elem: [[r_low, r_high], [c_l, c_h], [z_l, z_h]]
     # channelsOfImageNpArray: numpy array [ n_channels, x, y, z ]
+    # border_int_per_chan: For subsampled pathways, where out of the image. See get_subsampl_segment.
     # Returns: list with length [num_pathways], where each element is a list of length [num_segments],
     #          of arrays [channels, r, c, z]
     # TODO: Change result to a list of arrays [num_segments, channs, r, c, z]
@@ -877,7 +917,8 @@ def extractSegmentsGivenSliceCoords(cnn3d,
                                                                     channelsOfImageNpArray,
                                                                     sliceCoordsOfSegmentsToExtract[segment_i],
                                                                     cnn3d.pathways[pathway_i].subs_factor(),
-                                                                    inp_shapes_per_path[pathway_i])
+                                                                    inp_shapes_per_path[pathway_i],
+                                                                    border_int_per_chan)
 
             channsForSegmentsPerPathToReturn[pathway_i].append(channsForThisSubsPathForThisSegm)
 
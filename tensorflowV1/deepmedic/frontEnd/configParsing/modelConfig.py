@@ -27,6 +27,8 @@ class ModelConfig(Config):
     PAD_MODE_NORM = "padTypePerLayerNormal"
     RESID_CONN_LAYERS_NORM = "layersWithResidualConnNormal"
     LOWER_RANK_LAYERS_NORM = "lowerRankLayersNormal"
+    DEPTHWISE_SEP_LAYERS_NORM = "depthwiseSeparableLayersNormal"
+    GROUPED_LAYERS_NORM = "groupedConvLayersNormal"
     
     #==Subsampled pathway==
     USE_SUBSAMPLED = "useSubsampledPathway"
@@ -36,12 +38,18 @@ class ModelConfig(Config):
     SUBS_FACTOR = "subsampleFactor"
     RESID_CONN_LAYERS_SUBS = "layersWithResidualConnSubsampled"
     LOWER_RANK_LAYERS_SUBS = "lowerRankLayersSubsampled"
+    DEPTHWISE_SEP_LAYERS_SUBS = "depthwiseSeparableLayersSubsampled"
+    GROUPED_LAYERS_SUBS = "groupedConvLayersSubsampled"
     
     #==Extra hidden FC Layers. Final Classification layer is not included in here.
     N_FM_FC = "numberFMsPerLayerFC"
     KERN_DIM_FC = "kernelDimPerLayerFC"
     PAD_MODE_FC = "padTypePerLayerFC"
     RESID_CONN_LAYERS_FC = "layersWithResidualConnFC"
+    GROUPED_LAYERS_FC = "groupedConvLayersFC"
+    
+    #Number of groups of the channels in grouped convolutional layers
+    N_GROUPS_GROUPED_CONVS = "numberOfGroupsInGroupedConvs"
     
     #Size of Image Segments
     SEG_DIM_TRAIN = "segmentsDimTrain"
@@ -60,6 +68,7 @@ class ModelConfig(Config):
     
     #Batch Normalization
     BN_ROLL_AV_BATCHES = "rollAverageForBNOverThatManyBatches"
+    BN_FUSED = "useFusedBatchNorm"
     
 
     def __init__(self, abs_path_to_cfg):
@@ -163,6 +163,21 @@ class ModelParameters(object):
               "or an empty list [] for no such connections. Exiting!")
         exit(1)
 
+    @staticmethod
+    def errorLayerOfManyConvTypes(strPathwayType, layer_num):
+        print("ERROR: Layer [", layer_num, "] of the [", strPathwayType, "] pathway was specified in more than one of "
+              "the parameters \"lowerRankLayers\", \"depthwiseSeparableLayers\" and \"groupedConvLayers\".")
+        print("\t A layer can be of only one of these types. Exiting!")
+        exit(1)
+
+    @staticmethod
+    def errorGroupsNotDividingFMs(strPathwayType, layer_num, n_fms_in, n_fms_out, n_groups):
+        print("ERROR: Layer [", layer_num, "] of the [", strPathwayType, "] pathway was specified in the parameter "
+              "\"groupedConvLayers\", but its number of input FMs [", n_fms_in, "] and output FMs [", n_fms_out, "] "
+              "are not both divisible by the number of groups [", n_groups, "] (\"numberOfGroupsInGroupedConvs\").")
+        print("\t Change the number of FMs or groups, or do not make this layer grouped. Exiting!")
+        exit(1)
+
     @staticmethod
     def warnForSameReceptiveField():
         print("WARN: Because of limitations in the current version, the two pathways must have the same "
@@ -223,6 +238,18 @@ class ModelParameters(object):
             self.errorResLayer1("Fully Connected")
 
 
+    def _check_conv_types_per_layer(self, strPathwayType, n_fms_in_per_l, n_fms_out_per_l,
+                                    lower_rank_layers, depthwise_sep_layers, grouped_layers, n_groups):
+        # Layer numbers, starting from 1.
+        for layer_num in set(lower_rank_layers + depthwise_sep_layers + grouped_layers):
+            if (layer_num in lower_rank_layers) + (layer_num in depthwise_sep_layers) + (layer_num in grouped_layers) > 1:
+                self.errorLayerOfManyConvTypes(strPathwayType, layer_num)
+        for layer_num in grouped_layers:
+            n_fms_in, n_fms_out = n_fms_in_per_l[layer_num - 1], n_fms_out_per_l[layer_num - 1]
+            if n_fms_in % n_groups != 0 or n_fms_out % n_groups != 0:
+                self.errorGroupsNotDividingFMs(strPathwayType, layer_num, n_fms_in, n_fms_out, n_groups)
+
+
     def _default_drop_fc(self, n_fms_in_extra_fcs):
         # n_fms_in_extra_fcs: List of integers, 1 per layer in the final classification path, except final classif layer
         n_extra_fcs = len(n_fms_in_extra_fcs)
@@ -255,6 +282,9 @@ class ModelParameters(object):
         # The below are layer numbers, starting from 1 for 1st layer. NOT indices starting from 0.
         res_conn_at_layers_norm = cfg[cfg.RESID_CONN_LAYERS_NORM] if cfg[cfg.RESID_CONN_LAYERS_NORM] is not None else []
         lower_rank_layers_norm = cfg[cfg.LOWER_RANK_LAYERS_NORM] if cfg[cfg.LOWER_RANK_LAYERS_NORM] is not None else []
+        depthwise_sep_layers_norm = cfg[cfg.DEPTHWISE_SEP_LAYERS_NORM] if cfg[cfg.DEPTHWISE_SEP_LAYERS_NORM] is not None \
+            else []
+        grouped_layers_norm = cfg[cfg.GROUPED_LAYERS_NORM] if cfg[cfg.GROUPED_LAYERS_NORM] is not None else []
         
         # == Subsampled pathway ==
         self._use_subs_paths = cfg[cfg.USE_SUBSAMPLED] if cfg[cfg.USE_SUBSAMPLED] is not None else False
@@ -265,6 +295,8 @@ class ModelParameters(object):
             self._pad_mode_per_l_subs = []
             res_conn_at_layers_subs = []
             lower_rank_layers_subs = []
+            depthwise_sep_layers_subs = []
+            grouped_layers_subs = []
             rec_field_subs = []
 
         else:
@@ -312,6 +344,12 @@ class ModelParameters(object):
                 else res_conn_at_layers_norm
             lower_rank_layers_subs = cfg[cfg.LOWER_RANK_LAYERS_SUBS] if cfg[cfg.LOWER_RANK_LAYERS_SUBS] is not None \
                 else lower_rank_layers_norm
+            # Depthwise separable and grouped. As of the normal pathway, unless any of the two is given for the subsampled.
+            conv_types_subs_given = cfg[cfg.DEPTHWISE_SEP_LAYERS_SUBS] is not None or cfg[cfg.GROUPED_LAYERS_SUBS] is not None
+            depthwise_sep_layers_subs = cfg[cfg.DEPTHWISE_SEP_LAYERS_SUBS] if cfg[cfg.DEPTHWISE_SEP_LAYERS_SUBS] is not None \
+                else [] if conv_types_subs_given else depthwise_sep_layers_norm
+            grouped_layers_subs = cfg[cfg.GROUPED_LAYERS_SUBS] if cfg[cfg.GROUPED_LAYERS_SUBS] is not None \
+                else [] if conv_types_subs_given else grouped_layers_norm
             
         # == FC Layers ==
         self._n_fms_in_extra_fcs = cfg[cfg.N_FM_FC] if cfg[cfg.N_FM_FC] is not None else []
@@ -322,6 +360,9 @@ class ModelParameters(object):
                                                       'equal to length of number-of-FMs-in-FC +1 (for classif layer)'
         self._pad_mode_per_l_fc = cfg[cfg.PAD_MODE_FC] if cfg[cfg.PAD_MODE_FC] is not None else ['VALID'] * n_layers_fc
         res_conn_at_layers_fc = cfg[cfg.RESID_CONN_LAYERS_FC] if cfg[cfg.RESID_CONN_LAYERS_FC] is not None else []
+        grouped_layers_fc = cfg[cfg.GROUPED_LAYERS_FC] if cfg[cfg.GROUPED_LAYERS_FC] is not None else []
+        self._n_groups_grouped_convs = cfg[cfg.N_GROUPS_GROUPED_CONVS] if cfg[cfg.N_GROUPS_GROUPED_CONVS] is not None else 4
+        assert self._n_groups_grouped_convs >= 1
                                         
         # == Size of Image Segments ==
         self._inp_dims_hr_path = {'train': None, 'val': None, 'test': None}
@@ -354,6 +395,7 @@ class ModelParameters(object):
         # == BATCH NORMALIZATION ==
         self._apply_bn_to_inp_of_paths = [False, False, True] # Per pathway type. 3rd entry for FC must always be True
         self._n_batches_for_bn_mov_avg = cfg[cfg.BN_ROLL_AV_BATCHES] if cfg[cfg.BN_ROLL_AV_BATCHES] is not None else 60
+        self._use_fused_bn = cfg[cfg.BN_FUSED] if cfg[cfg.BN_FUSED] is not None else False
         
         # ============== CALCULATED =====================
         # Residual Connections backwards, per pathway type :
@@ -375,6 +417,31 @@ class ModelParameters(object):
                                                   [],
                                                   []
                                                   ]
+        # Depthwise separable and grouped convs, per pathway type:
+        n_fms_out_fc = self._n_fms_in_extra_fcs + [self._n_classes]
+        n_fms_in_fc = [sum([self._n_fms_per_l_norm[-1]] + [n_fms_subs[-1] for n_fms_subs in self._n_fms_per_l_subs])] + \
+                      n_fms_out_fc[:-1]
+        self._check_conv_types_per_layer("Normal", [self._n_in_chans] + self._n_fms_per_l_norm[:-1],
+                                         self._n_fms_per_l_norm, lower_rank_layers_norm,
+                                         depthwise_sep_layers_norm, grouped_layers_norm, self._n_groups_grouped_convs)
+        for n_fms_per_l_subs in self._n_fms_per_l_subs:
+            self._check_conv_types_per_layer("Subsampled", [self._n_in_chans] + n_fms_per_l_subs[:-1],
+                                             n_fms_per_l_subs, lower_rank_layers_subs,
+                                             depthwise_sep_layers_subs, grouped_layers_subs, self._n_groups_grouped_convs)
+        self._check_conv_types_per_layer("Fully Connected", n_fms_in_fc, n_fms_out_fc, [],
+                                         [], grouped_layers_fc, self._n_groups_grouped_convs)
+        self._inds_layers_dw_sep_per_pathtype = [[layer_num - 1 for layer_num in depthwise_sep_layers_norm],
+                                                 [layer_num - 1 for layer_num in depthwise_sep_layers_subs],
+                                                 [], # FC is 1x1x1, nothing to separate.
+                                                 []
+                                                 ]
+        self._inds_layers_grouped_per_pathtype = [[layer_num - 1 for layer_num in grouped_layers_norm],
+                                                  [layer_num - 1 for layer_num in grouped_layers_subs],
+                                                  [layer_num - 1 for layer_num in grouped_layers_fc],
+                                                  []
+                                                  ]
+        self._n_groups_of_grouped_l_per_pathtype = [[self._n_groups_grouped_convs for layer_i in inds_grouped]
+                                                    for inds_grouped in self._inds_layers_grouped_per_pathtype]
         # ============= HIDDENS ===============
         
         # ------- POOLING ---------- (not fully supported currently)
@@ -416,6 +483,8 @@ class ModelParameters(object):
         logPrint("Residual connections added at the output of layers (indices from 0) = " + str(self._inds_layers_for_res_conn_at_outp[0]))
         logPrint("Layers that will be made of Lower Rank (indices from 0) = " + str(self._inds_layers_low_rank_per_pathtype[0]))
         logPrint("Lower Rank layers will be made of rank = " + str(self._ranks_of_low_rank_l_per_pathtype[0]))
+        logPrint("Layers that will be Depthwise Separable (indices from 0) = " + str(self._inds_layers_dw_sep_per_pathtype[0]))
+        logPrint("Layers that will be Grouped convs (indices from 0) = " + str(self._inds_layers_grouped_per_pathtype[0]))
         
         logPrint("~~Subsampled Pathway~~")
         logPrint("Use subsampled Pathway = " + str(self._use_subs_paths))
@@ -428,6 +497,8 @@ class ModelParameters(object):
         logPrint("Residual connections added at the output of layers (indices from 0) = " + str(self._inds_layers_for_res_conn_at_outp[1]))
         logPrint("Layers that will be made of Lower Rank (indices from 0) = " + str(self._inds_layers_low_rank_per_pathtype[1]))
         logPrint("Lower Rank layers will be made of rank = " + str(self._ranks_of_low_rank_l_per_pathtype[1]))
+        logPrint("Layers that will be Depthwise Separable (indices from 0) = " + str(self._inds_layers_dw_sep_per_pathtype[1]))
+        logPrint("Layers that will be Grouped convs (indices from 0) = " + str(self._inds_layers_grouped_per_pathtype[1]))
 
         logPrint("~~Fully Connected Pathway~~")
         logPrint("Number of additional FC layers (Excluding the Classif. Layer) = " + str(len(self._n_fms_in_extra_fcs)))
@@ -435,6 +506,8 @@ class ModelParameters(object):
         logPrint("Padding mode of convs per layer = " + str(self._pad_mode_per_l_fc))
         logPrint("Residual connections added at the output of layers (indices from 0) = " + str(self._inds_layers_for_res_conn_at_outp[2]))
         logPrint("Layers that will be made of Lower Rank (indices from 0) = " + str(self._inds_layers_low_rank_per_pathtype[2]))
+        logPrint("Layers that will be Grouped convs (indices from 0) = " + str(self._inds_layers_grouped_per_pathtype[2]))
+        logPrint("Number of groups of the channels in Grouped convs (all pathways) = " + str(self._n_groups_grouped_convs))
         logPrint("Dimensions of Kernels in final FC path before classification = " + str(self._kern_dims_fc))
         
         logPrint("~~Size Of Image Segments~~")
@@ -456,6 +529,7 @@ class ModelParameters(object):
         logPrint("~~Batch Normalization~~")
         logPrint("Apply BN straight on pathways' inputs (eg straight on segments) = " + str(self._apply_bn_to_inp_of_paths))
         logPrint("Batch Normalization uses a rolling average for inference, over this many batches = " + str(self._n_batches_for_bn_mov_avg))
+        logPrint("Use the fused kernels of TensorFlow for Batch Normalization (epsilon 1.001e-5) = " + str(self._use_fused_bn))
         
         logPrint("========== Done with printing session's parameters ==========")
         logPrint("=============================================================")
@@ -490,6 +564,10 @@ class ModelParameters(object):
                 #--Lower Rank Layer Per Pathway---
                 self._inds_layers_low_rank_per_pathtype,
                 self._ranks_of_low_rank_l_per_pathtype,
+                #--Depthwise Separable and Grouped Conv Layers Per Pathway---
+                self._inds_layers_dw_sep_per_pathtype,
+                self._inds_layers_grouped_per_pathtype,
+                self._n_groups_of_grouped_l_per_pathtype,
                 #---Pooling---
                 self._max_pool_prms_per_pathtype,
 
@@ -500,7 +578,8 @@ class ModelParameters(object):
                 self._conv_w_init_type,
                 #Batch Normalization
                 self._apply_bn_to_inp_of_paths,
-                self._n_batches_for_bn_mov_avg
+                self._n_batches_for_bn_mov_avg,
+                self._use_fused_bn
                 ]
         
         return args
@@ -514,5 +593,8 @@ class ModelParameters(object):
     def get_n_classes(self):
         return self._n_classes
 
+    def get_use_subs_paths(self):
+        return self._use_subs_paths
+
     def get_model_name(self):
         return self._model_name
@@ -19,6 +19,7 @@ class TestConfig(Config):
     #[REQUIRED]
     FOLDER_OUTP = "folderForOutput"
     SAVED_MODEL = "cnnModelFilePath"
+    FROZEN_GRAPH = "frozen_inference_graph" # Default None. Else, path to a graph from -export, used instead of SAVED_MODEL.
     DATAFRAME = "dataframe"
     CHANNELS = "channels"
     FNAMES_PREDS = "namesForPredictionsPerCase"
@@ -32,6 +33,30 @@ class TestConfig(Config):
     SUFFIX_SEGM_PROB = "suffixForSegmAndProbsDict"
     
     BATCHSIZE = "batchsize"
+    SEG_DIM_INFER = "segmentsDimInference" # Default None: as given in the model config. Eg written by -autotune.
+    
+    # ~~~~ Inference by whole-volume slabs instead of tiles ~~~~
+    INFER_BY_SLABS = "infer_by_slabs" # Default False
+    SLAB_MEM_BUDGET_MB = "slab_mem_budget_mb" # Default None: whole volume in one slab.
+    # ~~~~ Load next and save previous subject in background, while predicting current ~~~~
+    INFER_PIPELINED = "infer_pipelined" # Default False
+    # ~~~~ Data-parallel inference. Subjects are sharded over worker processes, each with its own TF session ~~~~
+    N_WORKERS = "n_inference_workers" # Default 1: No workers, all subjects in main process.
+    N_THREADS_PER_WORKER = "n_threads_per_worker" # Default None: cpu-cores / n_inference_workers
+    PIN_WORKERS_TO_CORES = "pin_workers_to_cores" # Default False
+    # ~~~~ Back output prob maps and FMs by scratch files on disk instead of RAM ~~~~
+    MEMMAP_OUTP_VOLS = "memmap_output_volumes" # Default False
+    FOLDER_MEMMAP = "folder_for_memmap_files" # Default: folderForOutput
+    # ~~~~ Make only the segmentation while stitching, no prob maps per class ~~~~
+    INFER_LABELS_ONLY = "infer_labels_only" # Default False
+    SAVE_MAX_PROB_MAP = "save_max_prob_map" # Default False
+    # ~~~~ Crop each subject to the bounding box of its ROI before processing ~~~~
+    CROP_TO_ROI = "crop_to_roi" # Default False
+    # ~~~~ Compile the forward pass with XLA ~~~~
+    USE_XLA_JIT = "use_xla_jit" # Default False
+    XLA_TIME_UNCOMPILED = "xla_time_uncompiled" # Default False. For debugging. Time the forward pass also not compiled.
+    # ~~~~ Precision of the net's activations and computations ~~~~
+    PRECISION_POLICY = "precision_policy" # "float32" (default) or "mixed_bfloat16"
     
     # optionals, cause default is False.
     SAVE_INDIV_FMS = "saveIndividualFms"
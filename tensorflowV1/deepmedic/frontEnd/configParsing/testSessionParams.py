@@ -8,6 +8,7 @@
 from __future__ import absolute_import, print_function, division
 
 import os
+import multiprocessing
 import pandas as pd
 
 from deepmedic.frontEnd.configParsing.utils import abs_from_rel_path, parse_filelist, check_and_adjust_path_to_ckpt, \
@@ -46,6 +47,9 @@ class TestSessionParameters(object) :
         abs_path_cfg = cfg.get_abs_path_to_cfg()
         path_model = abs_from_rel_path(cfg[cfg.SAVED_MODEL], abs_path_cfg) if cfg[cfg.SAVED_MODEL] is not None else None
         self.model_ckpt_path = check_and_adjust_path_to_ckpt(self.log, path_model) if path_model is not None else None
+        # Frozen graph for inference, as exported with -export. If given, used instead of the checkpoint.
+        self.frozen_graph_path = abs_from_rel_path(cfg[cfg.FROZEN_GRAPH], abs_path_cfg) \
+            if cfg[cfg.FROZEN_GRAPH] is not None else None
 
         # Input:
         if cfg[cfg.DATAFRAME] is not None:  # get data from csv/dataframe
@@ -64,7 +68,9 @@ class TestSessionParameters(object) :
         else:  # Get data input data from old variables.
             self.csv_fname = None
             self.dataframe = None
-            self.channels_fpaths = parse_fpaths_of_channs_from_filelists(cfg[cfg.CHANNELS], abs_path_cfg)
+            # Channels may not be given, eg if only serving segmentation requests.
+            self.channels_fpaths = parse_fpaths_of_channs_from_filelists(cfg[cfg.CHANNELS], abs_path_cfg) \
+                if cfg[cfg.CHANNELS] is not None else []
             self.gt_fpaths = parse_filelist(abs_from_rel_path(cfg[cfg.GT_LBLS], abs_path_cfg), make_abs=True) \
                 if cfg[cfg.GT_LBLS] is not None else None
             self.roi_fpaths = parse_filelist(abs_from_rel_path(cfg[cfg.ROIS], abs_path_cfg), make_abs=True) \
@@ -81,6 +87,39 @@ class TestSessionParameters(object) :
         self.suffixes_for_outp = cfg[cfg.SUFFIX_SEGM_PROB] if cfg[cfg.SUFFIX_SEGM_PROB] is not None \
             else {"segm": "Segm", "prob": "ProbMapClass"}
         self.batchsize = cfg[cfg.BATCHSIZE] if cfg[cfg.BATCHSIZE] is not None else 10
+        # Size of segments. If None, as given in the model config.
+        self.inp_dims_hr_path = cfg[cfg.SEG_DIM_INFER]
+        # Inference by slabs. The fully convolutional net is given the largest slabs of the volume that fit in memory.
+        self.infer_by_slabs_requested = cfg[cfg.INFER_BY_SLABS] if cfg[cfg.INFER_BY_SLABS] is not None else False
+        self.infer_prms = {'slabs': self.infer_by_slabs_requested,
+                           'slab_mem_budget_mb': cfg[cfg.SLAB_MEM_BUDGET_MB],
+                           # Pipelining: Overlap loading, prediction and saving of consecutive subjects.
+                           'pipelined': cfg[cfg.INFER_PIPELINED] if cfg[cfg.INFER_PIPELINED] is not None else False,
+                           # Folder for scratch files that back the output volumes. None to keep them in RAM.
+                           'memmap_dir': None,
+                           # Only the segmentation (and optionally the prob of the predicted class), no prob maps.
+                           'labels_only': cfg[cfg.INFER_LABELS_ONLY] if cfg[cfg.INFER_LABELS_ONLY] is not None else False,
+                           'max_prob': cfg[cfg.SAVE_MAX_PROB_MAP] if cfg[cfg.SAVE_MAX_PROB_MAP] is not None else False,
+                           # Process only the bounding box of the ROI (plus receptive field) of each subject.
+                           'crop_to_roi': cfg[cfg.CROP_TO_ROI] if cfg[cfg.CROP_TO_ROI] is not None else False,
+                           # Pad the shapes given to the net to few sizes, so that XLA does not recompile for each.
+                           'bucket_shapes': False}
+        # Compile the forward pass with XLA.
+        self.use_xla = cfg[cfg.USE_XLA_JIT] if cfg[cfg.USE_XLA_JIT] is not None else False
+        self.infer_prms['bucket_shapes'] = self.use_xla
+        # For debugging. Also make the forward pass not compiled, to log the speedup by XLA at warm-up.
+        self.xla_time_uncompiled = cfg[cfg.XLA_TIME_UNCOMPILED] if cfg[cfg.XLA_TIME_UNCOMPILED] is not None else False
+        # Precision: bfloat16 activations and compute, with float32 variables and BN statistics. Not for frozen graphs.
+        self.precision_policy = cfg[cfg.PRECISION_POLICY] if cfg[cfg.PRECISION_POLICY] is not None else "float32"
+        assert self.precision_policy in ["float32", "mixed_bfloat16"]
+        if cfg[cfg.MEMMAP_OUTP_VOLS]:
+            self.infer_prms['memmap_dir'] = abs_from_rel_path(cfg[cfg.FOLDER_MEMMAP], abs_path_cfg) \
+                if cfg[cfg.FOLDER_MEMMAP] is not None else self.main_outp_folder
+        # Data-parallel inference over worker processes.
+        self.n_workers = min(cfg[cfg.N_WORKERS], len(self.channels_fpaths)) if cfg[cfg.N_WORKERS] is not None else 1
+        self.n_threads_per_worker = cfg[cfg.N_THREADS_PER_WORKER] if cfg[cfg.N_THREADS_PER_WORKER] is not None \
+            else max(1, multiprocessing.cpu_count() // max(1, self.n_workers))
+        self.pin_workers_to_cores = cfg[cfg.PIN_WORKERS_TO_CORES] if cfg[cfg.PIN_WORKERS_TO_CORES] is not None else False
         # features:
         self.save_fms_flag = cfg[cfg.SAVE_INDIV_FMS] if cfg[cfg.SAVE_INDIV_FMS] is not None else False
         if self.save_fms_flag:
@@ -91,6 +130,10 @@ class TestSessionParameters(object) :
         else:
             self.inds_fms_per_pathtype_per_layer_to_save = None
         self.out_fms_fpaths = None  #Filled by call to self._make_fpaths_for_preds_and_fms()
+        if self.save_fms_flag and self.frozen_graph_path is not None:
+            self.log.print3("ERROR: In testing-config, saving FMs (" + cfg.SAVE_INDIV_FMS + ") is not possible with a " +
+                            "frozen graph (" + cfg.FROZEN_GRAPH + "), which keeps only the output. Exiting.")
+            exit(1)
 
         # ===================== PRE-PROCESSING ======================
         # === Data compatibility checks ===
@@ -108,7 +151,7 @@ class TestSessionParameters(object) :
                 norm_zscore_prms[key] = cfg[cfg.NORM_ZSCORE_PRMS][key]
         if norm_zscore_prms['apply_to_all_channels'] and norm_zscore_prms['apply_per_channel'] is not None:
             self.errorIntNormZScoreTwoAppliesGiven()
-        if norm_zscore_prms['apply_per_channel'] is not None:
+        if norm_zscore_prms['apply_per_channel'] is not None and cfg[cfg.CHANNELS] is not None:
             assert len(norm_zscore_prms['apply_per_channel']) == len(cfg[cfg.CHANNELS])  # num channels
         # Aggregate params from all types of normalization:
         # norm_prms = None : No int normalization will be performed.
@@ -147,6 +190,9 @@ class TestSessionParameters(object) :
     def get_path_to_load_model_from(self):
         return self.model_ckpt_path
 
+    def get_path_to_frozen_graph(self):
+        return self.frozen_graph_path
+
 
     def print_params(self):
         logPrint = self.log.print3
@@ -156,6 +202,8 @@ class TestSessionParameters(object) :
         logPrint("=============================================================")
         logPrint("sessionName = " + str(self._session_name))
         logPrint("Model will be loaded from save = " + str(self.model_ckpt_path))
+        logPrint("Frozen graph for inference, used instead of the saved model (None: not used) = " +
+                 str(self.frozen_graph_path))
         logPrint("~~~~~~~~~~~~~~~~~~~~INPUT~~~~~~~~~~~~~~~~")
         logPrint("Dataframe (csv) filename = " + str(self.csv_fname))
         logPrint("Number of cases to perform inference on = " + str(self.n_cases))
@@ -163,6 +211,29 @@ class TestSessionParameters(object) :
         logPrint("Paths to provided GT labels per case = " + str(self.gt_fpaths))
         logPrint("Filepaths of the ROI Masks provided per case = " + str(self.roi_fpaths))
         logPrint("Batch size = " + str(self.batchsize))
+        logPrint("Size of Segments (None: as in model config) = " + str(self.inp_dims_hr_path))
+        logPrint("Segment by whole-volume slabs instead of tiles = " + str(self.infer_prms['slabs']))
+        if self.infer_by_slabs_requested and not self.infer_prms['slabs']:
+            logPrint("WARN: Slabs were requested (infer_by_slabs), but are OFF: not supported for models with subsampled pathways.")
+        logPrint("Memory budget for the forward pass of a slab (MB, None for whole volume) = " +
+                 str(self.infer_prms['slab_mem_budget_mb']))
+        logPrint("Load next and save previous subject while predicting current (pipelined) = " +
+                 str(self.infer_prms['pipelined']))
+        logPrint("Folder for scratch files backing output volumes (None: in RAM) = " + str(self.infer_prms['memmap_dir']))
+        logPrint("Make only the segmentation, no probability maps per class (labels only) = " +
+                 str(self.infer_prms['labels_only']))
+        if self.infer_prms['labels_only']:
+            logPrint("Save probability of the predicted class (max prob map) = " + str(self.infer_prms['max_prob']))
+        logPrint("Crop each subject to the bounding box of its ROI before processing = " +
+                 str(self.infer_prms['crop_to_roi']))
+        logPrint("Compile the forward pass with XLA (and bucket shapes of inputs) = " + str(self.use_xla))
+        if self.use_xla:
+            logPrint("Time the forward pass also not compiled, to log the speedup by XLA (debugging) = " + str(self.xla_time_uncompiled))
+        logPrint("Precision policy of activations and computations = " + str(self.precision_policy))
+        logPrint("Number of worker processes to share the subjects = " + str(self.n_workers))
+        if self.n_workers > 1:
+            logPrint("Number of threads per worker = " + str(self.n_threads_per_worker))
+            logPrint("Pin each worker to its own cpu-cores = " + str(self.pin_workers_to_cores))
 
         logPrint("~~~~~~~~~~~~~~~~~~~OUTPUT~~~~~~~~~~~~~~~")
         logPrint("Path to the main output-folder = " + str(self.main_outp_folder))
@@ -196,18 +267,38 @@ class TestSessionParameters(object) :
         logPrint("========== Done with printing session's parameters ==========")
         logPrint("=============================================================\n")
 
-    def get_args_for_testing(self):
+    def get_inp_dims_hr_path(self, model_params):
+        return self.inp_dims_hr_path if self.inp_dims_hr_path is not None else model_params.get_inp_dims_hr_path('test')
+
+    def get_infer_by_slabs(self):
+        return self.infer_prms['slabs']
+
+    def disable_infer_by_slabs_if_unsupported(self, model_params):
+        # Low-res inputs of tiles are on a grid aligned per tile. A slab cannot reproduce it, so results would differ.
+        # Called before print_params(), so that the printed parameters show that tiling is used.
+        if self.infer_prms['slabs'] and model_params.get_use_subs_paths():
+            self.log.print3("WARN: Segmenting by slabs (infer_by_slabs) is not supported for models with subsampled "
+                            "pathways, as it would not give the same predictions as tiling. Segmenting by tiles instead.")
+            self.infer_prms['slabs'] = False
+
+    def get_args_for_testing(self, subjs_idxs=None):
+        # subjs_idxs: If given, only the subjects with these indices are included, eg for a worker process.
 
         validation0orTesting1 = 1
 
+        def of_subjs(list_per_subj):
+            if subjs_idxs is None or list_per_subj is None:
+                return list_per_subj
+            return [list_per_subj[subj_i] for subj_i in subjs_idxs]
+
         args = [self.log,
                 validation0orTesting1,
                 {"segm": self.save_segms, "prob": self.save_probs_per_cl},
 
-                self.channels_fpaths,
-                self.gt_fpaths,
-                self.roi_fpaths,
-                self.out_preds_fpaths,
+                of_subjs(self.channels_fpaths),
+                of_subjs(self.gt_fpaths),
+                of_subjs(self.roi_fpaths),
+                of_subjs(self.out_preds_fpaths),
                 self.suffixes_for_outp,
                 # Hyper parameters
                 self.batchsize,
@@ -219,7 +310,7 @@ class TestSessionParameters(object) :
                 # For FM visualisation
                 self.save_fms_flag,
                 self.inds_fms_per_pathtype_per_layer_to_save,
-                self.out_fms_fpaths
+                of_subjs(self.out_fms_fpaths)
                 ]
         
         return args
@@ -38,6 +38,8 @@ class TrainConfig(Config):
     NUM_CASES_LOADED_PERSUB = "numOfCasesLoadedPerSubepoch"
     NUM_TR_SEGMS_LOADED_PERSUB = "numberTrainingSegmentsLoadedOnGpuPerSubep"
     BATCHSIZE_TR = "batchsize_train"
+    NUM_STEPS_PER_RUN_TR = "num_steps_per_session_run_train"
+    NUM_BATCHES_PER_UPDATE_TR = "num_batches_per_update_train"
     NUM_OF_PROC_SAMPL = "num_processes_sampling"
     
     # ~~~~~ Learning rate schedule ~~~~~
@@ -96,6 +98,7 @@ class TrainConfig(Config):
     # RMS
     RHO_RMS = "rhoRms"
     EPS_RMS = "epsilonRms"
+    FUSED_OPT_OPS = "useFusedOptimizerOps"
     # Losses
     LOSSES_WEIGHTS = "losses_and_weights"
     W_C_IN_COST = "reweight_classes_in_cost"
@@ -111,6 +114,11 @@ class TrainConfig(Config):
     # ========= GENERICS =========
     # ~~~~ Data compabitiliby checks ~~~
     RUN_INP_CHECKS = "run_input_checks"
+    # ~~~~ Compile the net with XLA ~~~~
+    USE_XLA_JIT = "use_xla_jit" # Default False
+    XLA_TIME_UNCOMPILED = "xla_time_uncompiled" # Default False. For debugging. Time the forward pass also not compiled.
+    # ~~~~ Precision of the net's activations and computations ~~~~
+    PRECISION_POLICY = "precision_policy" # "float32" (default) or "mixed_bfloat16"
     # ~~~~~ Preprocessing ~~~~~~~~
     PAD_INPUT = "padInputImagesBool"
     NORM_VERB_LVL = "norm_verbosity_lvl"
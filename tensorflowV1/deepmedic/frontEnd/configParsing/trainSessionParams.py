@@ -254,6 +254,11 @@ class TrainSessionParameters(object):
         self.n_samples_per_subep_train = \
             cfg[cfg.NUM_TR_SEGMS_LOADED_PERSUB] if cfg[cfg.NUM_TR_SEGMS_LOADED_PERSUB] is not None else 1000
         self.batchsize_train = cfg[cfg.BATCHSIZE_TR] if cfg[cfg.BATCHSIZE_TR] is not None else self.errReqBatchSizeTr()
+        self.n_steps_per_run_train = cfg[cfg.NUM_STEPS_PER_RUN_TR] if cfg[cfg.NUM_STEPS_PER_RUN_TR] is not None else 1
+        assert self.n_steps_per_run_train >= 1
+        self.n_batches_per_update_train = \
+            cfg[cfg.NUM_BATCHES_PER_UPDATE_TR] if cfg[cfg.NUM_BATCHES_PER_UPDATE_TR] is not None else 1
+        assert self.n_batches_per_update_train >= 1
         self.num_parallel_proc_sampling = cfg[cfg.NUM_OF_PROC_SAMPL] if cfg[cfg.NUM_OF_PROC_SAMPL] is not None else 0
 
         # ~~~~~~~ Learning Rate Schedule ~~~~~~~~
@@ -403,6 +408,13 @@ class TrainSessionParameters(object):
         # ===================== PRE-PROCESSING ======================
         # === Data compatibility checks ===
         self.run_input_checks = cfg[cfg.RUN_INP_CHECKS] if cfg[cfg.RUN_INP_CHECKS] is not None else True
+        # === Compilation of the net's graph with XLA ===
+        self.use_xla = cfg[cfg.USE_XLA_JIT] if cfg[cfg.USE_XLA_JIT] is not None else False
+        # For debugging. Also make the inference graph not compiled, to log the speedup by XLA at warm-up.
+        self.xla_time_uncompiled = cfg[cfg.XLA_TIME_UNCOMPILED] if cfg[cfg.XLA_TIME_UNCOMPILED] is not None else False
+        # === Precision: bfloat16 activations and compute, with float32 variables, BN statistics and costs ===
+        self.precision_policy = cfg[cfg.PRECISION_POLICY] if cfg[cfg.PRECISION_POLICY] is not None else "float32"
+        assert self.precision_policy in ["float32", "mixed_bfloat16"]
         # == Padding ==
         self.pad_input = cfg[cfg.PAD_INPUT] if cfg[cfg.PAD_INPUT] is not None else True
         # == Normalization ==
@@ -479,6 +491,7 @@ class TrainSessionParameters(object):
         self.momentumValue = cfg[cfg.MOM] if cfg[cfg.MOM] is not None else 0.6
         if self.momentumValue < 0. or self.momentumValue > 1:
             self.errorRequireMomValueBetween01()
+        self.fused_optimizer_ops = cfg[cfg.FUSED_OPT_OPS] if cfg[cfg.FUSED_OPT_OPS] is not None else False
 
         # ==Regularization==
         self.L1_reg_weight = cfg[cfg.L1_REG] if cfg[cfg.L1_REG] is not None else 0.000001
@@ -592,6 +605,14 @@ class TrainSessionParameters(object):
                  ". NOTE: This number of segments divided by the batch-size defines the number of "
                  "optimization-iterations that will be performed every subepoch!")
         logPrint("Batch size (train) = " + str(self.batchsize_train))
+        logPrint("Number of training steps (batches) per session run = " + str(self.n_steps_per_run_train))
+        logPrint("Number of batches to accumulate gradients over, per optimizer update = " +
+                 str(self.n_batches_per_update_train) + ". Effective batch size = " +
+                 str(self.batchsize_train * self.n_batches_per_update_train))
+        n_batches_left_per_subep = (self.n_samples_per_subep_train // self.batchsize_train) % self.n_batches_per_update_train
+        if n_batches_left_per_subep > 0:
+            logPrint("WARN: Batches per subepoch are not a multiple of the batches per update. The last " +
+                     str(n_batches_left_per_subep) + " batches of every subepoch make an update with the mean of their gradients.")
         logPrint("Number of parallel processes for sampling = " + str(self.num_parallel_proc_sampling))
 
         logPrint("~~Learning Rate Schedule~~")
@@ -667,6 +688,7 @@ class TrainSessionParameters(object):
         logPrint("Momentum Type: Classic (0) or Nesterov (1) = " + str(self.classicMom0Nesterov1))
         logPrint("Momentum Non-Normalized (0) or Normalized (1) = " + str(self.momNonNormalized0Normalized1))
         logPrint("Momentum Value = " + str(self.momentumValue))
+        logPrint("Use fused ops for the updates of the optimizer = " + str(self.fused_optimizer_ops))
         logPrint("~~Costs~~")
         logPrint("Loss functions and their weights = " + str(self.losses_and_weights))
         logPrint("Reweight samples in cost on a per-class basis = " + str(self.reweight_classes_in_cost))
@@ -681,6 +703,12 @@ class TrainSessionParameters(object):
         logPrint("~~~~~~~~~~~~~~~~~~ PRE-PROCESSING ~~~~~~~~~~~~~~~~")
         logPrint("~~Data Compabitibility Checks~~")
         logPrint("Check whether input data has correct format (can slow down process) = " + str(self.run_input_checks))
+        logPrint("~~Compilation~~")
+        logPrint("Compile the net with XLA = " + str(self.use_xla))
+        if self.use_xla:
+            logPrint("Time the inference graph also not compiled, to log the speedup by XLA (debugging) = " + str(self.xla_time_uncompiled))
+        logPrint("~~Precision~~")
+        logPrint("Precision policy of activations and computations = " + str(self.precision_policy))
         logPrint("~~Padding~~")
         logPrint("Pad Input Images = " + str(self.pad_input))
         logPrint("~~Intensity Normalization~~")
@@ -724,6 +752,7 @@ class TrainSessionParameters(object):
                 self.sampling_type_inst_tr,
                 self.sampling_type_inst_val,
                 self.batchsize_train,
+                self.n_steps_per_run_train,
                 self.batchsize_val_samples,
                 self.batchsize_val_whole,
                 
@@ -745,7 +774,10 @@ class TrainSessionParameters(object):
                 
                 # -------- Pre-Processing ------
                 self.pad_input,
-                self.norm_prms
+                self.norm_prms,
+                
+                # -------- Compilation ------
+                self.use_xla
                 ]
         return args
 
@@ -758,7 +790,9 @@ class TrainSessionParameters(object):
                 self.L2_reg_weight,
                 # Cost Schedules
                 # Weighting Classes differently in the CNN's cost function during training:
-                self.reweight_classes_in_cost
+                self.reweight_classes_in_cost,
+                # Gradient accumulation
+                self.n_batches_per_update_train
                 ]
         return args
 
@@ -776,6 +810,7 @@ class TrainSessionParameters(object):
                 self.b2Adam,
                 self.eAdam,
                 self.rhoRms,
-                self.eRms
+                self.eRms,
+                self.fused_optimizer_ops
                 ]
         return args
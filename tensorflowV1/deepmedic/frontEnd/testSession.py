@@ -8,14 +8,118 @@
 from __future__ import absolute_import, print_function, division
 from six.moves import input
 import os
+import multiprocessing
 
 import tensorflow as tf
 from deepmedic.frontEnd.session import Session
 from deepmedic.frontEnd.configParsing.utils import abs_from_rel_path
 from deepmedic.frontEnd.configParsing.testSessionParams import TestSessionParameters
 from deepmedic.frontEnd.sessHelpers import make_folders_for_test_session, handle_exception_tf_restore
+from deepmedic.logging import loggers
+from deepmedic.logging.accuracyMonitor import AccuracyMonitorForEpSegm
 from deepmedic.neuralnet.cnn3d import Cnn3d
-from deepmedic.routines.testing import inference_on_whole_volumes
+from deepmedic.neuralnet.ops import xla_jit_scope
+from deepmedic.routines.testing import inference_on_whole_volumes, report_metrics_for_subject, \
+    calc_stats_of_metrics, report_mean_metrics, warmup_compiled_test_op
+from deepmedic.routines.autotune import autotune_test_segm_and_batchsize, write_autotuned_test_cfg
+from deepmedic.routines.serving import serve_segmentation
+from deepmedic.routines.export import export_frozen_inference_graph, load_frozen_inference_graph_def, \
+    import_frozen_inference_graph
+
+
+def make_test_graph(log, sess_device, model_params, inp_dims_hr_path, dynamic_dims, inds_fms_to_save, verbose=True,
+                    frozen_graph_path=None, use_xla=False, precision_policy="float32", xla_time_uncompiled=False):
+    # frozen_graph_path: If given, the forward pass is imported from this frozen graph, instead of made from the
+    #                    variables of the model. The model is still made, for its architecture (eg dims of segments).
+    # use_xla: If True, the forward pass is compiled by XLA (its ops are fused in clusters). See ops.xla_jit_scope.
+    # precision_policy: See Cnn3d.apply(). A frozen graph is always float32.
+    # xla_time_uncompiled: For debugging. If True and use_xla, the forward pass is also made not compiled, only to
+    #                      time it at warm-up. It doubles the graph (a frozen graph is imported twice).
+    # Returns: graphTf, cnn3d, inp_shapes_per_path, saver_net, coll_vars_net
+    graphTf = tf.Graph()
+    
+    with graphTf.as_default():
+        with graphTf.device(sess_device): # Throws an error if GPU is specified but not available.
+            log.print3("=========== Making the CNN graph... ===============")
+            cnn3d = Cnn3d()
+            with tf.compat.v1.variable_scope("net"):
+                cnn3d.make_cnn_model(*model_params.get_args_for_arch())  # Creates network's graph (no optimizer)
+                if min(cnn3d.calc_outp_dims_given_inp(inp_dims_hr_path)) < 1:
+                    log.print3("ERROR: Size of segments for testing " + str(inp_dims_hr_path) +
+                               " is smaller than the receptive field of the model. Exiting."); exit(1)
+                inp_plchldrs, inp_shapes_per_path = cnn3d.create_inp_plchldrs(inp_dims_hr_path, 'test',
+                                                                              dynamic_dims=dynamic_dims)
+                def make_forward_pass():
+                    if frozen_graph_path is None:
+                        return cnn3d.apply(inp_plchldrs, 'infer', 'test', verbose=verbose, log=log,
+                                           precision_policy=precision_policy)
+                    else:
+                        return import_frozen_inference_graph(log,
+                                                             load_frozen_inference_graph_def(log, frozen_graph_path),
+                                                             inp_plchldrs)
+                # If asked, the same forward pass uncompiled too, to time it against. Made first, because ...
+                # ... apply() keeps the outputs of the last call for saving FMs. Never run, but for timing.
+                p_y_given_x_uncompiled = make_forward_pass() if use_xla and xla_time_uncompiled else None
+                with xla_jit_scope(use_xla):
+                    p_y_given_x = make_forward_pass()
+                
+        log.print3("=========== Compiling the Testing Function ============")
+        log.print3("=======================================================\n")
+        
+        cnn3d.setup_ops_n_feeds_to_test(log, inp_plchldrs, p_y_given_x, inds_fms_to_save, p_y_given_x_uncompiled)
+        # Create the saver
+        coll_vars_net = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.GLOBAL_VARIABLES, scope="net")
+        saver_net = tf.compat.v1.train.Saver(var_list=coll_vars_net)  # saver_net would suffice
+        # TF2: dict_vars_net = {'net_var'+str(i): v for i, v in enumerate(coll_vars_net)}
+        # TF2: ckpt_net = tf.train.Checkpoint(**dict_vars_net)
+        
+    return graphTf, cnn3d, inp_shapes_per_path, saver_net, coll_vars_net
+
+
+def load_net_params(log, sessionTf, saver_net, file_to_load_params_from):
+    log.print3("=========== Loading parameters from specified saved model ===============")
+    chkpt_fname = tf.train.latest_checkpoint(file_to_load_params_from) if os.path.isdir(file_to_load_params_from) else file_to_load_params_from
+    log.print3("Loading parameters from:" + str(chkpt_fname))
+    try:
+        saver_net.restore(sessionTf, chkpt_fname)
+        # TF2: ckpt_net.restore(chkpt_fname)
+        log.print3("Parameters were loaded.")
+    except Exception as e: handle_exception_tf_restore(log, e)
+
+
+def run_inference_worker(worker_i, log_filepath, sess_device, model_params, file_to_load_params_from,
+                         frozen_graph_path, inp_dims_hr_path, dynamic_dims, inds_fms_to_save, n_threads, cores,
+                         args_for_testing, infer_prms, use_xla, precision_policy, xla_time_uncompiled):
+    # Runs in a separate process. Segments a shard of the subjects, with its own graph and session.
+    # args_for_testing: As from TestSessionParameters.get_args_for_testing(), for the subjects of this worker.
+    # cores: List of cpu-cores to pin this process to. None to leave it to the OS.
+    # Returns the metrics of each subject of the shard.
+    log = loggers.Logger(log_filepath)
+    log.print3("=========== Worker #" + str(worker_i) + " segmenting " + str(len(args_for_testing[3])) +
+               " subjects, with " + str(n_threads) + " threads ===============")
+    if cores is not None:
+        log.print3("Pinning worker to cpu-cores: " + str(cores))
+        os.sched_setaffinity(0, cores)
+    
+    (graphTf, cnn3d, inp_shapes_per_path,
+     saver_net, _) = make_test_graph(log, sess_device, model_params, inp_dims_hr_path, dynamic_dims,
+                                     inds_fms_to_save, verbose=False, frozen_graph_path=frozen_graph_path,
+                                     use_xla=use_xla, precision_policy=precision_policy,
+                                     xla_time_uncompiled=xla_time_uncompiled)
+    
+    with tf.compat.v1.Session(graph=graphTf, config=tf.compat.v1.ConfigProto(log_device_placement=False, device_count={'CPU':999, 'GPU':99},
+                                                                             intra_op_parallelism_threads=n_threads,
+                                                                             inter_op_parallelism_threads=2)) as sessionTf:
+        if frozen_graph_path is None:
+            load_net_params(log, sessionTf, saver_net, file_to_load_params_from)
+            cnn3d.refresh_bn_inference_stats(sessionTf)
+        if use_xla and not infer_prms['slabs']:  # Slabs have the shape of each volume. They compile when met.
+            warmup_compiled_test_op(log, sessionTf, cnn3d, inp_shapes_per_path, args_for_testing[8])  # [8]: batchsize
+        (_,
+         metrics_per_subj_per_c) = inference_on_whole_volumes(*([sessionTf, cnn3d, log] + args_for_testing[1:] +
+                                                                [inp_shapes_per_path, infer_prms]),
+                                                              return_metrics_per_subj=True)
+    return metrics_per_subj_per_c
 
 
 class TestSession(Session):
@@ -46,6 +150,7 @@ class TestSession(Session):
                                              self._out_folder_fms,
                                              model_params.get_n_classes(),
                                              self._cfg)
+        self._params.disable_infer_by_slabs_if_unsupported(model_params)
         
         self._log.print3("")
         self._log.print3("============     NEW TESTING SESSION    ===============")
@@ -78,57 +183,157 @@ class TestSession(Session):
     
     def run_session(self, *args):
         (sess_device,
-         model_params,) = args
-        
-        graphTf = tf.Graph()
-        
-        with graphTf.as_default():
-            with graphTf.device(sess_device): # Throws an error if GPU is specified but not available.
-                self._log.print3("=========== Making the CNN graph... ===============")
-                cnn3d = Cnn3d()
-                with tf.compat.v1.variable_scope("net"):
-                    cnn3d.make_cnn_model(*model_params.get_args_for_arch())  # Creates network's graph (no optimizer)
-                    inp_plchldrs, inp_shapes_per_path = cnn3d.create_inp_plchldrs(model_params.get_inp_dims_hr_path('test'), 'test')
-                    p_y_given_x = cnn3d.apply(inp_plchldrs, 'infer', 'test', verbose=True, log=self._log)
-                    
-            self._log.print3("=========== Compiling the Testing Function ============")
-            self._log.print3("=======================================================\n")
-            
-            cnn3d.setup_ops_n_feeds_to_test(self._log, inp_plchldrs, p_y_given_x, self._params.inds_fms_per_pathtype_per_layer_to_save)
-            # Create the saver
-            coll_vars_net = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.GLOBAL_VARIABLES, scope="net")
-            saver_net = tf.compat.v1.train.Saver(var_list=coll_vars_net)  # saver_net would suffice
-            # TF2: dict_vars_net = {'net_var'+str(i): v for i, v in enumerate(coll_vars_net)}
-            # TF2: ckpt_net = tf.train.Checkpoint(**dict_vars_net)
+         model_params,
+         autotune_mem_mb,  # If not None, autotune inference for this budget, instead of testing.
+         serve_port,  # If not None, serve segmentation requests at this port, instead of testing.
+         export_path) = args  # If not None, export the loaded model as a frozen graph for inference, instead of testing.
+        
+        inp_dims_hr_path = self._params.get_inp_dims_hr_path(model_params)
+        # Slabs differ in size per subject, and autotuning tries many segment sizes.
+        # Both need placeholders of dynamic dims.
+        dynamic_dims = self._params.get_infer_by_slabs() or autotune_mem_mb is not None
+        
+        # The frozen graph has the params. Not when exporting one, which needs the variables of the model.
+        frozen_graph_path = self._params.get_path_to_frozen_graph() if export_path is None else None
+        
+        if serve_port is not None and self._params.get_path_to_load_model_from() is None and frozen_graph_path is None:
+            self._log.print3("ERROR: Serving segmentation requires a saved model to load. Exiting."); exit(1)
+        if export_path is not None and self._params.get_path_to_load_model_from() is None:
+            self._log.print3("ERROR: Exporting a frozen graph requires a saved model to load. Exiting."); exit(1)
+        if self._params.n_workers > 1 and autotune_mem_mb is None and serve_port is None and export_path is None:
+            self._run_session_in_workers(sess_device, model_params, inp_dims_hr_path, dynamic_dims, frozen_graph_path)
+            return
+        
+        (graphTf, cnn3d, inp_shapes_per_path,
+         saver_net, coll_vars_net) = make_test_graph(self._log, sess_device, model_params, inp_dims_hr_path, dynamic_dims,
+                                                     self._params.inds_fms_per_pathtype_per_layer_to_save,
+                                                     frozen_graph_path=frozen_graph_path, use_xla=self._params.use_xla,
+                                                     precision_policy=self._params.precision_policy,
+                                                     xla_time_uncompiled=self._params.xla_time_uncompiled)
             
         with tf.compat.v1.Session(graph=graphTf, config=tf.compat.v1.ConfigProto(log_device_placement=False, device_count={'CPU':999, 'GPU':99})) as sessionTf:
             file_to_load_params_from = self._params.get_path_to_load_model_from()
-            if file_to_load_params_from is not None: # Load params
-                self._log.print3("=========== Loading parameters from specified saved model ===============")
-                chkpt_fname = tf.train.latest_checkpoint(file_to_load_params_from) if os.path.isdir(file_to_load_params_from) else file_to_load_params_from
-                self._log.print3("Loading parameters from:" + str(chkpt_fname))
-                try:
-                    saver_net.restore(sessionTf, chkpt_fname)
-                    # TF2: ckpt_net.restore(chkpt_fname)
-                    self._log.print3("Parameters were loaded.")
-                except Exception as e: handle_exception_tf_restore(self._log, e)
+            if frozen_graph_path is not None:
+                pass  # Params are constants in the frozen graph.
+            elif file_to_load_params_from is not None: # Load params
+                load_net_params(self._log, sessionTf, saver_net, file_to_load_params_from)
                 
             else:
-                self._ask_user_if_test_with_random()  # Asks user whether to continue with randomly initialized model.
+                if autotune_mem_mb is None:  # Speed does not depend on the values of the parameters.
+                    self._ask_user_if_test_with_random()  # Asks user whether to continue with randomly initialized model.
                 self._log.print3("")
                 self._log.print3("=========== Initializing network variables  ===============")
                 tf.compat.v1.variables_initializer(var_list=coll_vars_net).run()
                 self._log.print3("Model variables were initialized.")
+            if frozen_graph_path is None:
+                cnn3d.refresh_bn_inference_stats(sessionTf)  # From the loaded or initialized rolling averages.
                 
                 
+            if export_path is not None:
+                export_frozen_inference_graph(self._log, sessionTf, cnn3d, export_path)
+                return
+            
+            if autotune_mem_mb is not None:
+                try:
+                    (best_inp_dims,
+                     best_batchsize,
+                     best_vox_per_sec) = autotune_test_segm_and_batchsize(self._log, sessionTf, cnn3d,
+                                                                          inp_dims_hr_path, autotune_mem_mb)
+                except RuntimeError as e:
+                    self._log.print3("ERROR: Autotuning failed: " + str(e) + " Exiting."); exit(1)
+                write_autotuned_test_cfg(self._log, self.get_abs_path_to_cfg(),
+                                         {self._cfg.SEG_DIM_INFER: [int(dim) for dim in best_inp_dims],
+                                          self._cfg.BATCHSIZE: int(best_batchsize)},
+                                         best_vox_per_sec)
+                return
+            
+            if serve_port is not None:
+                serve_segmentation(self._log, sessionTf, cnn3d, inp_shapes_per_path, serve_port, self._out_folder_preds,
+                                   {"segm": self._params.save_segms, "prob": self._params.save_probs_per_cl},
+                                   self._params.suffixes_for_outp,
+                                   self._params.batchsize, self._params.run_input_checks, self._params.pad_input,
+                                   self._params.norm_prms, self._params.infer_prms)
+                return
+            
             self._log.print3("")
             self._log.print3("======================================================")
             self._log.print3("=========== Testing with the CNN model ===============")
             self._log.print3("======================================================")
             
+            if self._params.use_xla and not self._params.infer_prms['slabs']:
+                warmup_compiled_test_op(self._log, sessionTf, cnn3d, inp_shapes_per_path, self._params.batchsize)
             res_code = inference_on_whole_volumes(*([sessionTf, cnn3d] +
                                                     self._params.get_args_for_testing() +
-                                                    [inp_shapes_per_path]))
+                                                    [inp_shapes_per_path, self._params.infer_prms]))
+        
+        self._log.print3("")
+        self._log.print3("======================================================")
+        self._log.print3("=========== Testing session finished =================")
+        self._log.print3("======================================================")
+
+        
+    def _run_session_in_workers(self, sess_device, model_params, inp_dims_hr_path, dynamic_dims, frozen_graph_path):
+        # Data-parallel inference. Subjects are sharded over processes, each with its own graph and TF session.
+        # Intra-op parallelism of small 3D convs saturates well before many cores. Many small sessions scale better.
+        # Predictions are saved by the workers in the usual folders. Metrics are merged and reported here.
+        n_workers = self._params.n_workers
+        n_threads = self._params.n_threads_per_worker
+        file_to_load_params_from = self._params.get_path_to_load_model_from()
+        if file_to_load_params_from is None and frozen_graph_path is None:
+            self._log.print3("ERROR: Inference with multiple workers requires a saved model to load. " +
+                             "Otherwise each worker would initialize the model differently. Exiting."); exit(1)
+        
+        cores_per_worker = [None] * n_workers
+        if self._params.pin_workers_to_cores:
+            if not hasattr(os, 'sched_setaffinity'):
+                self._log.print3("WARN: Pinning workers to cpu-cores is not supported on this platform. Skipping.")
+            else:
+                cores_avail = sorted(os.sched_getaffinity(0))
+                cores_per_worker = [[cores_avail[(worker_i * n_threads + t) % len(cores_avail)] for t in range(n_threads)]
+                                    for worker_i in range(n_workers)]
+        
+        self._log.print3("")
+        self._log.print3("======================================================")
+        self._log.print3("====== Testing with the CNN model in " + str(n_workers) + " workers ======")
+        self._log.print3("======================================================")
+        
+        # Round robin, so that each worker gets subjects from all parts of the list.
+        subjs_idxs_per_worker = [list(range(self._params.n_cases))[worker_i::n_workers] for worker_i in range(n_workers)]
+        mp_pool = multiprocessing.get_context('spawn').Pool(processes=n_workers)  # Not fork. TF is not fork-safe.
+        try:
+            jobs = []
+            for worker_i in range(n_workers):
+                log_filepath = self._out_folder_logs + "/" + self._session_name + ".worker" + str(worker_i) + ".txt"
+                self._log.print3("Worker #" + str(worker_i) + " segments subjects with indices " +
+                                 str(subjs_idxs_per_worker[worker_i]) + ". Its log: " + log_filepath)
+                args_for_worker = [worker_i, log_filepath, sess_device, model_params, file_to_load_params_from,
+                                   frozen_graph_path, inp_dims_hr_path, dynamic_dims, self._params.inds_fms_per_pathtype_per_layer_to_save,
+                                   n_threads, cores_per_worker[worker_i],
+                                   self._params.get_args_for_testing(subjs_idxs_per_worker[worker_i]),
+                                   self._params.infer_prms, self._params.use_xla, self._params.precision_policy,
+                                   self._params.xla_time_uncompiled]
+                jobs.append(mp_pool.apply_async(run_inference_worker, args_for_worker))
+            metrics_per_worker = [job.get() for job in jobs]
+        except (Exception, KeyboardInterrupt) as e:
+            self._log.print3("Terminating worker processes.")
+            mp_pool.terminate()
+            mp_pool.join()  # Will wait. A KeybInt will kill this (py3)
+            raise e
+        else:
+            mp_pool.close()
+            mp_pool.join()
+        
+        if self._params.gt_fpaths is not None:  # GT was given. Merge the metrics of the workers and report.
+            NA_PATTERN = AccuracyMonitorForEpSegm.NA_PATTERN
+            metrics_per_subj_per_c = {key: [None] * self._params.n_cases for key in metrics_per_worker[0]}
+            for worker_i in range(n_workers):
+                for idx_in_worker, subj_i in enumerate(subjs_idxs_per_worker[worker_i]):
+                    for key in metrics_per_subj_per_c:
+                        metrics_per_subj_per_c[key][subj_i] = metrics_per_worker[worker_i][key][idx_in_worker]
+            for subj_i in range(self._params.n_cases):
+                report_metrics_for_subject(self._log, metrics_per_subj_per_c, subj_i, NA_PATTERN, "Testing")
+            mean_metrics = calc_stats_of_metrics(metrics_per_subj_per_c, NA_PATTERN)
+            report_mean_metrics(self._log, mean_metrics, NA_PATTERN, "Testing")
         
         self._log.print3("")
         self._log.print3("======================================================")
@@ -16,8 +16,10 @@ from deepmedic.frontEnd.sessHelpers import make_folders_for_train_session, handl
 from deepmedic.logging.utils import datetime_now_str
 from deepmedic.neuralnet.cnn3d import Cnn3d
 from deepmedic.neuralnet.trainer import Trainer
+from deepmedic.neuralnet.ops import xla_jit_scope
 
 from deepmedic.routines.training import do_training
+from deepmedic.routines.testing import warmup_compiled_test_op
 
 from deepmedic.logging.tensorboard_logger import TensorboardLogger
 
@@ -106,21 +108,43 @@ class TrainSession(Session):
                 with tf.compat.v1.variable_scope("net"):
                     cnn3d.make_cnn_model(*model_params.get_args_for_arch())
                     # I have now created the CNN graph. But not yet the Optimizer's graph.
-                    inp_plchldrs_train, inp_shapes_per_path_train = cnn3d.create_inp_plchldrs(model_params.get_inp_dims_hr_path('train'), 'train')
-                    inp_plchldrs_val, inp_shapes_per_path_val = cnn3d.create_inp_plchldrs(model_params.get_inp_dims_hr_path('val'), 'val')
-                    inp_plchldrs_test, inp_shapes_per_path_test = cnn3d.create_inp_plchldrs(model_params.get_inp_dims_hr_path('test'), 'test')
-                    p_y_given_x_train  = cnn3d.apply(inp_plchldrs_train, 'train', 'train', verbose=True, log=self._log)
-                    p_y_given_x_val    = cnn3d.apply(inp_plchldrs_val, 'infer', 'val', verbose=True, log=self._log)
-                    p_y_given_x_test   = cnn3d.apply(inp_plchldrs_test, 'infer', 'test', verbose=True, log=self._log)
+                    # Training and validation on samples read batches from input pipelines.
+                    inp_pipeline_train, inp_shapes_per_path_train = cnn3d.create_inp_pipeline(model_params.get_inp_dims_hr_path('train'), 'train')
+                    inp_pipeline_val, inp_shapes_per_path_val = cnn3d.create_inp_pipeline(model_params.get_inp_dims_hr_path('val'), 'val')
+                    # Validation on samples and on whole volumes share one inference graph, with dynamic spatial dims.
+                    # Its placeholders give the batches of the validation pipeline, unless fed (with whole volumes).
+                    inp_plchldrs_infer, _ = cnn3d.create_inp_plchldrs(model_params.get_inp_dims_hr_path('val'), 'infer',
+                                                                      dynamic_dims=True, default_inps=inp_pipeline_val['batch'])
+                    inp_shapes_per_path_test = cnn3d.calc_inp_dims_of_paths_from_hr_inp(model_params.get_inp_dims_hr_path('test'))
+                    # For debugging, if compiled, also uncompiled, to time it against. It doubles the inference graph.
+                    # Made first, as apply() keeps the last outputs (FMs).
+                    p_y_given_x_infer_uncompiled = None
+                    if self._params.use_xla and self._params.xla_time_uncompiled:
+                        p_y_given_x_infer_uncompiled = cnn3d.apply(inp_plchldrs_infer, 'infer', 'test', verbose=False,
+                                                                   log=self._log,
+                                                                   precision_policy=self._params.precision_policy)
+                    with xla_jit_scope(self._params.use_xla):
+                        p_y_given_x_infer = cnn3d.apply(inp_plchldrs_infer, 'infer', 'test', verbose=True, log=self._log,
+                                                        precision_policy=self._params.precision_policy)
                     
             # No explicit device assignment for the rest.
             # Because trained has piecewise_constant that is only on cpu, and so is saver.
             with tf.compat.v1.variable_scope("trainer"):
                 self._log.print3("=========== Building Trainer ===========\n")
                 trainer = Trainer(*(self._params.get_args_for_trainer() + [cnn3d]))
-                trainer.compute_costs(self._log, p_y_given_x_train)
                 trainer.create_optimizer(*self._params.get_args_for_optimizer())  # Trainer and net connect here.
 
+            def make_train_step(batch):
+                # Built once, or within the loop of steps of a session run (see cnn3d.setup_ops_n_feeds_to_train).
+                # If compiled with XLA, it is compiled at its first run, as running it to warm up would train.
+                with xla_jit_scope(self._params.use_xla):
+                    with tf.device(sess_device):
+                        (p_y_given_x_train, logits_train) = cnn3d.apply(batch, 'train', 'train', verbose=True,
+                                                                        log=self._log, ret_logits=True,
+                                                                        precision_policy=self._params.precision_policy)
+                    trainer.compute_costs(self._log, p_y_given_x_train, logits_train, batch['y_gt'])
+                return p_y_given_x_train, trainer.get_total_cost(), trainer.get_param_updates_wrt_total_cost()
+
             tensorboard_loggers = self.create_tensorboard_loggers(['train', 'val'],
                                                                   graphTf,
                                                                   create_log=self._params.get_tensorboard_bool())
@@ -129,18 +153,17 @@ class TrainSession(Session):
             self._log.print3("=========== Compiling the Training Function ===========")
             self._log.print3("=======================================================\n")
             cnn3d.setup_ops_n_feeds_to_train(self._log,
-                                             inp_plchldrs_train,
-                                             p_y_given_x_train,
-                                             trainer.get_total_cost(),
-                                             trainer.get_param_updates_wrt_total_cost()  # list of ops
-                                             )
+                                             inp_pipeline_train,
+                                             make_train_step,
+                                             self._params.n_steps_per_run_train)
 
             self._log.print3("=========== Compiling the Validation Function =========")
-            cnn3d.setup_ops_n_feeds_to_val(self._log, inp_plchldrs_val, p_y_given_x_val)
+            cnn3d.setup_ops_n_feeds_to_val(self._log, inp_pipeline_val, p_y_given_x_infer)
 
             self._log.print3("=========== Compiling the Testing Function ============")
-            # For validation with full segmentation
-            cnn3d.setup_ops_n_feeds_to_test(self._log, inp_plchldrs_test, p_y_given_x_test, self._params.inds_fms_per_pathtype_per_layer_to_save)
+            # For validation with full segmentation. Same inference graph as above.
+            cnn3d.setup_ops_n_feeds_to_test(self._log, inp_plchldrs_infer, p_y_given_x_infer, self._params.inds_fms_per_pathtype_per_layer_to_save,
+                                            p_y_given_x_infer_uncompiled)
 
             # Create the savers
             saver_all = tf.compat.v1.train.Saver(max_to_keep=999)  # Will be used during training for saving everything.
@@ -149,6 +172,9 @@ class TrainSession(Session):
             saver_net = tf.compat.v1.train.Saver(var_list=coll_vars_net)  # Used to load the net's parameters.
             coll_vars_trainer = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.GLOBAL_VARIABLES, scope="trainer")
             saver_trainer = tf.compat.v1.train.Saver(var_list=coll_vars_trainer)  # to load the trainer's params
+            # Not saved. Eg the index of each BN layer in its rolling-average matrices. Initialized in every session.
+            coll_vars_net_local = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.LOCAL_VARIABLES, scope="net")
+            coll_vars_trainer_local = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.LOCAL_VARIABLES, scope="trainer")
             
             # TF2: dict_vars_net = {'net_var'+str(i): v for i, v in enumerate(coll_vars_net)}
             # TF2: dict_vars_trainer = {'trainer_var'+str(i): v for i, v in enumerate(coll_vars_trainer)}
@@ -209,6 +235,17 @@ class TrainSession(Session):
                 # tf.train.write_graph(graph_or_graph_def=sessionTf.graph.as_graph_def(),
                 #                      logdir="", name=filename_to_save_with+".graph.pb", as_text=False)
 
+            tf.compat.v1.variables_initializer(var_list=coll_vars_net_local).run()
+            tf.compat.v1.variables_initializer(var_list=coll_vars_trainer_local).run()
+            cnn3d.refresh_bn_inference_stats(sessionTf)  # From the loaded or initialized rolling averages.
+            if self._params.use_xla:  # Compile the inference graph for the shapes of validation.
+                if self._params.val_on_samples_during_train:
+                    warmup_compiled_test_op(self._log, sessionTf, cnn3d, inp_shapes_per_path_val,
+                                            self._params.batchsize_val_samples)
+                if self._params.val_on_whole_volumes:
+                    warmup_compiled_test_op(self._log, sessionTf, cnn3d, inp_shapes_per_path_test,
+                                            self._params.batchsize_val_whole)
+
             self._log.print3("")
             self._log.print3("=======================================================")
             self._log.print3("============== Training the CNN model =================")
@@ -93,5 +93,5 @@ def print_progress_step_tr_val(log, n_batches, n_batches_done, batch_size, prefi
 def print_progress_step_test(log, n_batches, n_batches_done, batch_size, n_tiles_for_subj):
     progress_step = max(1, n_batches // 5)
     if n_batches_done == 0 or (n_batches_done % progress_step) == 0 or (n_batches_done == n_batches):
-        log.print3("Processed " + str(n_batches_done * batch_size) + "/" + str(n_tiles_for_subj) + " segments.")
+        log.print3("Processed " + str(min(n_batches_done * batch_size, n_tiles_for_subj)) + "/" + str(n_tiles_for_subj) + " segments.")
         
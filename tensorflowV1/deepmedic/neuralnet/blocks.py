@@ -12,6 +12,7 @@ import random
 import tensorflow as tf
 
 import deepmedic.neuralnet.layers as dm_layers
+import deepmedic.neuralnet.ops as ops
 
 #################################################################
 #                         Block Types                           #
@@ -21,6 +22,8 @@ import deepmedic.neuralnet.layers as dm_layers
 # Anything that adds new trainable parameters is a layer, added to the block/sequence.
 # Inheritance:
 # Block -> ConvBlock -> LowRankConvBlock
+#                L-----> DepthwiseSeparableConvBlock
+#                L-----> GroupedConvBlock
 #                L-----> ConvBlockWithSoftmax
 #        L-----> SoftmaxBlock (could be changed to layer)
 
@@ -68,9 +71,13 @@ class Block(object):
         return self._n_fms_in
     def get_n_fms_out(self):
         return self._n_fms_out
+    def get_layers(self):
+        return self._layers
     
     def fm_activations(self, indices_of_fms_in_layer_to_visualise_from_to_exclusive) :
-        return self.output["test"][:, indices_of_fms_in_layer_to_visualise_from_to_exclusive[0] : indices_of_fms_in_layer_to_visualise_from_to_exclusive[1], :, :, :]
+        # Fetched, so returned channels-first [batch, fms, r, c, z], as the inputs and outputs of the net.
+        fms = self.output["test"][:, :, :, :, indices_of_fms_in_layer_to_visualise_from_to_exclusive[0] : indices_of_fms_in_layer_to_visualise_from_to_exclusive[1]]
+        return ops.to_channels_first(tf.cast(fms, "float32")) # In case of mixed precision.
         
     # Main functionality
     def apply(self, input, mode):
@@ -100,13 +107,11 @@ class Block(object):
             total_params += block.params_for_L1_L2_reg()
         return total_params
     
-    def update_arrays_of_bn_moving_avg(self, sessionTf):
-        # This function should be erazed when I reimplement the Rolling average.
-        if self._bn_l is not None :
-            self._bn_l.update_arrays_of_bn_moving_avg(sessionTf)
-            
     def get_update_ops_for_bn_moving_avg(self) :
         return self._bn_l.get_update_ops_for_bn_moving_avg() if self._bn_l is not None else []
+    
+    def get_ops_refresh_bn_inference_stats(self) :
+        return [self._bn_l.get_op_refresh_inference_stats()] if self._bn_l is not None else []
 
 
 
@@ -126,6 +131,7 @@ class ConvBlock(Block):
               conv_pad_mode,
               use_bn,
               moving_avg_length, #If this is <= 0, we are not using BatchNormalization, even if above is True.
+              use_fused_bn=False,
               activ_func="relu",
               dropout_rate=0.0):
         """
@@ -145,7 +151,7 @@ class ConvBlock(Block):
         
         #------------------ Batch Normalization ------------------
         if use_bn and moving_avg_length > 0 :
-            self._bn_l = dm_layers.BatchNormLayer(moving_avg_length, n_channels=n_fms_in)
+            self._bn_l = dm_layers.BatchNormLayer(moving_avg_length, n_channels=n_fms_in, use_fused=use_fused_bn)
             self._layers.append(self._bn_l)
         else : #Not using batch normalization
             #make the bias terms and apply them. Like the old days before BN's own learnt bias terms.
@@ -185,6 +191,25 @@ class LowRankConvBlock(ConvBlock):
         return dm_layers.LowRankConvolutionalLayer(fms_in, fms_out, conv_kernel_dims, init_method, pad_mode, rng)
     
     
+# Ala Chollet, Xception: Deep Learning with Depthwise Separable Convolutions, CVPR 2017.
+class DepthwiseSeparableConvBlock(ConvBlock):
+    def __init__(self) :
+        ConvBlock.__init__(self)
+        
+    def _create_conv_layer(self, fms_in, fms_out, conv_kernel_dims, init_method, pad_mode, rng):
+        return dm_layers.DepthwiseSeparableConvolutionalLayer(fms_in, fms_out, conv_kernel_dims, init_method, pad_mode, rng)
+    
+    
+# Ala Xie et al, Aggregated Residual Transformations for Deep Neural Networks (ResNeXt), CVPR 2017.
+class GroupedConvBlock(ConvBlock):
+    def __init__(self, n_groups=4) :
+        ConvBlock.__init__(self)
+        self._n_groups = n_groups # Must divide the number of input and output FMs.
+        
+    def _create_conv_layer(self, fms_in, fms_out, conv_kernel_dims, init_method, pad_mode, rng):
+        return dm_layers.GroupedConvolutionalLayer(fms_in, fms_out, conv_kernel_dims, init_method, pad_mode, rng, self._n_groups)
+    
+    
 class SoftmaxBlock(Block):
     """ Softmax for classification. Note, this is simply the softmax function, after adding bias. Not a ConvBlock """
     def __init__(self):
@@ -208,9 +233,16 @@ class SoftmaxBlock(Block):
         # At this last classification layer, the conv output needs to have bias added before the softmax.
         # NOTE: So, two biases are associated with this layer. self.b which is added in the ouput of the previous layer's output of conv,
         # and this self._bClassLayer that is added only to this final output before the softmax.       
-        logits = self._bias_l.apply(input, mode)
-        p_y_given_x = tf.nn.softmax(logits/self._temperature, axis=1)
-        return p_y_given_x
+        # input: [batch, r, c, z, classes]. Returns channels-last too.
+        # Returns: p_y_given_x, and the logits it is the softmax of (after temperature). Costs can use the logits directly.
+        # Softmax and costs are always in float32, even if the net computes in bfloat16 (mixed precision).
+        logits = self._bias_l.apply(tf.cast(input, "float32"), mode)
+        logits = logits/self._temperature if self._temperature != 1 else logits
+        p_y_given_x = tf.nn.softmax(logits, axis=-1)
+        return p_y_given_x, logits
+    
+    def get_temperature(self):
+        return self._temperature
         
         
     def get_rp_rn_tp_tn(self, p_y_given_x, y_gt):
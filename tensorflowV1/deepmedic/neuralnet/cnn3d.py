@@ -18,6 +18,11 @@ from deepmedic.neuralnet.blocks import SoftmaxBlock
 import deepmedic.neuralnet.ops as ops
 
 
+# Precision policies: The dtype of activations and computations of the net, per policy. Variables (master weights),
+# statistics of BN, the softmax and the costs are float32 in all policies.
+COMPUTE_DTYPE_PER_PRECISION_POLICY = {"float32": "float32", "mixed_bfloat16": "bfloat16"}
+
+
 ##################################################
 ##################################################
 ################ THE CNN CLASS ###################
@@ -37,7 +42,7 @@ class Cnn3d(object):
         self.num_classes = None
         
         #======= Output tensors Y_GT ========
-        # For each targetLayer, I should be placing a y_gt placeholder/feed.
+        # For each targetLayer, I should be placing a y_gt tensor. Batches of labels from the input pipelines.
         self._output_gt_tensor_feeds = {'train': {},
                                         'val': {}}
         
@@ -68,17 +73,19 @@ class Cnn3d(object):
     
 
         
-    # for inference with batch-normalization.
-    # Every training batch, this is called to update an internal matrix of each layer, with the last mus and vars,
-    # so that I can compute the rolling average for inference.
-    def update_arrays_of_bn_moving_avg(self, sessionTf):
+    def refresh_bn_inference_stats(self, sessionTf):
+        # BN layers cache the mu and var for inference, from the arrays of the rolling average. Refresh them all.
+        # Must be called after the arrays change: After loading or initializing the model, and after training batches.
+        ops_refresh = []
         for pathway in self.pathways :
             for block in pathway.get_blocks() :
-                block.update_arrays_of_bn_moving_avg(sessionTf)  # Will do nothing if no BN.
+                ops_refresh.extend(block.get_ops_refresh_bn_inference_stats())
+        if len(ops_refresh) > 0:
+            sessionTf.run(fetches=ops_refresh)
                     
     def _get_update_ops_for_bn_moving_avg(self) :
-        # These are not the variables of the normalization of the FMs' distributions that are optimized during training. These are only the Mu and Stds that are used during inference,
-        # ... and here we update the sharedVariable which is used "from the outside during do_training()" to update the rolling-average-matrix for inference. Do for all layers.
+        # These are not the variables of the normalization of the FMs' distributions that are optimized during training. These are only the Mu and Stds that are used during inference.
+        # For all layers, write mu and var of the batch in the rolling-average matrices for inference. Grouped with the training step.
         updatesForBnRollingAverage = []
         for pathway in self.pathways :
             for block in pathway.get_blocks() :
@@ -111,49 +118,101 @@ class Cnn3d(object):
         return self._feeds_main[str_train_val_test]
     
     
-    def setup_ops_n_feeds_to_train(self, log, inp_plchldrs, p_y_given_x, total_cost, updates_of_params_wrt_total_cost) :
+    def setup_ops_n_feeds_to_train(self, log, inp_pipeline, make_train_step, n_steps_per_run=1) :
+        # inp_pipeline: As returned from create_inp_pipeline().
+        # make_train_step: Function that applies the net on a batch of the pipeline and computes the cost.
+        #                  Returns: p_y_given_x, total cost, list of ops that update the params wrt the cost.
+        # n_steps_per_run: If > 1, a run of the training ops performs that many steps, in a tf.while_loop in the graph.
+        #                  Saves the overhead of a session run per batch. Fewer steps can be fed to feeds['n_steps'].
         log.print3("...Building the training function...")
         
-        y_gt = self._output_gt_tensor_feeds['train']['y_gt']
+        (arr_rp_rn_tp_tn_subep, op_reset_rp_rn_tp_tn) = self._make_accumulator_of_rp_rn_tp_tn('train')
         
-        #================BATCH NORMALIZATION ROLLING AVERAGE UPDATES======================
-        updates = updates_of_params_wrt_total_cost + self._get_update_ops_for_bn_moving_avg()
-        updates_grouped_op = tf.group( *updates ) # this op returns no output when run.
+        def train_step(batch):
+            # Returns: cost, list of all updates of the step.
+            (p_y_given_x, total_cost, updates_of_params_wrt_total_cost) = make_train_step(batch)
+            
+            #================ ACCUMULATION OF RP/RN/TP/TN OF THE SUBEPOCH ======================
+            list_rp_rn_tp_tn = self.finalTargetLayer.get_rp_rn_tp_tn(p_y_given_x, batch['y_gt'])
+            op_acc_rp_rn_tp_tn = self._make_op_acc_rp_rn_tp_tn(arr_rp_rn_tp_tn_subep, list_rp_rn_tp_tn)
+            
+            #================BATCH NORMALIZATION ROLLING AVERAGE UPDATES======================
+            updates = updates_of_params_wrt_total_cost + self._get_update_ops_for_bn_moving_avg() + [op_acc_rp_rn_tp_tn]
+            return total_cost, updates
+        
+        if n_steps_per_run == 1:
+            (cost, updates) = train_step(inp_pipeline['batch'])
+            updates_grouped_op = tf.group( *updates ) # this op returns no output when run.
+        else:
+            # Every iteration reads the next batch from the pipeline and does a step, after the step of previous iteration.
+            n_steps = tf.compat.v1.placeholder_with_default(np.int32(n_steps_per_run), shape=[], name="n_steps_per_run")
+            def loop_body(step_i, sum_costs):
+                (cost_step, updates) = train_step(inp_pipeline['iterator'].get_next())
+                with tf.control_dependencies(updates):
+                    return step_i + 1, sum_costs + cost_step
+            (n_steps_done, sum_costs) = tf.while_loop(lambda step_i, sum_costs: step_i < n_steps, loop_body,
+                                                      [tf.constant(0), tf.constant(0., dtype="float32")],
+                                                      parallel_iterations=1)
+            cost = sum_costs / tf.cast(n_steps_done, "float32") # Mean over the steps of the run.
+            updates_grouped_op = tf.group( n_steps_done ) # Runs the loop. Updates are within it.
+            inp_pipeline['feeds']['n_steps'] = n_steps
         
         #======================== Collecting ops and feeds =================
         log.print3("...Collecting ops and feeds for training...")
         
-        self._ops_main['train']['cost'] = total_cost
-        self._ops_main['train']['list_rp_rn_tp_tn'] = self.finalTargetLayer.get_rp_rn_tp_tn(p_y_given_x, y_gt)
+        self._ops_main['train']['cost'] = cost
+        self._ops_main['train']['arr_rp_rn_tp_tn_subep'] = arr_rp_rn_tp_tn_subep
+        self._ops_main['train']['reset_rp_rn_tp_tn_subep'] = op_reset_rp_rn_tp_tn
         self._ops_main['train']['updates_grouped_op'] = updates_grouped_op
+        self._ops_main['train']['init_inp_pipeline'] = inp_pipeline['init']
         
-        self._feeds_main['train']['x'] = inp_plchldrs['x']
-        for subpath_i in range(self.numSubsPaths) : # if there are subsampled paths...
-            self._feeds_main['train']['x_sub_'+str(subpath_i)] = inp_plchldrs['x_sub_'+str(subpath_i)]
-        self._feeds_main['train']['y_gt'] = y_gt
+        # Feeds are the samples of a whole subepoch, given to the input pipeline when initializing it.
+        self._feeds_main['train'] = inp_pipeline['feeds']
         
         log.print3("Done.")
         
-    def setup_ops_n_feeds_to_val(self, log, inp_plchldrs, p_y_given_x):
+    def _make_accumulator_of_rp_rn_tp_tn(self, train_val_test):
+        # Sums the real pos, real neg, true pred pos, true pred neg of batches in the graph. Fetched once per subepoch.
+        # Local variable, so not saved. Reset at the start of every subepoch.
+        # It is not in the scopes ("net", "trainer") whose local variables the session initializes. So the reset...
+        # ... is its initializer, which sets it to zeros, and it is initialized before the first subepoch uses it.
+        # Returns: variable [num_classes, 4], with rows of rp,rn,tp,tn per class. Op that resets it.
+        arr_rp_rn_tp_tn_subep = tf.compat.v1.Variable( np.zeros([self.num_classes, 4], dtype="int32"), trainable=False,
+                                                      collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES],
+                                                      name="accRpRnTpTn_" + train_val_test )
+        op_reset = arr_rp_rn_tp_tn_subep.initializer
+        return arr_rp_rn_tp_tn_subep, op_reset
+    
+    def _make_op_acc_rp_rn_tp_tn(self, arr_rp_rn_tp_tn_subep, list_rp_rn_tp_tn):
+        # Op that adds the rp,rn,tp,tn of a batch to the accumulator.
+        return tf.compat.v1.assign_add( arr_rp_rn_tp_tn_subep, tf.reshape(tf.stack(list_rp_rn_tp_tn), [self.num_classes, 4]) )
+    
+    def setup_ops_n_feeds_to_val(self, log, inp_pipeline, p_y_given_x):
+        # inp_pipeline: As returned from create_inp_pipeline(). The net was applied on its batches.
         log.print3("...Building the validation function...")
         
-        y_gt = self._output_gt_tensor_feeds['val']['y_gt']
+        y_gt = inp_pipeline['batch']['y_gt']
         
         log.print3("...Collecting ops and feeds for validation...")
         
+        list_rp_rn_tp_tn = self.finalTargetLayer.get_rp_rn_tp_tn(p_y_given_x, y_gt)
+        (arr_rp_rn_tp_tn_subep, op_reset_rp_rn_tp_tn) = self._make_accumulator_of_rp_rn_tp_tn('val')
+        op_acc_rp_rn_tp_tn = self._make_op_acc_rp_rn_tp_tn(arr_rp_rn_tp_tn_subep, list_rp_rn_tp_tn)
+        
         self._ops_main['val'] = {}
-        self._ops_main['val']['list_rp_rn_tp_tn'] = self.finalTargetLayer.get_rp_rn_tp_tn(p_y_given_x, y_gt)
+        self._ops_main['val']['acc_rp_rn_tp_tn'] = op_acc_rp_rn_tp_tn # The validation step.
+        self._ops_main['val']['arr_rp_rn_tp_tn_subep'] = arr_rp_rn_tp_tn_subep
+        self._ops_main['val']['reset_rp_rn_tp_tn_subep'] = op_reset_rp_rn_tp_tn
+        self._ops_main['val']['init_inp_pipeline'] = inp_pipeline['init']
         
-        self._feeds_main['val'] = {}
-        self._feeds_main['val']['x'] = inp_plchldrs['x']
-        for subpath_i in range(self.numSubsPaths) : # if there are subsampled paths...
-            self._feeds_main['val']['x_sub_'+str(subpath_i)] = inp_plchldrs['x_sub_'+str(subpath_i)]
-        self._feeds_main['val']['y_gt'] = y_gt
+        self._feeds_main['val'] = inp_pipeline['feeds']
         
         log.print3("Done.")
         
         
-    def setup_ops_n_feeds_to_test(self, log, inp_plchldrs, p_y_given_x, indices_fms_per_pathtype_per_layer_to_save=None) :
+    def setup_ops_n_feeds_to_test(self, log, inp_plchldrs, p_y_given_x, indices_fms_per_pathtype_per_layer_to_save=None,
+                                  p_y_given_x_uncompiled=None) :
+        # p_y_given_x_uncompiled: For debugging. If p_y_given_x is compiled by XLA, the same forward pass not compiled. Only for timing.
         log.print3("...Building the function for testing and visualisation of FMs...")
         
         listToReturnWithAllTheFmActivationsPerLayer = []
@@ -172,6 +231,7 @@ class Cnn3d(object):
         self._ops_main['test'] = {}
         self._ops_main['test']['list_of_fms_per_layer'] = listToReturnWithAllTheFmActivationsPerLayer
         self._ops_main['test']['pred_probs'] = p_y_given_x
+        self._ops_main['test']['pred_probs_uncompiled'] = p_y_given_x_uncompiled
         
         self._feeds_main['test'] = {}
         self._feeds_main['test']['x'] = inp_plchldrs['x']
@@ -181,17 +241,47 @@ class Cnn3d(object):
         log.print3("Done.")
         
         
-    def create_inp_plchldrs(self, inp_dims, train_val_test): # TODO: Remove for eager
+    def create_inp_plchldrs(self, inp_dims, train_val_test, dynamic_dims=False, default_inps=None): # TODO: Remove for eager
+            # dynamic_dims: If True, spatial dims of placeholders are left unknown (None), so that the graph can be fed
+            #               segments of any size (eg whole-volume slabs). inp_shapes_per_path still refer to inp_dims.
+            # default_inps: Optional dict of tensors (x, x_sub_i), eg batches of an input pipeline. Given by the
+            #               placeholders when they are not fed.
             inp_shapes_per_path = self.calc_inp_dims_of_paths_from_hr_inp(inp_dims)
-            return self._setup_inp_plchldrs(train_val_test, inp_shapes_per_path), inp_shapes_per_path
+            plchldr_shapes_per_path = [[None, None, None]] * len(inp_shapes_per_path) if dynamic_dims else inp_shapes_per_path
+            return self._setup_inp_plchldrs(train_val_test, plchldr_shapes_per_path, default_inps), inp_shapes_per_path
     
-    def _setup_inp_plchldrs(self, train_val_test, inp_shapes_per_path): # TODO: REMOVE for eager
-        assert train_val_test in ['train', 'val', 'test']
+    def _setup_inp_plchldrs(self, train_val_test, inp_shapes_per_path, default_inps=None): # TODO: REMOVE for eager
+        assert train_val_test in ['train', 'val', 'test', 'infer'] # 'infer': Shared by val and test.
         inp_plchldrs = {}
-        inp_plchldrs['x'] = tf.compat.v1.placeholder(dtype="float32", shape=[None, self.pathways[0].get_n_fms_in()]+inp_shapes_per_path[0], name='inp_x_'+train_val_test)
-        for subpath_i in range(self.numSubsPaths): # if there are subsampled paths...
-            inp_plchldrs['x_sub_'+str(subpath_i)] = tf.compat.v1.placeholder(dtype="float32", shape=[None, self.pathways[0].get_n_fms_in()]+inp_shapes_per_path[subpath_i+1], name="inp_x_sub_"+str(subpath_i)+'_' + train_val_test)
+        keys = ['x'] + ['x_sub_'+str(subpath_i) for subpath_i in range(self.numSubsPaths)] # if there are subsampled paths...
+        for path_i in range(len(keys)):
+            shape = [None, self.pathways[0].get_n_fms_in()]+list(inp_shapes_per_path[path_i])
+            name = 'inp_'+keys[path_i]+'_'+train_val_test
+            if default_inps is None:
+                inp_plchldrs[keys[path_i]] = tf.compat.v1.placeholder(dtype="float32", shape=shape, name=name)
+            else:
+                inp_plchldrs[keys[path_i]] = tf.compat.v1.placeholder_with_default(default_inps[keys[path_i]], shape=shape, name=name)
         return inp_plchldrs
+    
+    def create_inp_pipeline(self, inp_dims, train_val_test):
+        # Input pipeline (tf.data) over the samples of a subepoch, so that batches are not fed one by one via feed_dict.
+        # The samples are fed once per subepoch, when initializing the pipeline. Every step then reads a batch from its
+        # iterator. Batches are prefetched, so that the next one is staged while the current step runs.
+        # Returns: inp_pipeline: dict with 'feeds': Placeholders for the samples of the subepoch (x, x_sub_i, y_gt) and batchsize.
+        #                                  'init': Op that initializes the pipeline. Run with the feeds.
+        #                                  'batch': Tensors of the next batch (x, x_sub_i, y_gt).
+        #                                  'iterator': To get more batches within one session run (see setup_ops_n_feeds_to_train).
+        #          inp_shapes_per_path: As create_inp_plchldrs().
+        with tf.device("/cpu:0"): # Pipelines run on cpu, whatever the device of the net.
+            feeds, inp_shapes_per_path = self.create_inp_plchldrs(inp_dims, train_val_test)
+            feeds['y_gt'] = tf.compat.v1.placeholder(dtype="int32", shape=[None, None, None, None], name="y_" + train_val_test)
+            feeds['batchsize'] = tf.compat.v1.placeholder(dtype="int64", shape=[], name="batchsize_" + train_val_test)
+            samples = {key: feeds[key] for key in feeds if key != 'batchsize'}
+            dataset = tf.data.Dataset.from_tensor_slices(samples).batch(feeds['batchsize']).prefetch(1)
+            iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+            inp_pipeline = {'feeds': feeds, 'init': iterator.initializer, 'batch': iterator.get_next(), 'iterator': iterator}
+        self._output_gt_tensor_feeds[train_val_test]['y_gt'] = inp_pipeline['batch']['y_gt']
+        return inp_pipeline, inp_shapes_per_path
         
     def make_cnn_model( self,
                         log,
@@ -223,6 +313,10 @@ class Cnn3d(object):
                         #--Lower Rank Layer Per Pathway---
                         indicesOfLowerRankLayersPerPathway,
                         ranksOfLowerRankLayersForEachPathway,
+                        #--Depthwise Separable and Grouped Conv Layers Per Pathway---
+                        indicesOfDepthwiseSepLayersPerPathway,
+                        indicesOfGroupedLayersPerPathway,
+                        nGroupsOfGroupedLayersPerPathway,
                         #---Pooling---
                         maxPoolingParamsStructure,
                         
@@ -234,6 +328,7 @@ class Cnn3d(object):
                         # Batch Normalization
                         applyBnToInputOfPathways,  # one Boolean flag per pathway type. Placeholder for the FC pathway.
                         movingAvForBnOverXBatches,
+                        useFusedBn,
                         ):
         
         self.cnnModelName = cnnModelName
@@ -269,11 +364,15 @@ class Cnn3d(object):
                           thisPathwayConvPadModePerLayer,
                           thisPathwayUseBnPerLayer,
                           movingAvForBnOverXBatches,
+                          useFusedBn,
                           thisPathwayActivFuncPerLayer,
                           dropoutRatesForAllPathways[thisPathwayType],
                           maxPoolingParamsStructure[thisPathwayType],
                           indicesOfLowerRankLayersPerPathway[thisPathwayType],
                           ranksOfLowerRankLayersForEachPathway[thisPathwayType],
+                          indicesOfDepthwiseSepLayersPerPathway[thisPathwayType],
+                          indicesOfGroupedLayersPerPathway[thisPathwayType],
+                          nGroupsOfGroupedLayersPerPathway[thisPathwayType],
                           indicesOfLayersToConnectResidualsInOutput[thisPathwayType]
                           )
         
@@ -300,11 +399,15 @@ class Cnn3d(object):
                               thisPathwayConvPadModePerLayer,
                               thisPathwayUseBnPerLayer,
                               movingAvForBnOverXBatches,
+                              useFusedBn,
                               thisPathwayActivFuncPerLayer,
                               dropoutRatesForAllPathways[thisPathwayType],
                               maxPoolingParamsStructure[thisPathwayType],
                               indicesOfLowerRankLayersPerPathway[thisPathwayType],
                               ranksOfLowerRankLayersForEachPathway[thisPathwayType],
+                              indicesOfDepthwiseSepLayersPerPathway[thisPathwayType],
+                              indicesOfGroupedLayersPerPathway[thisPathwayType],
+                              nGroupsOfGroupedLayersPerPathway[thisPathwayType],
                               indicesOfLayersToConnectResidualsInOutput[thisPathwayType]
                               )
         
@@ -335,11 +438,15 @@ class Cnn3d(object):
                           thisPathwayConvPadModePerLayer,
                           thisPathwayUseBnPerLayer,
                           movingAvForBnOverXBatches,
+                          useFusedBn,
                           thisPathwayActivFuncPerLayer,
                           dropoutRatesForAllPathways[thisPathwayType],
                           maxPoolingParamsStructure[thisPathwayType],
                           indicesOfLowerRankLayersPerPathway[thisPathwayType],
                           ranksOfLowerRankLayersForEachPathway[thisPathwayType],
+                          indicesOfDepthwiseSepLayersPerPathway[thisPathwayType],
+                          indicesOfGroupedLayersPerPathway[thisPathwayType],
+                          nGroupsOfGroupedLayersPerPathway[thisPathwayType],
                           indicesOfLayersToConnectResidualsInOutput[thisPathwayType]
                           )
         
@@ -350,27 +457,31 @@ class Cnn3d(object):
         self.finalTargetLayer.build(rng, self.getFcPathway().get_n_fms_out(), softmaxTemperature)
         self.getFcPathway().get_block(-1).connect_target_block(self.finalTargetLayer)
         
-        # =============== BUILDING FINISHED - BELOW IS TEMPORARY ========================    
-        self._output_gt_tensor_feeds['train']['y_gt'] = tf.compat.v1.placeholder(dtype="int32", shape=[None, None, None, None], name="y_train")
-        self._output_gt_tensor_feeds['val']['y_gt'] = tf.compat.v1.placeholder(dtype="int32", shape=[None, None, None, None], name="y_val")
-        
         log.print3("Finished building the CNN's model.")
         
         
-    def apply(self, inputs_per_pathw, mode, train_val_test, verbose=True, log=None):
+    def apply(self, inputs_per_pathw, mode, train_val_test, verbose=True, log=None, ret_logits=False,
+              precision_policy="float32"):
         # Currently applies it on the placeholders. TODO: On actual input.
         # train_val_test: TEMPORARY. ONLY TO RETURN FMS. REMOVE IN END OF REFACTORING.
+        # ret_logits: If True, also returns the logits of the softmax, channels-last [batch, r, c, z, classes], for costs.
+        # precision_policy: Key of COMPUTE_DTYPE_PER_PRECISION_POLICY. Inputs are cast to its dtype. Outputs are float32.
+        compute_dtype = COMPUTE_DTYPE_PER_PRECISION_POLICY[precision_policy]
         #assert len(inputs_per_pathw) == len(self.pathways) - 1
         
+        # Inputs are fed channels-first [batch, chans, r, c, z]. Within the net, activations are channels-last
+        # [batch, r, c, z, chans], so that convs, BN etc need no transposes. Transpose only here, at input and output.
+        
         #===== Apply High-Res path =========
-        input = inputs_per_pathw['x']
+        input = ops.to_channels_last(tf.cast(inputs_per_pathw['x'], compute_dtype))
         out = self.pathways[0].apply(input, mode, train_val_test, verbose, log)
-        dims_outp_pathway_hr = out.shape
+        # Static dims if known. Otherwise (placeholders of dynamic dims) use the dims at runtime.
+        dims_outp_pathway_hr = out.shape if out.shape.is_fully_defined() else tf.shape(out)
         fms_from_paths_to_concat = [out]
         
         # === Subsampled pathways =========
         for subpath_i in range(self.numSubsPaths):
-            input = inputs_per_pathw['x_sub_'+str(subpath_i)]
+            input = ops.to_channels_last(tf.cast(inputs_per_pathw['x_sub_'+str(subpath_i)], compute_dtype))
             this_pathway = self.pathways[subpath_i+1]
             out_lr = this_pathway.apply(input, mode, train_val_test, verbose, log)
             # this creates essentially the "upsampling layer"
@@ -378,11 +489,14 @@ class Cnn3d(object):
             fms_from_paths_to_concat.append(out)
             
         # ===== Concatenate and final convs ========
-        conc_inp_fms = tf.concat(fms_from_paths_to_concat, axis=1)
+        conc_inp_fms = tf.concat(fms_from_paths_to_concat, axis=4)
         logits_no_bias = self.pathways[-1].apply(conc_inp_fms, mode, train_val_test, verbose, log)
         # Softmax
-        p_y_given_x = self.finalTargetLayer.apply(logits_no_bias, mode)
+        (p_y_given_x, logits) = self.finalTargetLayer.apply(logits_no_bias, mode)
+        p_y_given_x = ops.to_channels_first(p_y_given_x) # [batch, classes, r, c, z], for costs and fetching.
         
+        if ret_logits:
+            return p_y_given_x, logits
         return p_y_given_x
         
     def calc_inp_dims_of_paths_from_hr_inp(self, inp_hr_dims):
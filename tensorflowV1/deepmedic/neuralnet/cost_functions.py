@@ -10,22 +10,17 @@ from __future__ import absolute_import, print_function, division
 import tensorflow as tf
 
 
-def x_entr( p_y_given_x_train, y_gt, weightPerClass, eps=1e-6 ):
-    # p_y_given_x_train : tensor5 [batchSize, classes, r, c, z]
+def x_entr( logits_train, y_gt, weightPerClass ):
+    # logits_train : tensor5 [batchSize, r, c, z, classes]. Channels-last logits, that the softmax gives p_y_given_x of.
     # y: T.itensor4('y'). Dimensions [batchSize, r, c, z]
     # weightPerClass is a vector with 1 element per class.
+    # Fused log-softmax and pick of the true class' value per voxel, without one-hot or log of probabilities.
+    x_entr_per_voxel = tf.nn.sparse_softmax_cross_entropy_with_logits( labels=y_gt, logits=logits_train )
     
     #Weighting the cost of the different classes in the cost-function, in order to counter class imbalance.
-    log_p_y_given_x_train = tf.math.log( p_y_given_x_train + eps)
-    
-    weightPerClass5D = tf.reshape(weightPerClass, shape=[1, tf.shape(p_y_given_x_train)[1], 1, 1, 1])
-    weighted_log_p_y_given_x_train = log_p_y_given_x_train * weightPerClass5D
-    
-    y_one_hot = tf.one_hot( indices=y_gt, depth=tf.shape(p_y_given_x_train)[1], axis=1, dtype="float32" )
-    
-    num_samples = tf.cast( tf.reduce_prod( tf.shape(y_gt) ), "float32")
+    weight_per_voxel = tf.gather( weightPerClass, y_gt )
     
-    return - (1./ num_samples) * tf.reduce_sum( weighted_log_p_y_given_x_train * y_one_hot )
+    return tf.reduce_mean( weight_per_voxel * x_entr_per_voxel )
 
 
 def iou(p_y_given_x_train, y_gt, eps=1e-5):
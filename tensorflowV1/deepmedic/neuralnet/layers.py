@@ -63,7 +63,7 @@ class PoolingLayer(Layer):
         self._pool_mode = pool_mode
         
     def apply(self, input, _):
-        # input dimensions: (batch, fms, r, c, z)
+        # input dimensions: (batch, r, c, z, fms)
         return ops.pool_3d(input, self._window_size, self._strides, self._pad_mode, self._pool_mode)
         
     def trainable_params(self):
@@ -106,7 +106,11 @@ class ConvolutionalLayer(Layer):
         return std_init
     
     def apply(self, input, mode):
-        return ops.conv_3d(input, self._w, self._pad_mode)
+        return self.apply_with_weights(input, self.trainable_params())
+    
+    def apply_with_weights(self, input, ws):
+        # ws: List of weights to convolve with, in the order of trainable_params(). Eg constants of a frozen graph.
+        return ops.conv_3d(input, ws[0], self._pad_mode)
 
     def trainable_params(self):
         return [self._w]
@@ -114,6 +118,14 @@ class ConvolutionalLayer(Layer):
     def params_for_L1_L2_reg(self):
         return self.trainable_params()
     
+    def inds_of_ws_on_inp(self):
+        # Indices in trainable_params() of the weights convolving the input of the layer. Eg to fold a scale of the input.
+        return list(range(len(self.trainable_params())))
+    
+    def inds_of_ws_to_outp(self):
+        # Indices in trainable_params() of the weights whose outputs, concatenated, are the output of the layer.
+        return list(range(len(self.trainable_params())))
+    
     def _n_padding(self):
         # Returns [padx,pady,padz], how much pad would have been added to preserve dimensions ('SAME' or 'MIRROR').
         return [0,0,0] if self._pad_mode == 'VALID' else [self._w.shape.as_list()[2+d] - 1 for d in range(3)]
@@ -168,29 +180,30 @@ class LowRankConvolutionalLayer(ConvolutionalLayer):
     def params_for_L1_L2_reg(self):
         return self.trainable_params()
     
-    def apply(self, input, mode):
-        out_x = ops.conv_3d(input, self._w_x, self._pad_mode)
-        out_y = ops.conv_3d(input, self._w_y, self._pad_mode)
-        out_z = ops.conv_3d(input, self._w_z, self._pad_mode)
+    def apply_with_weights(self, input, ws):
+        out_x = ops.conv_3d(input, ws[0], self._pad_mode)
+        out_y = ops.conv_3d(input, ws[1], self._pad_mode)
+        out_z = ops.conv_3d(input, ws[2], self._pad_mode)
         # concatenate together.
         out = self._crop_sub_outputs_same_dims_and_concat(out_x, out_y, out_z)
         return out
         
     def _crop_sub_outputs_same_dims_and_concat(self, tens_x, tens_y, tens_z):
+        # tens_x, tens_y, tens_z: [batch, r, c, z, fms]
         assert (tens_x.shape[0] == tens_y.shape[0]) and (tens_y.shape[0] == tens_z.shape[0]) # batch-size
         conv_tens_shape = [tens_x.shape[0],
-                           tens_x.shape[1] + tens_y.shape[1] + tens_z.shape[1],
-                           tens_x.shape[2],
-                           tens_y.shape[3],
-                           tens_z.shape[4]
+                           tens_x.shape[1],
+                           tens_y.shape[2],
+                           tens_z.shape[3],
+                           tens_x.shape[4] + tens_y.shape[4] + tens_z.shape[4]
                            ]
-        x_crop_slice = slice( (self._conv_kernel_dims[0]-1)//2, (self._conv_kernel_dims[0]-1)//2 + conv_tens_shape[2] )
-        y_crop_slice = slice( (self._conv_kernel_dims[1]-1)//2, (self._conv_kernel_dims[1]-1)//2 + conv_tens_shape[3] )
-        z_crop_slice = slice( (self._conv_kernel_dims[2]-1)//2, (self._conv_kernel_dims[2]-1)//2 + conv_tens_shape[4] )
-        tens_x_crop = tens_x[:,:, :, y_crop_slice if self._rank == 1 else slice(0, MAX_INT), z_crop_slice  ]
-        tens_y_crop = tens_y[:,:, x_crop_slice, :, z_crop_slice if self._rank == 1 else slice(0, MAX_INT) ]
-        tens_z_crop = tens_z[:,:, x_crop_slice if self._rank == 1 else slice(0, MAX_INT), y_crop_slice, : ]
-        conc_tens = tf.concat([tens_x_crop, tens_y_crop, tens_z_crop], axis=1) #concatenate the FMs
+        x_crop_slice = slice( (self._conv_kernel_dims[0]-1)//2, (self._conv_kernel_dims[0]-1)//2 + conv_tens_shape[1] )
+        y_crop_slice = slice( (self._conv_kernel_dims[1]-1)//2, (self._conv_kernel_dims[1]-1)//2 + conv_tens_shape[2] )
+        z_crop_slice = slice( (self._conv_kernel_dims[2]-1)//2, (self._conv_kernel_dims[2]-1)//2 + conv_tens_shape[3] )
+        tens_x_crop = tens_x[:, :, y_crop_slice if self._rank == 1 else slice(0, MAX_INT), z_crop_slice, : ]
+        tens_y_crop = tens_y[:, x_crop_slice, :, z_crop_slice if self._rank == 1 else slice(0, MAX_INT), : ]
+        tens_z_crop = tens_z[:, x_crop_slice if self._rank == 1 else slice(0, MAX_INT), y_crop_slice, :, : ]
+        conc_tens = tf.concat([tens_x_crop, tens_y_crop, tens_z_crop], axis=4) #concatenate the FMs
         return conc_tens
     
     def _n_padding(self):
@@ -224,6 +237,54 @@ class LowRankConvolutionalLayer(ConvolutionalLayer):
                 (outp_dims[1]-1)*self._strides[1] + self._w_y.shape.as_list()[3] - padding[1],
                 (outp_dims[2]-1)*self._strides[2] + self._w_z.shape.as_list()[4] - padding[2]]
     
+class DepthwiseSeparableConvolutionalLayer(ConvolutionalLayer):
+    # Depthwise conv (a spatial kernel per input channel), followed by pointwise (1x1x1) conv that mixes the channels.
+    # Params and flops: fms_in*(x*y*z + fms_out) instead of fms_in*fms_out*x*y*z. Ala Chollet, Xception, CVPR 2017.
+    # self._w is the depthwise kernel, so padding, receptive field and dimensions are as of the parent.
+    def __init__(self, fms_in, fms_out, conv_kernel_dims, init_method, pad_mode, rng):
+        # No non-linearity in between. Depthwise preserves the variance, pointwise gets the gain of the init method.
+        init_method_dw = ["fanIn", 1.0] if init_method[0] == "fanIn" else init_method
+        std_init = self._get_std_init(init_method_dw, 1, fms_in, conv_kernel_dims)
+        w_init = np.asarray(rng.normal(loc=0.0, scale=std_init, size=[fms_in, 1] + conv_kernel_dims), dtype='float32')
+        self._w = tf.Variable(w_init, dtype="float32", name="W_dw") # [#FMs of Input, 1, x, y, z]
+        
+        std_init = self._get_std_init(init_method, fms_in, fms_out, [1,1,1])
+        w_init = np.asarray(rng.normal(loc=0.0, scale=std_init, size=[fms_out, fms_in, 1, 1, 1]), dtype='float32')
+        self._w_pw = tf.Variable(w_init, dtype="float32", name="W_pw") # [#FMs of this layer, #FMs of Input, 1, 1, 1]
+        
+        self._strides = [1,1,1]
+        self._pad_mode = pad_mode
+        
+    def trainable_params(self):
+        return [self._w, self._w_pw] # Different shapes.
+    
+    def apply_with_weights(self, input, ws):
+        out_dw = ops.depthwise_conv_3d(input, ws[0], self._pad_mode)
+        return ops.conv_3d(out_dw, ws[1], 'VALID')
+    
+    def inds_of_ws_on_inp(self):
+        return [0]
+    
+    def inds_of_ws_to_outp(self):
+        return [1]
+    
+    
+class GroupedConvolutionalLayer(ConvolutionalLayer):
+    # Channels of input and output split in groups. Each group of outputs is computed only from the same group of inputs.
+    # Params and flops divided by n_groups. Ala Krizhevsky et al, NIPS 2012 and Xie et al, ResNeXt, CVPR 2017.
+    def __init__(self, fms_in, fms_out, conv_kernel_dims, init_method, pad_mode, rng, n_groups):
+        assert fms_in % n_groups == 0 and fms_out % n_groups == 0
+        self._n_groups = n_groups
+        std_init = self._get_std_init(init_method, fms_in//n_groups, fms_out, conv_kernel_dims)
+        w_init = np.asarray(rng.normal(loc=0.0, scale=std_init, size=[fms_out, fms_in//n_groups] + conv_kernel_dims), dtype='float32')
+        self._w = tf.Variable(w_init, dtype="float32", name="W") # [#FMs of this layer, #FMs of Input / n_groups, x, y, z]
+        self._strides = [1,1,1]
+        self._pad_mode = pad_mode
+        
+    def apply_with_weights(self, input, ws):
+        return ops.grouped_conv_3d(input, ws[0], self._n_groups, self._pad_mode)
+    
+    
 class DropoutLayer(Layer):
     def __init__(self, dropout_rate, rng):
         self._keep_prob = 1 - dropout_rate
@@ -237,7 +298,7 @@ class DropoutLayer(Layer):
             random_tensor = self._keep_prob
             random_tensor += tf.random.uniform(shape=tf.shape(input), minval=0., maxval=1., seed=self._rng.randint(999999), dtype="float32")
             # 0. if [keep_prob, 1.0) and 1. if [1.0, 1.0 + keep_prob)
-            dropout_mask = tf.floor(random_tensor)
+            dropout_mask = tf.cast(tf.floor(random_tensor), input.dtype)
             output = input * dropout_mask
         elif mode == "infer":
             output = input * self._keep_prob
@@ -246,6 +307,10 @@ class DropoutLayer(Layer):
         
         return output
     
+    def get_inference_scale(self):
+        # Factor by which the input is scaled at inference.
+        return 1. if self._keep_prob > 0.999 else self._keep_prob
+    
     def trainable_params(self):
         return []
     
@@ -255,69 +320,119 @@ class BiasLayer(Layer):
         
 
     def apply(self, input, _):
-        # self._b.shape[0] should already be input.shape[1] number of input channels.
-        return input + tf.reshape(self._b, shape=[1,input.shape[1],1,1,1])
+        # self._b.shape[0] should already be input.shape[4] number of input channels. Broadcasts over the last axis.
+        return input + tf.cast(self._b, input.dtype)
+    
+    def _apply_fused(self, input, mode):
+        # Statistics, scale and offset are float32 for any type of input, as the kernel requires.
+        if mode == "train":
+            norm_inp, self._new_mu_batch_t, var_unbiased = tf.compat.v1.nn.fused_batch_norm(input, self._g, self._b, epsilon=self._epsilon,
+                                                                                            data_format="NDHWC", is_training=True)
+            # The kernel returns the unbiased variance. The rolling average keeps the biased one, as the non-fused version.
+            n_vox_per_chan = tf.cast(tf.size(input) // tf.shape(input)[4], "float32")
+            self._new_var_batch_t = var_unbiased * (n_vox_per_chan - 1.) / n_vox_per_chan
+        elif mode == "infer":
+            norm_inp, _, _ = tf.compat.v1.nn.fused_batch_norm(input, self._g, self._b, mean=self._mu_for_inference, variance=self._var_for_inference,
+                                                             epsilon=self._epsilon, data_format="NDHWC", is_training=False)
+        else:
+            raise NotImplementedError()
+        return norm_inp
+    
+    def get_inference_affine(self):
+        # Returns tensors (scale, shift) per channel, so that at inference: output = input * scale + shift
+        return tf.ones_like(self._b), self._b
     
     def trainable_params(self):
         return [self._b]
     
 class BatchNormLayer(Layer):
     # Order of functions:
-    # __init__ -> apply(train) --> get_update_ops_for_bn_moving_avg -> update_arrays_of_bn_moving_avg -> apply(infer)
-    def __init__(self, moving_avg_length, n_channels):
+    # __init__ -> apply(train) --> get_update_ops_for_bn_moving_avg (run with the training step) ->
+    # -> get_op_refresh_inference_stats -> apply(infer)
+    def __init__(self, moving_avg_length, n_channels, use_fused=False):
         self._moving_avg_length = moving_avg_length # integer. The number of iterations (batches) over which to compute a moving average.
+        self._use_fused = use_fused # If True, normalization is by tf's fused_batch_norm kernels.
+        # Added to var. The fused kernels require epsilon >= 1.001e-5, so outputs differ slightly from the non-fused version.
+        self._epsilon = 1.001e-5 if use_fused else np.finfo(np.float32).tiny
         self._g = tf.Variable( np.ones( (n_channels), dtype='float32'), name="gBn" )
         self._b = tf.Variable( np.zeros( (n_channels), dtype='float32'), name="bBn" )
         #for moving average:
         self._array_mus_for_moving_avg = tf.Variable( np.zeros( (moving_avg_length, n_channels), dtype='float32' ), name="muBnsForRollingAverage" )
         self._array_vars_for_moving_avg = tf.Variable( np.ones( (moving_avg_length, n_channels), dtype='float32' ), name="varBnsForRollingAverage" )        
-        self._new_mu_batch = tf.Variable(np.zeros( (n_channels), dtype='float32'), name="sharedNewMu_B") # Value will be assigned every training-iteration.
-        self._new_var_batch = tf.Variable(np.ones( (n_channels), dtype='float32'), name="sharedNewVar_B")
-        # Create ops for updating the matrices with the bn inference stats.
-        self._tf_plchld_int32 = tf.compat.v1.placeholder( dtype="int32", name="tf_plchld_int32") # convenience for tf.assign
-        self._op_update_mtrx_bn_inf_mu = tf.compat.v1.assign( self._array_mus_for_moving_avg[self._tf_plchld_int32], self._new_mu_batch ) # Cant it just take tensor? self._latest_mu_batch?
-        self._op_update_mtrx_bn_inf_var = tf.compat.v1.assign( self._array_vars_for_moving_avg[self._tf_plchld_int32], self._new_var_batch )
+        # Index in the rolling-average matrices, of the entry to update in the next batch. Updated in the graph.
+        # Local, so not in checkpoints. Starts from 0 in every session, when local variables are initialized.
+        self._idx_where_moving_avg_is = tf.compat.v1.Variable( 0, dtype="int32", trainable=False,
+                                                               collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES], name="idxBnRollingAverage" )
         
-        self._idx_where_moving_avg_is = 0 #Index in the rolling-average matrices of the layers, of the entry to update in the next batch. Could be tf.Var.
+        # Mu and var for inference. Cached means of the matrices above, so that inference does not reduce them every pass.
+        # Local, so not in checkpoints. They are made from the matrices after loading or training, via the op below.
+        self._mu_for_inference = tf.compat.v1.Variable( np.zeros( (n_channels), dtype='float32'), trainable=False,
+                                                        collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES], name="muBnForInference" )
+        self._var_for_inference = tf.compat.v1.Variable( np.ones( (n_channels), dtype='float32'), trainable=False,
+                                                         collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES], name="varBnForInference" )
+        self._op_refresh_inference_stats = tf.group( tf.compat.v1.assign( self._mu_for_inference, tf.reduce_mean(self._array_mus_for_moving_avg, axis=0) ),
+                                                     tf.compat.v1.assign( self._var_for_inference, tf.reduce_mean(self._array_vars_for_moving_avg, axis=0) ) )
 
     def trainable_params(self):
         return [self._g, self._b]
     
-    def apply(self, input, mode, e1 = np.finfo(np.float32).tiny):
+    def apply(self, input, mode):
         # mode: String in ["train", "infer"]
-        n_channs = input.shape[1]
-        
+        # input: [batch, r, c, z, channels]
+        # If input is bfloat16 (mixed precision), g, b and the statistics are float32. Only scale and shift are cast,
+        # so that the normalization is applied in bfloat16, as one multiply-add per voxel: input * scale + shift, per channel.
+        # If use_fused, one fused_batch_norm op per layer instead, with its bigger epsilon.
+        if self._use_fused:
+            return self._apply_fused(input, mode)
         if mode == "train":
-            self._new_mu_batch_t, self._new_var_batch_t = tf.nn.moments(input, axes=[0,2,3,4])
-            mu = self._new_mu_batch_t
-            var = self._new_var_batch_t
+            inp_f32 = tf.cast(input, "float32") if input.dtype != tf.float32 else input
+            self._new_mu_batch_t, self._new_var_batch_t = tf.nn.moments(inp_f32, axes=[0,1,2,3])
+            scale = self._g / tf.sqrt(self._new_var_batch_t + self._epsilon)
+            shift = self._b - self._new_mu_batch_t * scale
         elif mode == "infer":
-            mu = tf.reduce_mean(self._array_mus_for_moving_avg, axis=0)
-            var = tf.reduce_mean(self._array_vars_for_moving_avg, axis=0)
+            scale, shift = self.get_inference_affine()
         else:
             raise NotImplementedError()
         
-        # Reshape for broadcast.
-        g_resh = tf.reshape(self._g, shape=[1,n_channs,1,1,1])
-        b_resh = tf.reshape(self._b, shape=[1,n_channs,1,1,1])
-        mu     = tf.reshape(mu, shape=[1,n_channs,1,1,1])
-        var    = tf.reshape(var, shape=[1,n_channs,1,1,1])
-        # Normalize
-        norm_inp = (input - mu ) /  tf.sqrt(var + e1) # e1 should come OUT of the sqrt! 
-        norm_inp = g_resh * norm_inp + b_resh
-        
-        # Returns mu_batch, var_batch to update the moving average afterwards (during training)
+        if input.dtype != tf.float32:
+            scale, shift = tf.cast(scale, input.dtype), tf.cast(shift, input.dtype)
+        norm_inp = input * scale + shift # Broadcast over last axis.
         return norm_inp
+    
+    def _apply_fused(self, input, mode):
+        # Statistics, scale and offset are float32 for any type of input, as the kernel requires.
+        if mode == "train":
+            norm_inp, self._new_mu_batch_t, var_unbiased = tf.compat.v1.nn.fused_batch_norm(input, self._g, self._b, epsilon=self._epsilon,
+                                                                                            data_format="NDHWC", is_training=True)
+            # The kernel returns the unbiased variance. The rolling average keeps the biased one, as the non-fused version.
+            n_vox_per_chan = tf.cast(tf.size(input) // tf.shape(input)[4], "float32")
+            self._new_var_batch_t = var_unbiased * (n_vox_per_chan - 1.) / n_vox_per_chan
+        elif mode == "infer":
+            norm_inp, _, _ = tf.compat.v1.nn.fused_batch_norm(input, self._g, self._b, mean=self._mu_for_inference, variance=self._var_for_inference,
+                                                             epsilon=self._epsilon, data_format="NDHWC", is_training=False)
+        else:
+            raise NotImplementedError()
+        return norm_inp
+    
+    def get_inference_affine(self):
+        # Returns tensors (scale, shift) per channel, so that at inference: output = input * scale + shift
+        # Used by apply() in "infer" mode, with the cached mu and var.
+        scale = self._g / tf.sqrt(self._var_for_inference + self._epsilon)
+        shift = self._b - self._mu_for_inference * scale
+        return scale, shift
+    
+    def get_op_refresh_inference_stats(self):
+        # Must be run after the matrices for the moving average change (training or loading), before inference.
+        return self._op_refresh_inference_stats
         
-    def get_update_ops_for_bn_moving_avg(self) : # I think this is utterly useless.
-        # This function or something similar should stay, even if I clean the BN rolling average.
-        return [ tf.compat.v1.assign( ref=self._new_mu_batch, value=self._new_mu_batch_t, validate_shape=True ),
-                tf.compat.v1.assign( ref=self._new_var_batch, value=self._new_var_batch_t, validate_shape=True ) ]
-        
-    def update_arrays_of_bn_moving_avg(self, sessionTf):
-            sessionTf.run( fetches=self._op_update_mtrx_bn_inf_mu, feed_dict={self._tf_plchld_int32: self._idx_where_moving_avg_is} )
-            sessionTf.run( fetches=self._op_update_mtrx_bn_inf_var, feed_dict={self._tf_plchld_int32: self._idx_where_moving_avg_is} )
-            self._idx_where_moving_avg_is = (self._idx_where_moving_avg_is + 1) % self._moving_avg_length
+    def get_update_ops_for_bn_moving_avg(self) :
+        # Ops that write mu and var of the training batch in the rolling-average matrices, and advance the index.
+        # Requires apply(train) first. To be grouped with the training step, so that one run does everything.
+        op_update_mu = tf.compat.v1.scatter_update( self._array_mus_for_moving_avg, self._idx_where_moving_avg_is, self._new_mu_batch_t )
+        op_update_var = tf.compat.v1.scatter_update( self._array_vars_for_moving_avg, self._idx_where_moving_avg_is, self._new_var_batch_t )
+        with tf.control_dependencies([op_update_mu, op_update_var]): # Advance only after the index was used.
+            op_advance_idx = tf.compat.v1.assign( self._idx_where_moving_avg_is, (self._idx_where_moving_avg_is + 1) % self._moving_avg_length )
+        return [ op_update_mu, op_update_var, op_advance_idx ]
             
 
 def get_act_layer(act_str, n_fms_in):
@@ -337,8 +452,8 @@ class PreluLayer(Layer):
         self._a = tf.Variable(np.ones((n_channels), dtype='float32')*alpha, name="aPrelu")
 
     def apply(self, input, _):
-        # input is a tensor of shape (batchSize, FMs, r, c, z)
-        return ops.prelu(input, tf.reshape(self._a, shape=[1,input.shape[1],1,1,1]) )
+        # input is a tensor of shape (batchSize, r, c, z, FMs)
+        return ops.prelu(input, tf.reshape(tf.cast(self._a, input.dtype), shape=[1,1,1,1,input.shape[4]]) )
     
     def trainable_params(self):
         return [self._a]
@@ -8,6 +8,7 @@
 from __future__ import absolute_import, print_function, division
 
 from math import ceil
+import contextlib
 import numpy as np
 import random
 
@@ -23,12 +24,23 @@ except ImportError:
 ###############################################################
 # Functions used by layers but do not change Layer Attributes #
 ###############################################################
+# Activations within the network are channels-last: [BatchSize, R, C, Z, Channels], the NDHWC of TF's kernels.
+# Inputs and outputs of the network are channels-first [BatchSize, Channels, R, C, Z]. See Cnn3d.apply().
+# Weights of convs stay [ #ChannelsOut, #ChannelsIn, R, C, Z ], as in existing checkpoints.
+
+def to_channels_last(input):
+    # [batch, channels, r, c, z] -> [batch, r, c, z, channels]
+    return tf.transpose(input, perm=[0,2,3,4,1])
+
+def to_channels_first(input, name=None):
+    # [batch, r, c, z, channels] -> [batch, channels, r, c, z]
+    return tf.transpose(input, perm=[0,4,1,2,3], name=name)
 
 def conv_3d(input, w, padding="VALID"):
     # input weight matrix W has shape: [ #ChannelsOut, #ChannelsIn, R, C, Z ]
-    # Input signal given in shape [BatchSize, Channels, R, C, Z]
+    # Input signal given in shape [BatchSize, R, C, Z, Channels]
     # padding: 'VALID', 'SAME' or 'MIRROR'
-    # Tensorflow's Conv3d requires filter shape: [ D/Z, H/C, W/R, C_in, C_out ] #ChannelsOut, #ChannelsIn, Z, R, C ]
+    # Tensorflow's Conv3d requires filter shape: [ R, C, Z, C_in, C_out ] for signal [BatchSize, R, C, Z, Channels]
     if padding in ['MIRROR', 'mirror']: # If mirror, do it here and perform conv as if not pad ('SAME')
         input = pad_by_mirroring(input, n_vox_pad_per_dim=[w.shape[2+d] - 1 for d in range(3)])
         padding = 'VALID'
@@ -37,35 +49,78 @@ def conv_3d(input, w, padding="VALID"):
     elif padding is None or padding in ['none', 'VALID', 'valid']:
         padding = 'VALID'
         
-    w_resh = tf.transpose(w, perm=[4,3,2,1,0])
-    # Conv3d requires signal in shape: [BatchSize, Channels, Z, R, C]
-    input_resh = tf.transpose(input, perm=[0,4,3,2,1])
-    output = tf.nn.conv3d(input = input_resh, # batch_size, time, num_of_input_channels, rows, columns
-                          filters = w_resh, # TF: Depth, Height, Wight, Chans_in, Chans_out
-                          strides = [1,1,1,1,1],
-                          padding = padding,
-                          data_format = "NDHWC"
-                          )
-    #Output is in the shape of the input image (signals_shape).
-    output = tf.transpose(output, perm=[0,4,3,2,1]) #reshape the result, back to the shape of the input image.
+    # Weights are kept in float32. Cast to the dtype of the signal (eg bfloat16 in mixed precision). No-op if same.
+    w_resh = tf.transpose(tf.cast(w, input.dtype), perm=[2,3,4,1,0]) # Only the (small) weights are transposed, not the signal.
+    # Convs are left out of XLA clusters (see xla_jit_scope). On cpu, XLA's 3D conv is much slower than TF's kernel.
+    with tf.xla.experimental.jit_scope(compile_ops=False):
+        output = tf.nn.conv3d(input = input, # batch_size, r, c, z, num_of_input_channels
+                              filters = w_resh, # TF: Depth, Height, Wight, Chans_in, Chans_out
+                              strides = [1,1,1,1,1],
+                              padding = padding,
+                              data_format = "NDHWC"
+                              )
+    return output
+
+def depthwise_conv_3d(input, w, padding="VALID"):
+    # input: [BatchSize, R, C, Z, Channels]. w: [Channels, 1, R, C, Z], a kernel per channel (channel multiplier 1).
+    # TF has no 3D depthwise conv (and no grouped conv3d on cpu). It is the sum of 2D depthwise convs over (r,c),...
+    # ... one per offset of the kernel along z. Z is moved next to batch, so that slices along it fold in the batch.
+    kern_dims = w.shape.as_list()[2:]
+    if padding in ['MIRROR', 'mirror']:
+        input = pad_by_mirroring(input, n_vox_pad_per_dim=[kern_dims[d] - 1 for d in range(3)])
+    elif padding in ['ZERO', 'zero']: # As 'SAME' of conv_3d.
+        input = tf.pad(input, [[0,0]] + [[(kern_dims[d] - 1)//2, kern_dims[d] - 1 - (kern_dims[d] - 1)//2] for d in range(3)] + [[0,0]])
+    n_chans = input.shape[4]
+    w_resh = tf.transpose(tf.cast(w[:, 0], input.dtype), perm=[1,2,3,0]) # [R, C, Z, Channels]
+    inp_zrc = tf.transpose(input, perm=[0,3,1,2,4]) # [Batch, Z, R, C, Channels]
+    output = None
+    for z_i in range(kern_dims[2]):
+        inp_slices = inp_zrc[:, z_i : (z_i - kern_dims[2] + 1) or None] # [Batch, Z_out, R, C, Channels]
+        shape_slices = tf.shape(inp_slices)
+        with tf.xla.experimental.jit_scope(compile_ops=False): # As conv_3d.
+            out_z_i = tf.nn.depthwise_conv2d(tf.reshape(inp_slices, [-1, shape_slices[2], shape_slices[3], n_chans]),
+                                             filter = tf.expand_dims(w_resh[:, :, z_i], axis=3), # [R, C, Channels, 1]
+                                             strides = [1,1,1,1],
+                                             padding = 'VALID')
+        shape_out_z_i = tf.shape(out_z_i)
+        out_z_i = tf.reshape(out_z_i, [shape_slices[0], shape_slices[1], shape_out_z_i[1], shape_out_z_i[2], n_chans])
+        output = out_z_i if output is None else output + out_z_i
+    output = tf.transpose(output, perm=[0,2,3,1,4]) # [Batch, R_out, C_out, Z_out, Channels]
+    # Reshapes above lose the static dims. Restore them where known.
+    output.set_shape([input.shape[0]] + [input.shape[1+d] - kern_dims[d] + 1 if input.shape[1+d] is not None else None
+                                         for d in range(3)] + [n_chans])
     return output
 
+def grouped_conv_3d(input, w, n_groups, padding="VALID"):
+    # input: [BatchSize, R, C, Z, Channels]. w: [ChannelsOut, ChannelsIn/n_groups, R, C, Z].
+    # Channels of input and output are split in n_groups. Each group of outputs is the conv of the same group of inputs.
+    # No grouped conv3d kernel on cpu, so one conv per group.
+    inp_per_group = tf.split(input, n_groups, axis=4)
+    w_per_group = tf.split(w, n_groups, axis=0)
+    return tf.concat([conv_3d(inp_g, w_g, padding) for inp_g, w_g in zip(inp_per_group, w_per_group)], axis=4)
+
+def xla_jit_scope(use_xla):
+    # If use_xla, ops made within are compiled by XLA at their first run (per shape of input), and so are their gradients.
+    # It fuses eg the elementwise ops of BN, activations and dropout between convs. Ops that XLA cannot compile ...
+    # ... are left out of the compiled clusters and run as usual.
+    return tf.xla.experimental.jit_scope() if use_xla else contextlib.nullcontext()
+
 def relu(input):
-    #input is a tensor of shape (batchSize, FMs, r, c, z)
-    return tf.maximum(0., input)
+    #input is a tensor of shape (batchSize, r, c, z, FMs)
+    return tf.maximum(tf.constant(0., dtype=input.dtype), input)
 
 def prelu(input, a):
-    # a = tensor of floats, [1, n_channels, 1, 1, 1]
-    pos = tf.maximum(0., input)
+    # a = tensor of floats, [1, 1, 1, 1, n_channels]
+    pos = tf.maximum(tf.constant(0., dtype=input.dtype), input)
     neg = a * (input - abs(input)) * 0.5
     return pos + neg
 
 def elu(input):
-    #input is a tensor of shape (batchSize, FMs, r, c, z)
+    #input is a tensor of shape (batchSize, r, c, z, FMs)
     return tf.nn.elu(input)
 
 def selu(input):
-    #input is a tensor of shape (batchSize, FMs, r, c, z)
+    #input is a tensor of shape (batchSize, r, c, z, FMs)
     lambda01 = 1.0507 # calc in p4 of paper.
     alpha01 = 1.6733 # WHERE IS THIS USED? I AM DOING SOMETHING WRONG I THINK.
     raise NotImplementedError()
@@ -73,7 +128,7 @@ def selu(input):
 
 
 def pool_3d(input, window_size, strides, pad_mode, pool_mode) :
-    # input dimensions: (batch, fms, r, c, z)
+    # input dimensions: (batch, r, c, z, fms)
     # poolParams: [[dsr,dsc,dsz], [strr,strc,strz], [mirrorPad-r,-c,-z], mode]
     # pool_mode: 'MAX' or 'AVG'
     if pad_mode in ['MIRROR', 'mirror']:
@@ -84,46 +139,45 @@ def pool_3d(input, window_size, strides, pad_mode, pool_mode) :
     elif padding is None or padding in ['none']:
         padding = 'VALID'
         
-    inp_resh = tf.transpose(input, perm=[0,4,3,2,1]) # Channels last.
-    pooled_out = tf.nn.pool(input = inp_resh,
+    pooled_out = tf.nn.pool(input = input,
                             window_shape=window_size,
                             strides=strides,
                             padding=pad_mode, # SAME or VALID
                             pooling_type=pool_mode,
                             data_format="NDHWC") # AVG or MAX
-    pooled_out = tf.transpose(pooled_out, perm=[0,4,3,2,1])
     
     return pooled_out
 
 
 def crop_center(fms, listOfNumberOfCentralVoxelsToGetPerDimension) :
-    # fms: a 5D tensor, [batch, fms, r, c, z]
+    # fms: a 5D tensor, [batch, r, c, z, fms]
     # listOfNumberOfCentralVoxelsToGetPerDimension: list of 3 scalars or Tensorflow 1D tensor (eg from tf.shape(x)). [r, c, z]
-    # NOTE: Because of the indexing in the end, the shape returned is commonyl (None, Fms, None, None, None). Should be reshape to preserve shape.
+    # NOTE: Because of the indexing in the end, the shape returned is commonyl (None, None, None, None, Fms). Should be reshape to preserve shape.
     fmsShape = tf.shape(fms) #fms.shape works too.
     # if part is of even width, one voxel to the left is the centre.
-    rCentreOfPartIndex = (fmsShape[2] - 1) // 2
+    rCentreOfPartIndex = (fmsShape[1] - 1) // 2
     rIndexToStartGettingCentralVoxels = rCentreOfPartIndex - (listOfNumberOfCentralVoxelsToGetPerDimension[0] - 1) // 2
     rIndexToStopGettingCentralVoxels = rIndexToStartGettingCentralVoxels + listOfNumberOfCentralVoxelsToGetPerDimension[0]  # Excluding
-    cCentreOfPartIndex = (fmsShape[3] - 1) // 2
+    cCentreOfPartIndex = (fmsShape[2] - 1) // 2
     cIndexToStartGettingCentralVoxels = cCentreOfPartIndex - (listOfNumberOfCentralVoxelsToGetPerDimension[1] - 1) // 2
     cIndexToStopGettingCentralVoxels = cIndexToStartGettingCentralVoxels + listOfNumberOfCentralVoxelsToGetPerDimension[1]  # Excluding
-    zCentreOfPartIndex = (fmsShape[4] - 1) // 2
+    zCentreOfPartIndex = (fmsShape[3] - 1) // 2
     zIndexToStartGettingCentralVoxels = zCentreOfPartIndex - (listOfNumberOfCentralVoxelsToGetPerDimension[2] - 1) // 2
     zIndexToStopGettingCentralVoxels = zIndexToStartGettingCentralVoxels + listOfNumberOfCentralVoxelsToGetPerDimension[2]  # Excluding
-    return fms[    :, :,
+    return fms[    :,
                 rIndexToStartGettingCentralVoxels : rIndexToStopGettingCentralVoxels,
                 cIndexToStartGettingCentralVoxels : cIndexToStopGettingCentralVoxels,
-                zIndexToStartGettingCentralVoxels : zIndexToStopGettingCentralVoxels]
+                zIndexToStartGettingCentralVoxels : zIndexToStopGettingCentralVoxels,
+                :]
 
 
 def crop_to_match_dims(input, dims_to_match):
-    # dims_to_match : [ batch size, num of fms, r, c, z] 
+    # dims_to_match : [ batch size, r, c, z, num of fms] 
     output = input[:,
-                   :,
+                   :dims_to_match[1],
                    :dims_to_match[2],
                    :dims_to_match[3],
-                   :dims_to_match[4]]
+                   :]
     return output
 
 
@@ -131,51 +185,52 @@ def make_residual_connection(tensor_1, tensor_2) :
     # tensor_1: earlier tensor
     # tensor_2: deeper tensor
     # Add the outputs of the two layers and return the output, as well as its dimensions.
-    # tensor_2 & tensor_1: 5D tensors [batchsize, chans, x, y, z], outputs of deepest and earliest layer of the Res.Conn.
+    # tensor_2 & tensor_1: 5D tensors [batchsize, x, y, z, chans], outputs of deepest and earliest layer of the Res.Conn.
     # Result: Shape of result should be exactly the same as the output of Deeper layer.
     tens_1_shape = tf.shape(tensor_1)
     tens_2_shape = tf.shape(tensor_2)
     # Get part of the earlier layer that is of the same dimensions as the FMs of the deeper:
-    tens_1_center_crop = crop_center(tensor_1, tens_2_shape[2:])
+    tens_1_center_crop = crop_center(tensor_1, tens_2_shape[1:4])
     # Add the FMs, after taking care of zero padding if the deeper layer has more FMs.
-    if tensor_2.get_shape()[1] >= tensor_1.get_shape()[1] : # ifs not allowed via tensor (from tf.shape(...))
+    if tensor_2.get_shape()[4] >= tensor_1.get_shape()[4] : # ifs not allowed via tensor (from tf.shape(...))
         blank_channels = tf.zeros(shape=[tens_2_shape[0],
-                                         tens_2_shape[1] - tens_1_shape[1],
-                                         tens_2_shape[2], tens_2_shape[3], tens_2_shape[4]], dtype="float32")
-        res_out = tensor_2 + tf.concat( [tens_1_center_crop, blank_channels], axis=1)
+                                         tens_2_shape[1], tens_2_shape[2], tens_2_shape[3],
+                                         tens_2_shape[4] - tens_1_shape[4]], dtype=tensor_2.dtype)
+        res_out = tensor_2 + tf.concat( [tens_1_center_crop, blank_channels], axis=4)
 
     else : # Deeper FMs are fewer than earlier. This should not happen in most architectures. But oh well...
-        res_out = tensor_2 + tens_1_center_crop[:, :tens_2_shape[1], :,:,:]
-    # The following reshape is to enforce the 4 dimensions to be "visible" to TF (cause the indexing in crop_center makes them dynamic/None)
-    res_out = tf.reshape(res_out, shape=[-1, res_out.shape[1], tensor_2.shape[2], tensor_2.shape[3], tensor_2.shape[4]])
+        res_out = tensor_2 + tens_1_center_crop[:, :,:,:, :tens_2_shape[4]]
+    # The following is to enforce the 4 dimensions to be "visible" to TF (cause the indexing in crop_center makes them dynamic/None)
+    # set_shape() instead of reshape, so that it also works when the dims of tensor_2 are dynamic.
+    res_out.set_shape(tensor_2.get_shape())
     return res_out
 
 
 def upsample_by_repeat(input, up_factors):
-    # input: [batch size, num of FMs, r, c, z]. Ala input/output of conv layers.
-    # Repeat FM in the three last dimensions, to upsample back to the normal resolution space.
+    # input: [batch size, r, c, z, num of FMs]. Ala input/output of conv layers.
+    # Repeat FM in the three spatial dimensions, to upsample back to the normal resolution space.
     # In numpy below: (but tf has no repeat, only tile, so, implementation is funny.
     # up_factors: list of upsampling factors per (3d) dimension. [up-x, up-y, up-z]
     res = input
     res_shape = tf.shape(input) # Dynamic. For batch and r,c,z dimensions. (unknown prior to runtime)
-    n_fms = input.get_shape()[1] # Static via get_shape(). Known. For reshape to return tensor with *known* shape[1].
-    # If tf.shape()[1] is used, reshape changes res.get_shape()[1] to (?).
+    n_fms = input.get_shape()[4] # Static via get_shape(). Known. For reshape to return tensor with *known* shape[4].
+    # If tf.shape()[4] is used, reshape changes res.get_shape()[4] to (?).
     
-    res = tf.reshape( tf.tile( tf.reshape( res, shape=[res_shape[0], res_shape[1]*res_shape[2], 1, res_shape[3], res_shape[4]] ),
-                               multiples=[1, 1, up_factors[0], 1, 1] ),
-                    shape=[res_shape[0], n_fms, res_shape[2]*up_factors[0], res_shape[3], res_shape[4]] )
+    res = tf.reshape( tf.tile( tf.reshape( res, shape=[res_shape[0], res_shape[1], 1, res_shape[2]*res_shape[3]*res_shape[4]] ),
+                               multiples=[1, 1, up_factors[0], 1] ),
+                    shape=[res_shape[0], res_shape[1]*up_factors[0], res_shape[2], res_shape[3], n_fms] )
     res_shape = tf.shape(res)
-    res = tf.reshape( tf.tile( tf.reshape( res, shape=[res_shape[0], res_shape[1], res_shape[2]*res_shape[3], 1, res_shape[4]] ),
-                               multiples=[1, 1, 1, up_factors[1], 1] ),
-                    shape=[res_shape[0], n_fms, res_shape[2], res_shape[3]*up_factors[1], res_shape[4]] )
+    res = tf.reshape( tf.tile( tf.reshape( res, shape=[res_shape[0], res_shape[1]*res_shape[2], 1, res_shape[3]*res_shape[4]] ),
+                               multiples=[1, 1, up_factors[1], 1] ),
+                    shape=[res_shape[0], res_shape[1], res_shape[2]*up_factors[1], res_shape[3], n_fms] )
     res_shape = tf.shape(res)
-    res = tf.reshape( tf.tile( tf.reshape( res, shape=[res_shape[0], res_shape[1], res_shape[2], res_shape[3]*res_shape[4], 1] ),
-                               multiples=[1, 1, 1, 1, up_factors[2]] ),
-                    shape=[res_shape[0], n_fms, res_shape[2], res_shape[3], res_shape[4]*up_factors[2]] )
+    res = tf.reshape( tf.tile( tf.reshape( res, shape=[res_shape[0], res_shape[1]*res_shape[2]*res_shape[3], 1, res_shape[4]] ),
+                               multiples=[1, 1, up_factors[2], 1] ),
+                    shape=[res_shape[0], res_shape[1], res_shape[2], res_shape[3]*up_factors[2], n_fms] )
     return res
     
 def upsample_5D_tens_and_crop(input, up_factors, upsampl_type="repeat", dims_to_match=None) :
-    # input: [batch_size, numberOfFms, r, c, z].
+    # input: [batch_size, r, c, z, numberOfFms].
     # up_factors: list of upsampling factors per (3d) dimension. [up-x, up-y, up-z]
     if upsampl_type == "repeat" :
         out_hr = upsample_by_repeat(input, up_factors)
@@ -193,23 +248,22 @@ def upsample_5D_tens_and_crop(input, up_factors, upsampl_type="repeat", dims_to_
 
 
 def pad_by_mirroring(input, n_vox_pad_per_dim):
-    # input shape: [batchSize, #channels#, r, c, z]
-    # inputImageDimensions : [ batchSize, #channels, dim r, dim c, dim z ] of input
+    # input shape: [batchSize, r, c, z, #channels#]
+    # inputImageDimensions : [ batchSize, dim r, dim c, dim z, #channels ] of input
     # n_vox_pad_per_dim shape: [ num o voxels in r-dim to add, ...c-dim, ...z-dim ]
     # If n_vox_pad_per_dim is odd, 1 more voxel is added to the right side.
     # r-axis
     assert np.all(n_vox_pad_per_dim) >= 0
     padLeft = int(n_vox_pad_per_dim[0] // 2); padRight = int((n_vox_pad_per_dim[0] + 1) // 2);
-    paddedImage = tf.concat([input[:, :, int(n_vox_pad_per_dim[0] // 2) - 1::-1 , :, :], input], axis=2) if padLeft > 0 else input
-    paddedImage = tf.concat([paddedImage, paddedImage[ :, :, -1:-1 - int((n_vox_pad_per_dim[0] + 1) // 2):-1, :, :]], axis=2) if padRight > 0 else paddedImage
+    paddedImage = tf.concat([input[:, int(n_vox_pad_per_dim[0] // 2) - 1::-1 , :, :, :], input], axis=1) if padLeft > 0 else input
+    paddedImage = tf.concat([paddedImage, paddedImage[ :, -1:-1 - int((n_vox_pad_per_dim[0] + 1) // 2):-1, :, :, :]], axis=1) if padRight > 0 else paddedImage
     # c-axis
     padLeft = int(n_vox_pad_per_dim[1] // 2); padRight = int((n_vox_pad_per_dim[1] + 1) // 2);
-    paddedImage = tf.concat([paddedImage[:, :, :, padLeft - 1::-1 , :], paddedImage], axis=3) if padLeft > 0 else paddedImage
-    paddedImage = tf.concat([paddedImage, paddedImage[:, :, :, -1:-1 - padRight:-1, :]], axis=3) if padRight > 0 else paddedImage
+    paddedImage = tf.concat([paddedImage[:, :, padLeft - 1::-1 , :, :], paddedImage], axis=2) if padLeft > 0 else paddedImage
+    paddedImage = tf.concat([paddedImage, paddedImage[:, :, -1:-1 - padRight:-1, :, :]], axis=2) if padRight > 0 else paddedImage
     # z-axis
     padLeft = int(n_vox_pad_per_dim[2] // 2); padRight = int((n_vox_pad_per_dim[2] + 1) // 2)
-    paddedImage = tf.concat([paddedImage[:, :, :, :, padLeft - 1::-1 ], paddedImage], axis=4) if padLeft > 0 else paddedImage
-    paddedImage = tf.concat([paddedImage, paddedImage[:, :, :, :, -1:-1 - padRight:-1]], axis=4) if padRight > 0 else paddedImage
+    paddedImage = tf.concat([paddedImage[:, :, :, padLeft - 1::-1 , :], paddedImage], axis=3) if padLeft > 0 else paddedImage
+    paddedImage = tf.concat([paddedImage, paddedImage[:, :, :, -1:-1 - padRight:-1, :]], axis=3) if padRight > 0 else paddedImage
     
     return paddedImage
-
@@ -11,8 +11,11 @@ import tensorflow as tf
 
 # Abstract
 class Optimizer(object):
-    def __init__(self, params_to_opt):
+    # fused: If True, updates use TF's fused kernels (ResourceApply*), one op per param, instead of many small ops.
+    #        Same variables, so checkpoints are compatible between the two.
+    def __init__(self, params_to_opt, fused=False):
         self._params_to_opt = params_to_opt
+        self._fused = fused
         self._initialize_vars()
     
     # Abstract
@@ -32,13 +35,24 @@ class Optimizer(object):
         grads = self.get_grads_for_params_responsible(cost)
         return self.get_update_ops_given_grads(grads)
     
+    def _get_fused_mom_update_ops(self, steps_per_lr, learning_rate, momentum, classicMomentum0OrNesterov1):
+        # Fused v = mom * v - lr * step, and param += v (classic) or param += mom * v - lr * step (Nesterov).
+        # Same convention as velocities_for_mom, that ResourceApplyMomentum has opposite sign of.
+        updates = []
+        for param, step_per_lr, v in zip(self._params_to_opt, steps_per_lr, self._velocities_for_mom):
+            updates.append( tf.raw_ops.ResourceApplyKerasMomentum( var=param.handle, accum=v.handle, lr=learning_rate,
+                                                                   grad=step_per_lr, momentum=momentum,
+                                                                   use_nesterov=(classicMomentum0OrNesterov1 == 1) ) )
+        return updates
+    
 class SgdOptimizer(Optimizer):
     def __init__(self,
                  params_to_opt,
                  learning_rate,
                  momentum,
                  momentumTypeNONNormalized0orNormalized1,
-                 classicMomentum0OrNesterov1):
+                 classicMomentum0OrNesterov1,
+                 fused=False):
         
         self.name = "SgdOptimizer"
         
@@ -49,7 +63,7 @@ class SgdOptimizer(Optimizer):
         
         self._velocities_for_mom = None # list  tf.var
         
-        Optimizer.__init__(self, params_to_opt)
+        Optimizer.__init__(self, params_to_opt, fused)
         
     def _initialize_vars(self):
         self._velocities_for_mom = []
@@ -62,6 +76,10 @@ class SgdOptimizer(Optimizer):
         # The below will be 1 if nonNormalized momentum, and (1-momentum) if I am using normalized momentum.
         multiplierForCurrentGradUpdateForNonNormalizedOrNormalizedMomentum = 1.0 - self._momentum * self._momentumTypeNONNormalized0orNormalized1
         
+        if self._fused:
+            steps_per_lr = [ multiplierForCurrentGradUpdateForNonNormalizedOrNormalizedMomentum * grad for grad in grads ]
+            return self._get_fused_mom_update_ops(steps_per_lr, self._learning_rate, self._momentum, self._classicMomentum0OrNesterov1)
+        
         for param, grad, v in zip(self._params_to_opt, grads, self._velocities_for_mom) :
             stepToGradientDirection = multiplierForCurrentGradUpdateForNonNormalizedOrNormalizedMomentum * self._learning_rate * grad
             newVelocity = self._momentum * v - stepToGradientDirection
@@ -83,7 +101,8 @@ class AdamOptimizer(Optimizer):
                  learning_rate,
                  b1_adam,
                  b2_adam,
-                 eps):
+                 eps,
+                 fused=False):
         
         self.name = "AdamOptimizer"
         
@@ -97,7 +116,7 @@ class AdamOptimizer(Optimizer):
         self._vars_of_grads = None
 
         
-        Optimizer.__init__(self, params_to_opt)
+        Optimizer.__init__(self, params_to_opt, fused)
         
     def _initialize_vars(self) :
         self._i_adam = tf.Variable(0.0, dtype="float32", name="i_adam")  # Current iteration of Adam
@@ -114,6 +133,17 @@ class AdamOptimizer(Optimizer):
         
         i = self._i_adam
         i_t = i + 1.
+        
+        if self._fused: # Same as below. The kernel computes lr_t from the powers of b1 and b2.
+            for param, grad, m, v in zip(self._params_to_opt, grads, self._means_of_grads, self._vars_of_grads):
+                updates.append( tf.raw_ops.ResourceApplyAdam( var=param.handle, m=m.handle, v=v.handle,
+                                                              beta1_power=(self._b1_adam)**i_t, beta2_power=(self._b2_adam)**i_t,
+                                                              lr=self._learning_rate, beta1=self._b1_adam, beta2=self._b2_adam,
+                                                              epsilon=self._eps, grad=grad ) )
+            with tf.control_dependencies(updates): # i is read by the above.
+                updates.append( tf.compat.v1.assign(ref=i, value=i_t, validate_shape=True) )
+            return updates
+        
         fix1 = 1. - (self._b1_adam)**i_t
         fix2 = 1. - (self._b2_adam)**i_t
         lr_t = self._learning_rate * (tf.sqrt(fix2) / fix1)
@@ -139,7 +169,8 @@ class RmsPropOptimizer(Optimizer):
                  momentumTypeNONNormalized0orNormalized1,
                  classicMomentum0OrNesterov1,
                  rho,
-                 eps):
+                 eps,
+                 fused=False):
         
         self.name = "RmsPropOptimizer"
         
@@ -153,7 +184,7 @@ class RmsPropOptimizer(Optimizer):
         self._accu_grad_squared = None
         self._velocities_for_mom = None
         
-        Optimizer.__init__(self, params_to_opt)
+        Optimizer.__init__(self, params_to_opt, fused)
         
     def _initialize_vars(self) :
         self._accu_grad_squared = []
@@ -167,6 +198,15 @@ class RmsPropOptimizer(Optimizer):
         # The below will be 1 if nonNormalized momentum, and (1-momentum) if I am using normalized momentum.
         multiplierForCurrentGradUpdateForNonNormalizedOrNormalizedMomentum = 1.0 - self._momentum * self._momentumTypeNONNormalized0orNormalized1
         
+        if self._fused:
+            # ResourceApplyRMSProp has no Nesterov, and its momentum has opposite sign of velocities_for_mom.
+            # So only the momentum and the update of the param are fused, given the grads rescaled by RMS.
+            steps_per_lr = []
+            for grad, accu in zip( grads, self._accu_grad_squared ):
+                accu_new = tf.compat.v1.assign(ref=accu, value=self._rho * accu + (1 - self._rho) * tf.square(grad), validate_shape=True)
+                steps_per_lr.append( multiplierForCurrentGradUpdateForNonNormalizedOrNormalizedMomentum * grad / tf.sqrt(accu_new + self._eps) )
+            return self._get_fused_mom_update_ops(steps_per_lr, self._learning_rate, self._momentum, self._classicMomentum0OrNesterov1)
+        
         for param, grad, accu, v in zip( self._params_to_opt, grads, self._accu_grad_squared, self._velocities_for_mom ):
             accu_new = self._rho * accu + (1 - self._rho) * tf.square(grad)
             stepToGradientDirection = multiplierForCurrentGradUpdateForNonNormalizedOrNormalizedMomentum * (self._learning_rate * grad / tf.sqrt(accu_new + self._eps))
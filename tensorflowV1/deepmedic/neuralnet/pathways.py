@@ -13,7 +13,7 @@ from math import ceil
 import tensorflow as tf
 
 from deepmedic.neuralnet.pathwayTypes import PathwayTypes
-from deepmedic.neuralnet.blocks import ConvBlock, LowRankConvBlock
+from deepmedic.neuralnet.blocks import ConvBlock, LowRankConvBlock, DepthwiseSeparableConvBlock, GroupedConvBlock
 import deepmedic.neuralnet.ops as ops
 
 
@@ -106,11 +106,15 @@ class Pathway(object):
               conv_pad_mode_per_layer,
               use_bn_per_layer, # As a flag for case that I want to apply BN on input image. I want to apply to input of FC.
               moving_avg_length,
+              use_fused_bn,
               activ_func_per_layer,
               dropout_rate_per_layer=[],
               pool_prms_for_path = [],
               inds_of_lower_rank_convs=[],
               ranks_of_lower_rank_convs = [],
+              inds_of_depthwise_sep_convs=[],
+              inds_of_grouped_convs=[],
+              n_groups_of_grouped_convs=[],
               inds_of_blocks_for_res_conns_at_out=[]
               ):
         log.print3("[Pathway_" + str(self.getStringType()) + "] is being built...")
@@ -125,6 +129,10 @@ class Pathway(object):
 
             if layer_i in inds_of_lower_rank_convs :
                 block = LowRankConvBlock(ranks_of_lower_rank_convs[ inds_of_lower_rank_convs.index(layer_i) ])
+            elif layer_i in inds_of_depthwise_sep_convs :
+                block = DepthwiseSeparableConvBlock()
+            elif layer_i in inds_of_grouped_convs :
+                block = GroupedConvBlock(n_groups_of_grouped_convs[ inds_of_grouped_convs.index(layer_i) ])
             else : # normal conv block
                 block = ConvBlock()
 
@@ -140,6 +148,7 @@ class Pathway(object):
                         conv_pad_mode=conv_pad_mode_per_layer[layer_i] if len(conv_pad_mode_per_layer) > 0 else None,
                         use_bn=use_bn_per_layer[layer_i],
                         moving_avg_length=moving_avg_length,
+                        use_fused_bn=use_fused_bn,
                         activ_func=activ_func_per_layer[layer_i],
                         dropout_rate=dropout_rate_per_layer[layer_i] if len(dropout_rate_per_layer) > 0 else 0
                         )
@@ -162,6 +171,8 @@ class Pathway(object):
         return self._blocks[index]
     def subs_factor(self):
         return self._subs_factor
+    def inds_of_blocks_for_res_conns_at_out(self):
+        return self._inds_of_blocks_for_res_conns_at_out
 
     # Other API :
     def getStringType(self) : raise NotImplementedMethod() # Abstract implementation. Children classes should implement this.
@@ -183,7 +194,7 @@ class SubsampledPathway(Pathway):
         self._subs_factor = subsamplingFactor
 
     def upsample_to_high_res(self, input, shape_to_match, upsampl_type="repeat"):
-        # shape_to_match: list of dimensions x,y,z to match, eg by cropping after upsampling. [dimx, dimy, dimz]
+        # shape_to_match: shape of the 5D tensor whose x,y,z dims to match, eg by cropping after upsampling. [batch, dimx, dimy, dimz, fms]
         return ops.upsample_5D_tens_and_crop(input, self.subs_factor(), upsampl_type, shape_to_match)
 
     # OVERRIDING parent's classes.
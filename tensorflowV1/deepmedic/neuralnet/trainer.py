@@ -34,6 +34,8 @@ class Trainer(object):
                  L2_reg_weight,
                  # Cost schedules
                  reweight_classes_in_cost,
+                 # Gradient accumulation
+                 n_batches_per_update,
                  network_to_train):
         
         log.print3("Building Trainer.")
@@ -48,6 +50,8 @@ class Trainer(object):
         self._total_cost = None # This is set-up by calling self.setup_costs(...)
         # Params for costs
         self._reweight_classes_in_cost = reweight_classes_in_cost
+        # Gradients of that many batches are accumulated, and their mean is given to the optimizer for one update.
+        self._n_batches_per_update = n_batches_per_update
         
         
         ################# OPTIMIZER AND SCHEDULES ###############
@@ -65,6 +69,9 @@ class Trainer(object):
         ########### Optimizer ###########
         # Optimizers
         self._optimizer = None # Trainer could be coordinating multiple optimizers, over multiple costs?
+        # Gradient accumulation. Only if n_batches_per_update > 1.
+        self._accum_grads = None # list of tf.vars
+        self._n_batches_accum_tfv = None
         
         ######## LR schedule specific ######
         # These are separated from the above, "Trainer" section, for future further modularization...
@@ -95,7 +102,8 @@ class Trainer(object):
         
         
     ############## All the logic wrt cost / regularizers should be done here ##############
-    def compute_costs(self, log, p_y_given_x): # Needs to be run with initialized self._num_epochs_trained_tfv
+    def compute_costs(self, log, p_y_given_x, logits, y_gt): # Needs to be run with initialized self._num_epochs_trained_tfv
+        # logits: Channels-last logits of p_y_given_x, as from cnn3d.apply(..., ret_logits=True). For cross entropy.
         if not self._total_cost is None:
             log.print3("ERROR: Problem in Trainer. It was called to setup the total cost, but it was not None."+\
                        "\n\t This should not happen. Setup should be called only once.\n Exiting!")
@@ -103,11 +111,10 @@ class Trainer(object):
         
         # Cost functions
         cost = 0
-        y_gt = self._net._output_gt_tensor_feeds['train']['y_gt']
         if "xentr" in self._losses_and_weights and self._losses_and_weights["xentr"] is not None:
             log.print3("COST: Using cross entropy with weight: " +str(self._losses_and_weights["xentr"]))
             w_per_cl_vec = self._compute_w_per_class_vector_for_xentr(self._net.num_classes, y_gt)
-            cost += self._losses_and_weights["xentr"] * cfs.x_entr(p_y_given_x, y_gt, w_per_cl_vec)
+            cost += self._losses_and_weights["xentr"] * cfs.x_entr(logits, y_gt, w_per_cl_vec)
         if "iou" in self._losses_and_weights and self._losses_and_weights["iou"] is not None:
             log.print3("COST: Using iou loss with weight: " +str(self._losses_and_weights["iou"]))
             cost += self._losses_and_weights["iou"] * cfs.iou(p_y_given_x, y_gt)
@@ -135,7 +142,8 @@ class Trainer(object):
                             b2ParamForAdam,
                             epsilonForAdam,
                             rhoParamForRmsProp,
-                            epsilonForRmsProp
+                            epsilonForRmsProp,
+                            fused_ops
                             ) :
         log.print3("...Initializing state of the optimizer...")
         
@@ -156,13 +164,15 @@ class Trainer(object):
                                                           self._curr_lr,
                                                           self._curr_mom,
                                                           momentumTypeNONNormalized0orNormalized1,
-                                                          classicMomentum0OrNesterov1 )
+                                                          classicMomentum0OrNesterov1,
+                                                          fused_ops )
         elif sgd0orAdam1orRmsProp2 == 1:
             self._optimizer = optimizers_dm.AdamOptimizer( params_to_opt,
                                                            self._curr_lr,
                                                            b1ParamForAdam,
                                                            b2ParamForAdam,
-                                                           epsilonForAdam )
+                                                           epsilonForAdam,
+                                                           fused_ops )
         elif sgd0orAdam1orRmsProp2 == 2:
             self._optimizer = optimizers_dm.RmsPropOptimizer( params_to_opt,
                                                               self._curr_lr,
@@ -170,7 +180,25 @@ class Trainer(object):
                                                               momentumTypeNONNormalized0orNormalized1,
                                                               classicMomentum0OrNesterov1,
                                                               rhoParamForRmsProp,
-                                                              epsilonForRmsProp  )
+                                                              epsilonForRmsProp,
+                                                              fused_ops )
+        
+        # Gradient accumulation. Local variables, so not saved. Accumulation starts anew in every session.
+        if self._n_batches_per_update > 1:
+            log.print3("Gradients will be accumulated over " + str(self._n_batches_per_update) + " batches per update.")
+            self._accum_grads = []
+            for param in params_to_opt:
+                self._accum_grads.append( tf.compat.v1.Variable( tf.zeros(param.shape, dtype="float32"), trainable=False,
+                                                                 collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES],
+                                                                 name="accum_grads" ) )
+            self._n_batches_accum_tfv = tf.compat.v1.Variable( 0, dtype="int32", trainable=False,
+                                                               collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES],
+                                                               name="n_batches_accum" )
+            # If the batches of a subepoch are not a multiple of n_batches_per_update, the last ones are left...
+            # ... accumulated. Run at the end of every subepoch, it updates with their mean, so none carry over.
+            self._op_flush_accum_grads = tf.cond( self._n_batches_accum_tfv > 0,
+                                                  lambda: self._make_op_update_with_mean_grads(self._n_batches_accum_tfv),
+                                                  tf.no_op )
         
 
         
@@ -181,8 +209,36 @@ class Trainer(object):
     # Called from within cnn3d.setup_ops_n_feeds_to_train()
     def get_param_updates_wrt_total_cost(self):
         # Excludes BN rolling average updates.
-        updates = self._optimizer.get_update_ops_given_cost( self.get_total_cost() ) # A list of assign ops. For cnn AND optimizer's params.
+        if self._n_batches_per_update == 1:
+            updates = self._optimizer.get_update_ops_given_cost( self.get_total_cost() ) # A list of assign ops. For cnn AND optimizer's params.
+        else:
+            grads = self._optimizer.get_grads_for_params_responsible( self.get_total_cost() )
+            updates = [ self._get_op_accum_grads_n_update(grads) ]
         return updates
+    
+    def _get_op_accum_grads_n_update(self, grads):
+        # Adds the grads of the batch to the accumulated. At the last batch of an update, the optimizer is given...
+        # ... their mean, as if computed on one batch with all of them. Its state (momentum, Adam's) advances per update.
+        ops_accum = [ tf.compat.v1.assign_add(accum, grad) for accum, grad in zip(self._accum_grads, grads) ]
+        with tf.control_dependencies(ops_accum):
+            n_batches_accum = tf.compat.v1.assign_add(self._n_batches_accum_tfv, 1)
+        
+        return tf.cond( tf.equal(n_batches_accum, self._n_batches_per_update),
+                        lambda: self._make_op_update_with_mean_grads(self._n_batches_per_update), tf.no_op )
+    
+    def _make_op_update_with_mean_grads(self, n_batches):
+        # Updates the params with the accumulated grads divided by n_batches (int or tensor), then resets the accumulation.
+        mean_grads = [ accum.read_value() / tf.cast(n_batches, "float32") for accum in self._accum_grads ]
+        updates = self._optimizer.get_update_ops_given_grads(mean_grads)
+        with tf.control_dependencies(updates):
+            ops_reset = [ tf.compat.v1.assign(accum, tf.zeros_like(accum)) for accum in self._accum_grads ]
+            ops_reset.append( tf.compat.v1.assign(self._n_batches_accum_tfv, 0) )
+        return tf.group(*ops_reset)
+    
+    def run_flush_accum_grads(self, sessionTf):
+        # At the end of a subepoch, updates with the gradients of batches left accumulated, if any.
+        if self._n_batches_per_update > 1:
+            sessionTf.run( self._op_flush_accum_grads )
         
     def get_num_epochs_trained_tfv(self):
         return self._num_epochs_trained_tfv
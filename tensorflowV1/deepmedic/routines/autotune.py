@@ -0,0 +1,124 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import time
+import numpy as np
+
+from deepmedic.routines.testing import prepare_feeds_dict, calc_bytes_per_inp_voxel
+from deepmedic.logging.utils import datetime_now_str
+
+
+def make_candidate_segment_dims(cnn3d, inp_dims_hr_path, scales=(0.5, 1., 1.5, 2., 3., 4.)):
+    # Candidate sizes of test segments, made by scaling the predicted output of the given segment.
+    # Predicted dims are kept multiples of the subsampling factors, so that low-res pathways align.
+    # Returns list of [r, c, z] input dims of the normal pathway. First is the given one.
+    outp_dims = cnn3d.calc_outp_dims_given_inp(inp_dims_hr_path)
+    n_unpred_vox = [inp_dims_hr_path[d] - outp_dims[d] for d in range(3)]
+    subs_factors = [pathway.subs_factor() for pathway in cnn3d.pathways]
+    multiple_per_axis = [int(np.lcm.reduce([int(factor[d]) for factor in subs_factors])) for d in range(3)]
+
+    candidates = [list(inp_dims_hr_path)]
+    for scale in scales:
+        outp_cand = [max(1, int(round(outp_dims[d] * scale / multiple_per_axis[d]))) * multiple_per_axis[d]
+                     for d in range(3)]
+        inp_cand = [n_unpred_vox[d] + outp_cand[d] for d in range(3)]
+        if inp_cand not in candidates:
+            candidates.append(inp_cand)
+    return candidates
+
+
+def benchmark_fwd_pass(sessionTf, cnn3d, inp_shapes_per_path, batchsize, n_reps):
+    # Time the forward pass of a batch of random segments. Requires test graph with dynamic dims.
+    # Returns average seconds per batch, excluding a first warm-up pass.
+    rng = np.random.RandomState(seed=0)
+    n_chans = cnn3d.pathways[0].get_n_fms_in()
+    channs_of_tiles_per_path = [rng.normal(size=[batchsize, n_chans] + list(inp_shape)).astype('float32')
+                                for inp_shape in inp_shapes_per_path[:1 + cnn3d.numSubsPaths]]
+    feeds_dict = prepare_feeds_dict(cnn3d.get_main_feeds('test'), channs_of_tiles_per_path)
+    op_pred_probs = cnn3d.get_main_ops('test')['pred_probs']
+
+    sessionTf.run(fetches=op_pred_probs, feed_dict=feeds_dict)  # Warm up.
+    t_start = time.time()
+    for _ in range(n_reps):
+        sessionTf.run(fetches=op_pred_probs, feed_dict=feeds_dict)
+    return (time.time() - t_start) / n_reps
+
+
+def autotune_test_segm_and_batchsize(log, sessionTf, cnn3d, inp_dims_hr_path, mem_budget_mb,
+                                     batchsizes=(1, 2, 4, 8, 16, 32, 64), n_reps=3):
+    # Benchmark candidate segment sizes and batch sizes on synthetic input, and find the fastest.
+    # Speed is measured in predicted voxels per second. Large segments waste less work on the unpredicted border,
+    # but need more memory per batch. Combinations estimated to need more than mem_budget_mb are skipped.
+    # inp_dims_hr_path: Segment size of the model, used as starting point for candidates.
+    # Returns: best_inp_dims, best_batchsize, best_vox_per_sec. Raises RuntimeError if no candidate fits in the budget.
+    log.print3("")
+    log.print3("=========== Autotuning segment size and batch size for inference ===========")
+    log.print3("Memory budget for the forward pass of a batch (MB) = " + str(mem_budget_mb))
+    bytes_per_inp_voxel = calc_bytes_per_inp_voxel(cnn3d)
+
+    best_inp_dims, best_batchsize, best_vox_per_sec = None, None, 0
+    for inp_dims in make_candidate_segment_dims(cnn3d, inp_dims_hr_path):
+        inp_shapes_per_path = cnn3d.calc_inp_dims_of_paths_from_hr_inp(inp_dims)
+        outp_dims = cnn3d.calc_outp_dims_given_inp(inp_dims)
+        unpred_margin = cnn3d.calc_unpredicted_margin(inp_dims)
+        n_vox_pred = int(np.prod(outp_dims))
+        border_work = 1. - n_vox_pred / np.prod(inp_dims)
+        log.print3("Segment " + str(inp_dims) + ", predicts " + str(list(outp_dims)) +
+                   ", unpredicted margin " + str(unpred_margin) +
+                   ", fraction of input voxels in the margin: " + "{0:.2f}".format(border_work))
+
+        vox_per_sec_prev_bs = 0
+        for batchsize in batchsizes:
+            est_mem_mb = batchsize * np.prod(inp_dims) * bytes_per_inp_voxel / (1024. * 1024.)
+            if mem_budget_mb is not None and est_mem_mb > mem_budget_mb:
+                log.print3("\t Batch size " + str(batchsize) + ": Skipped. Estimated memory " +
+                           "{0:.0f}".format(est_mem_mb) + " MB exceeds the budget.")
+                break
+            try:
+                t_batch = benchmark_fwd_pass(sessionTf, cnn3d, inp_shapes_per_path, batchsize, n_reps)
+            except Exception as e:  # eg out of memory on GPU.
+                log.print3("\t Batch size " + str(batchsize) + ": Failed with exception: " + str(e))
+                break
+            vox_per_sec = batchsize * n_vox_pred / t_batch
+            log.print3("\t Batch size " + str(batchsize) + ": " + "{0:.3f}".format(t_batch) + " secs per batch, " +
+                       "{0:.0f}".format(vox_per_sec) + " predicted voxels per sec. " +
+                       "Estimated memory " + "{0:.0f}".format(est_mem_mb) + " MB.")
+            if vox_per_sec > best_vox_per_sec:
+                best_inp_dims, best_batchsize, best_vox_per_sec = inp_dims, batchsize, vox_per_sec
+            if vox_per_sec < vox_per_sec_prev_bs:
+                break  # Larger batches will not help.
+            vox_per_sec_prev_bs = vox_per_sec
+
+    if best_inp_dims is None:
+        raise RuntimeError("No candidate segment size and batch size fit in the memory budget of " +
+                           str(mem_budget_mb) + " MB. Try a larger budget.")
+    log.print3("Fastest: Segment " + str(best_inp_dims) + " with batch size " + str(best_batchsize) + ", " +
+               "{0:.0f}".format(best_vox_per_sec) + " predicted voxels per sec.")
+    log.print3("============================================================================")
+    return best_inp_dims, best_batchsize, best_vox_per_sec
+
+
+def write_autotuned_test_cfg(log, abs_path_test_cfg, autotuned_prms, vox_per_sec):
+    # Write a copy of the test config, with the autotuned parameters appended so that they override the originals.
+    # Saved next to the original, so that relative paths in it remain valid.
+    # autotuned_prms: Dictionary. Keys are names of variables in the test config, with their autotuned values.
+    # Returns the path to the new config.
+    (path_no_ext, ext) = os.path.splitext(abs_path_test_cfg)
+    abs_path_autotuned_cfg = path_no_ext + "_autotuned" + ext
+    with open(abs_path_test_cfg, 'r') as f:
+        cfg_text = f.read()
+    with open(abs_path_autotuned_cfg, 'w') as f:
+        f.write(cfg_text)
+        f.write("\n\n# ============ Autotuned for inference speed (" + datetime_now_str() + ") ============\n")
+        f.write("# Measured " + "{0:.0f}".format(vox_per_sec) + " predicted voxels per sec.\n")
+        for key in autotuned_prms:
+            f.write(key + " = " + str(autotuned_prms[key]) + "\n")
+    log.print3("Wrote test config with autotuned parameters at: " + str(abs_path_autotuned_cfg))
+    return abs_path_autotuned_cfg
@@ -0,0 +1,214 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import numpy as np
+
+import tensorflow as tf
+
+from deepmedic.neuralnet.layers import DropoutLayer, PreluLayer
+import deepmedic.neuralnet.ops as ops
+
+# Name of the output of the frozen graph. Its inputs are named as the keys of Cnn3d's feeds for testing (x, x_sub_0...).
+NAME_OUTP_FROZEN = "pred_probs"
+
+
+#################################################################
+#        Folding parameters of the net for inference            #
+#################################################################
+# Blocks apply: [BN or bias] -> activation -> dropout -> pooling -> conv
+# At inference, BN and bias are an affine per channel. If the input of a block is only the output of the conv of the
+# previous block, the affine is folded into the conv's weights and a bias on its output. Otherwise, eg when the conv's
+# output is also added by a residual connection, the affine is kept but applied as one multiply-add.
+# Dropout at inference scales the input of the conv, so it is folded into the conv's weights.
+# Convs made of several weights (eg depthwise separable) fold the input scale only in the weights applied on the input,
+# and the affine only in the weights that give the output channels.
+
+def _scale_outp_chans(ws, scale):
+    # ws: List of weights of a conv layer, each [fms_out_of_w, fms_in, r, c, z]. Outputs of all ws are concatenated.
+    splits = np.cumsum([w.shape[0] for w in ws])[:-1]
+    return [w * np.reshape(scale_w, [-1, 1, 1, 1, 1]) for w, scale_w in zip(ws, np.split(scale, splits))]
+
+
+def _fold_affine_into_conv(folded_block_prev, scale, shift):
+    inds_ws_outp = folded_block_prev['inds_ws_outp']
+    ws_scaled = _scale_outp_chans([folded_block_prev['ws'][w_i] for w_i in inds_ws_outp], scale)
+    for w_i, w in zip(inds_ws_outp, ws_scaled):
+        folded_block_prev['ws'][w_i] = w
+    b_out = folded_block_prev['b_out'] if folded_block_prev['b_out'] is not None else 0.
+    folded_block_prev['b_out'] = b_out * scale + shift
+
+
+def fold_params_for_inference(sessionTf, cnn3d):
+    # Returns: folded params per pathway, per block. List of lists of dictionaries with numpy arrays:
+    #          'scale', 'shift': Affine on the input of the block. None if folded in the previous conv.
+    #          'prelu_a': Slope of PReLU, or None if other activation.
+    #          'ws': Weights of the conv, as from its trainable_params().
+    #          'inds_ws_outp': Indices in 'ws' of the weights that give the output channels of the conv.
+    #          'b_out': Bias to add to the output of the conv, or None.
+    folded_per_path = []
+    for pathway in cnn3d.pathways:
+        folded_blocks = []
+        for block in pathway.get_blocks():
+            layers = block.get_layers()
+            (scale, shift) = sessionTf.run(layers[0].get_inference_affine())  # BN or bias, always first.
+            conv_l = layers[-1]  # Conv, always last.
+            ws = sessionTf.run(conv_l.trainable_params())
+            prelu_a = None
+            for layer in layers[1:-1]:
+                if isinstance(layer, DropoutLayer):
+                    ws = [w * layer.get_inference_scale() if w_i in conv_l.inds_of_ws_on_inp() else w
+                          for w_i, w in enumerate(ws)]
+                elif isinstance(layer, PreluLayer):
+                    prelu_a = sessionTf.run(layer.trainable_params()[0])
+            folded_blocks.append({'scale': scale.astype('float64'), 'shift': shift.astype('float64'),
+                                  'prelu_a': prelu_a, 'ws': [w.astype('float64') for w in ws],
+                                  'inds_ws_outp': conv_l.inds_of_ws_to_outp(), 'b_out': None})
+        folded_per_path.append(folded_blocks)
+
+    # Within each pathway.
+    for pathway, folded_blocks in zip(cnn3d.pathways, folded_per_path):
+        inds_res = pathway.inds_of_blocks_for_res_conns_at_out()
+        for block_i in range(1, len(folded_blocks)):
+            # Output of previous block must be its conv, and not also feed a residual connection of the next block.
+            if (block_i - 1) not in inds_res and (block_i + 1) not in inds_res:
+                _fold_affine_into_conv(folded_blocks[block_i - 1],
+                                       folded_blocks[block_i]['scale'], folded_blocks[block_i]['shift'])
+                folded_blocks[block_i]['scale'], folded_blocks[block_i]['shift'] = None, None
+
+    # Input of the FC pathway: Concatenated (upsampled) outputs of the other pathways. Upsampling is by repetition.
+    fc_pathway, folded_fc = cnn3d.pathways[-1], folded_per_path[-1]
+    if 1 not in fc_pathway.inds_of_blocks_for_res_conns_at_out() and \
+            np.all([(len(pathway.get_blocks()) - 1) not in pathway.inds_of_blocks_for_res_conns_at_out()
+                    for pathway in cnn3d.pathways[:-1]]):
+        splits = np.cumsum([pathway.get_n_fms_out() for pathway in cnn3d.pathways[:-1]])[:-1]
+        for folded_blocks, scale, shift in zip(folded_per_path[:-1],
+                                               np.split(folded_fc[0]['scale'], splits),
+                                               np.split(folded_fc[0]['shift'], splits)):
+            _fold_affine_into_conv(folded_blocks[-1], scale, shift)
+        folded_fc[0]['scale'], folded_fc[0]['shift'] = None, None
+
+    # Bias of the softmax. Added to output of the last conv, so also valid if a residual connection is added to it.
+    b_softmax = sessionTf.run(cnn3d.finalTargetLayer.trainable_params()[0]).astype('float64')
+    _fold_affine_into_conv(folded_fc[-1], np.ones(b_softmax.shape), b_softmax)
+
+    return folded_per_path
+
+
+#################################################################
+#               Graph with the folded parameters                #
+#################################################################
+
+def _const_per_chan(vals):
+    # Broadcasts over the channels of channels-last activations.
+    return tf.constant(np.reshape(vals, [1, 1, 1, 1, -1]), dtype="float32")
+
+
+def _apply_folded_block(block, folded_block, input):
+    signal = input
+    if folded_block['scale'] is not None:
+        if np.all(folded_block['scale'] == 1.):  # Bias layer.
+            signal = signal + _const_per_chan(folded_block['shift'])
+        else:
+            signal = signal * _const_per_chan(folded_block['scale']) + _const_per_chan(folded_block['shift'])
+    layers = block.get_layers()
+    for layer in layers[1:-1]:
+        if isinstance(layer, DropoutLayer):
+            pass  # Folded in the conv.
+        elif isinstance(layer, PreluLayer) and np.all(folded_block['prelu_a'] >= 0.) and np.all(folded_block['prelu_a'] <= 1.):
+            signal = tf.maximum(signal, signal * _const_per_chan(folded_block['prelu_a']))  # Equals prelu for 0<=a<=1.
+        elif isinstance(layer, PreluLayer):
+            signal = ops.prelu(signal, _const_per_chan(folded_block['prelu_a']))
+        else:
+            signal = layer.apply(signal, "infer")
+    signal = layers[-1].apply_with_weights(signal, [tf.constant(w, dtype="float32") for w in folded_block['ws']])
+    if folded_block['b_out'] is not None:
+        signal = signal + _const_per_chan(folded_block['b_out'])
+    return signal
+
+
+def _apply_folded_pathway(pathway, folded_blocks, input):
+    # As Pathway.apply(), with the folded parameters.
+    inds_res = pathway.inds_of_blocks_for_res_conns_at_out()
+    input_to_prev_layer = None
+    input_to_next_layer = input
+    for idx, (block, folded_block) in enumerate(zip(pathway.get_blocks(), folded_blocks)):
+        out = _apply_folded_block(block, folded_block, input_to_next_layer)
+        if idx not in inds_res:
+            input_to_prev_layer = input_to_next_layer
+            input_to_next_layer = out
+        else:
+            out_res = ops.make_residual_connection(input_to_prev_layer, out)
+            input_to_prev_layer = input_to_next_layer
+            input_to_next_layer = out_res
+    return input_to_next_layer
+
+
+def make_frozen_inference_graph_def(cnn3d, folded_per_path):
+    # Graph with only the forward pass of testing, with parameters as constants. Spatial dims of inputs are dynamic.
+    # As Cnn3d.apply(), with the folded parameters. Inputs and output are channels-first, as of Cnn3d.
+    # Returns: GraphDef
+    graphTf = tf.Graph()
+    with graphTf.as_default():
+        n_chans = cnn3d.pathways[0].get_n_fms_in()
+        input = tf.compat.v1.placeholder(dtype="float32", shape=[None, n_chans, None, None, None], name="x")
+        out = _apply_folded_pathway(cnn3d.pathways[0], folded_per_path[0], ops.to_channels_last(input))
+        fms_from_paths_to_concat = [out]
+        for subpath_i in range(cnn3d.numSubsPaths):
+            input = tf.compat.v1.placeholder(dtype="float32", shape=[None, n_chans, None, None, None],
+                                             name="x_sub_" + str(subpath_i))
+            this_pathway = cnn3d.pathways[subpath_i + 1]
+            out_lr = _apply_folded_pathway(this_pathway, folded_per_path[subpath_i + 1], ops.to_channels_last(input))
+            fms_from_paths_to_concat.append(this_pathway.upsample_to_high_res(out_lr, shape_to_match=tf.shape(out),
+                                                                              upsampl_type="repeat"))
+        conc_inp_fms = tf.concat(fms_from_paths_to_concat, axis=4)
+        logits = _apply_folded_pathway(cnn3d.pathways[-1], folded_per_path[-1], conc_inp_fms)  # Softmax bias folded.
+        temperature = cnn3d.finalTargetLayer.get_temperature()
+        logits = logits / temperature if temperature != 1 else logits
+        ops.to_channels_first(tf.nn.softmax(logits, axis=-1), name=NAME_OUTP_FROZEN)
+    # Keep only what the output needs.
+    return tf.compat.v1.graph_util.extract_sub_graph(graphTf.as_graph_def(), [NAME_OUTP_FROZEN])
+
+
+def export_frozen_inference_graph(log, sessionTf, cnn3d, filepath):
+    # Write an inference-only graph of the model, with its current parameters, to a binary GraphDef file.
+    # It can be given to testing via the test config, instead of a checkpoint.
+    log.print3("")
+    log.print3("=========== Exporting frozen graph for inference ===============")
+    folded_per_path = fold_params_for_inference(sessionTf, cnn3d)
+    for pathway, folded_blocks in zip(cnn3d.pathways, folded_per_path):
+        log.print3("[Pathway_" + str(pathway.getStringType()) + "] Blocks with BN/bias folded in the previous conv: " +
+                   str([block_i for block_i in range(len(folded_blocks)) if folded_blocks[block_i]['scale'] is None]))
+    graph_def = make_frozen_inference_graph_def(cnn3d, folded_per_path)
+    tf.io.write_graph(graph_def, os.path.dirname(filepath), os.path.basename(filepath), as_text=False)
+    log.print3("Frozen graph with " + str(len(graph_def.node)) + " nodes was saved at: " + str(filepath))
+    log.print3("================================================================")
+
+
+def load_frozen_inference_graph_def(log, filepath):
+    log.print3("=========== Loading frozen graph for inference ===============")
+    log.print3("Loading frozen graph from: " + str(filepath))
+    graph_def = tf.compat.v1.GraphDef()
+    with tf.io.gfile.GFile(filepath, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def import_frozen_inference_graph(log, graph_def, inp_plchldrs):
+    # Import the frozen graph in the current graph, fed by the given input placeholders (as from create_inp_plchldrs).
+    # Returns: Tensor with the predicted probabilities, same as Cnn3d.apply()
+    try:
+        (p_y_given_x,) = tf.import_graph_def(graph_def,
+                                             input_map={key + ":0": inp_plchldrs[key] for key in inp_plchldrs},
+                                             return_elements=[NAME_OUTP_FROZEN + ":0"],
+                                             name="frozen")
+    except ValueError as e:
+        log.print3("ERROR: Frozen graph does not match the inputs of the model in the model config: " + str(e) +
+                   "\n\t Was it exported from another model? Exiting."); exit(1)
+    return p_y_given_x
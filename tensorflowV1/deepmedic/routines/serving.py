@@ -0,0 +1,334 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import io
+import os
+import json
+import time
+import threading
+import traceback
+import numpy as np
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+
+from deepmedic.logging.accuracyMonitor import AccuracyMonitorForEpSegm
+from deepmedic.dataManagement.io import makeFilepathForSavingPred, saveImgToNiiWithAffine
+from deepmedic.dataManagement.preprocessing import paste_crop_in_3d_img
+from deepmedic.dataManagement.sampling import calc_context_of_subsampl_segments
+from deepmedic.routines.testing import load_and_preproc_subject, preproc_subject, predict_whole_volume, \
+    postproc_save_and_eval_subject, unpad_img, calc_seg_from_prob_maps
+
+# Subjects that are loaded, predicted or saved at the same time. As when pipelined, only one is predicted at a time.
+MAX_JOBS_IN_FLIGHT = 3
+
+
+class InvalidRequestError(Exception):
+    # A request that is malformed. Replied with 400. Any other failure is replied with 500.
+    pass
+
+
+class SegmentationServer(ThreadingMixIn, HTTPServer):
+    # Keeps the graph and weights of a model loaded in a TF session, and segments subjects on request.
+    # Each request is handled in its own thread. Loading, pre-processing and saving of different requests overlap,
+    # while the forward passes are queued, one subject at a time, as the graph and session are shared.
+    # Endpoints:
+    # GET  /health         : JSON with the number of classes and the jobs waiting.
+    # POST /segment        : JSON {"channels": [paths to nii, one per channel], "roi_mask": path or null,
+    #                              "output": file name to save predictions with, or null}.
+    #                        Predictions are saved as when testing, in out_folder_preds. Returns JSON with their paths and the timing.
+    # POST /segment_arrays : npz with "channels" [channels, r, c, z], optionally "roi_mask" [r, c, z], "affine" [4, 4]
+    #                        and "output" (file name). Returns npz with "segmentation" [r, c, z] (and "affine", if given).
+    #                        If "output" is given, the segmentation is also saved in out_folder_preds, with the affine.
+    #                        Timing and paths of saved predictions in headers.
+    daemon_threads = True
+
+    def __init__(self, log, host, port, sessionTf, cnn3d, inp_shapes_per_path, out_folder_preds,
+                 savePredictedSegmAndProbsDict, suffixForSegmAndProbsDict,
+                 batchsize, run_input_checks, pad_input, norm_prms, infer_prms):
+        HTTPServer.__init__(self, (host, port), SegmentationRequestHandler)
+        self.log = log
+        self.sessionTf = sessionTf
+        self.cnn3d = cnn3d
+        self.inp_shapes_per_path = inp_shapes_per_path
+        self.unpred_margin = cnn3d.calc_unpredicted_margin(inp_shapes_per_path[0])
+        self.tile_outp_dims = cnn3d.calc_outp_dims_given_inp(inp_shapes_per_path[0])
+        self.tile_context = calc_context_of_subsampl_segments(cnn3d, inp_shapes_per_path[0])
+        self.out_folder_preds = out_folder_preds
+        self.savePredictedSegmAndProbsDict = savePredictedSegmAndProbsDict
+        self.suffixForSegmAndProbsDict = suffixForSegmAndProbsDict
+        self.batchsize = batchsize
+        self.run_input_checks = run_input_checks
+        self.pad_input = pad_input
+        self.norm_prms = norm_prms
+        self.infer_prms = infer_prms
+
+        self._lock_predict = threading.Lock()  # One forward pass over a subject at a time.
+        self._sem_jobs = threading.BoundedSemaphore(MAX_JOBS_IN_FLIGHT)
+        self._lock_counters = threading.Lock()
+        self._n_jobs = 0
+        self._n_jobs_waiting = 0
+
+    def _new_job_id(self):
+        with self._lock_counters:
+            job_id = self._n_jobs
+            self._n_jobs += 1
+            self._n_jobs_waiting += 1
+        return job_id
+
+    def get_n_jobs_waiting(self):
+        return self._n_jobs_waiting
+
+    def make_path_for_saving(self, name_for_saving):
+        # Predictions are saved only in out_folder_preds. name_for_saving: A file name given by a client, not a path.
+        if not isinstance(name_for_saving, str) or name_for_saving in ["", "."] or ".." in name_for_saving \
+                or "/" in name_for_saving or "\\" in name_for_saving:
+            raise InvalidRequestError("Output should be a file name, without path separators or \"..\". " +
+                                      "Predictions are saved in the output folder of the session. Given: " + str(name_for_saving))
+        return os.path.join(self.out_folder_preds, name_for_saving)
+
+    def _predict(self, channels, roi_mask, border_int_per_chan, timing):
+        # Queue for the session. Returns: prob_maps_vols, pred_seg, max_prob_vol
+        t_start = time.time()
+        with self._lock_predict:
+            timing['wait_for_predict'] = time.time() - t_start
+            t_start = time.time()
+            (prob_maps_vols,
+             _,
+             pred_seg,
+             max_prob_vol) = predict_whole_volume(self.log, self.sessionTf, self.cnn3d,
+                                                  channels, roi_mask, self.inp_shapes_per_path, self.unpred_margin,
+                                                  self.batchsize, False, None, self.infer_prms,
+                                                  border_int_per_chan)
+            timing['predict'] = time.time() - t_start
+        return prob_maps_vols, pred_seg, max_prob_vol
+
+    def segment_files(self, paths_per_chan, path_to_roi_mask, name_for_saving):
+        # Segment a subject given as nii files, and save the predictions as in testing.
+        # name_for_saving: Path in out_folder_preds (see make_path_for_saving), or None for a name from the job's id.
+        # Returns: dictionary with the paths to the saved predictions and the timing of each step in secs.
+        job_id = self._new_job_id()
+        timing = {}
+        t_job_start = time.time()
+        with self._sem_jobs:
+            with self._lock_counters:
+                self._n_jobs_waiting -= 1
+            timing['wait_for_slot'] = time.time() - t_job_start
+            if name_for_saving is None:
+                name_for_saving = self.out_folder_preds + "/job" + str(job_id) + ".nii.gz"
+            self.log.print3("SERVER: Job #" + str(job_id) + ": Segmenting subject with 1st channel at: " +
+                            str(paths_per_chan[0]))
+
+            t_start = time.time()
+            (channels,
+             _,
+             roi_mask,
+             pad_left_right_per_axis,
+             crop_coords,
+             full_dims,
+             border_int_per_chan) = load_and_preproc_subject(0, self.log,
+                                                   [paths_per_chan], None,
+                                                   [path_to_roi_mask] if path_to_roi_mask is not None else None,
+                                                   self.run_input_checks, self.cnn3d.num_classes, self.pad_input,
+                                                   self.unpred_margin, self.norm_prms,
+                                                   self.infer_prms['crop_to_roi'], self.tile_outp_dims,
+                                                   self.tile_context)
+            timing['load_and_preproc'] = time.time() - t_start
+
+            (prob_maps_vols,
+             pred_seg,
+             max_prob_vol) = self._predict(channels, roi_mask, border_int_per_chan, timing)
+            del channels
+
+            t_start = time.time()
+            metrics_dummy = {"dice1": [[-1]], "dice2": [[-1]], "dice3": [[-1]]}  # No GT. Not evaluated.
+            postproc_save_and_eval_subject(self.log, self.cnn3d, 0,
+                                           prob_maps_vols, None, pred_seg, max_prob_vol, None, roi_mask,
+                                           self.pad_input, pad_left_right_per_axis, crop_coords, full_dims,
+                                           self.savePredictedSegmAndProbsDict, self.suffixForSegmAndProbsDict,
+                                           [name_for_saving], [paths_per_chan],
+                                           False, None, None,
+                                           None, metrics_dummy, AccuracyMonitorForEpSegm.NA_PATTERN, "Serving",
+                                           self.infer_prms['memmap_dir'])
+            timing['postproc_and_save'] = time.time() - t_start
+        timing['total'] = time.time() - t_job_start
+        self.log_timing(job_id, timing)
+
+        outputs = {}
+        if self.savePredictedSegmAndProbsDict["segm"]:
+            outputs["segm"] = makeFilepathForSavingPred(name_for_saving, self.suffixForSegmAndProbsDict["segm"])
+        return {"job": job_id, "outputs": outputs, "timing_secs": timing}
+
+    def segment_arrays(self, channels, roi_mask, affine=None, name_for_saving=None):
+        # Segment a subject given as arrays. channels: [channels, r, c, z]. roi_mask: None or [r, c, z].
+        # affine: None or [4, 4], voxel to world coordinates of the arrays, to save the segmentation with.
+        # name_for_saving: Path in out_folder_preds (see make_path_for_saving) to save the segmentation, or None.
+        # Returns: the segmentation [r, c, z] as int16, masked by the ROI, dictionary with the path to the saved...
+        # ... segmentation (if saved), and the timing of each step in secs.
+        job_id = self._new_job_id()
+        timing = {}
+        t_job_start = time.time()
+        with self._sem_jobs:
+            with self._lock_counters:
+                self._n_jobs_waiting -= 1
+            timing['wait_for_slot'] = time.time() - t_job_start
+            self.log.print3("SERVER: Job #" + str(job_id) + ": Segmenting subject given as arrays of shape " +
+                            str(list(channels.shape)))
+
+            t_start = time.time()
+            (channels,
+             _,
+             roi_mask,
+             pad_left_right_per_axis,
+             crop_coords,
+             full_dims,
+             border_int_per_chan) = preproc_subject(self.log, channels, None, roi_mask,
+                                          self.run_input_checks, self.cnn3d.num_classes, self.pad_input,
+                                          self.unpred_margin, self.norm_prms,
+                                          self.infer_prms['crop_to_roi'], self.tile_outp_dims,
+                                          self.tile_context)
+            timing['load_and_preproc'] = time.time() - t_start
+
+            (prob_maps_vols,
+             pred_seg,
+             _) = self._predict(channels, roi_mask, border_int_per_chan, timing)
+            del channels
+
+            t_start = time.time()
+            if pred_seg is None:
+                pred_seg = calc_seg_from_prob_maps(prob_maps_vols, None)  # Returned in RAM.
+            del prob_maps_vols
+            pred_seg = unpad_img(pred_seg, self.pad_input, pad_left_right_per_axis)
+            roi_mask = unpad_img(roi_mask, self.pad_input, pad_left_right_per_axis)
+            pred_seg = pred_seg.astype("int16") if roi_mask is None else (pred_seg * (roi_mask > 0)).astype("int16")
+            pred_seg = paste_crop_in_3d_img(pred_seg, crop_coords, full_dims)
+            outputs = {}
+            if name_for_saving is not None:
+                outputs["segm"] = makeFilepathForSavingPred(name_for_saving, self.suffixForSegmAndProbsDict["segm"])
+                saveImgToNiiWithAffine(pred_seg, outputs["segm"], affine, np.dtype(np.int16), self.log)
+            timing['postproc_and_save'] = time.time() - t_start
+        timing['total'] = time.time() - t_job_start
+        self.log_timing(job_id, timing)
+
+        return pred_seg, outputs, timing
+
+    def log_timing(self, job_id, timing):
+        self.log.print3("SERVER: TIMING: Job #" + str(job_id) + " finished in {0:.2f}".format(timing['total']) +
+                        " secs. [Waiting: {0:.2f}".format(timing['wait_for_slot'] + timing['wait_for_predict']) +
+                        ", Loading and pre-processing: {0:.2f}".format(timing['load_and_preproc']) +
+                        ", Prediction: {0:.2f}".format(timing['predict']) +
+                        ", Post-processing and saving: {0:.2f}".format(timing['postproc_and_save']) + "]")
+
+
+class SegmentationRequestHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, body, content_type, extra_headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key in (extra_headers if extra_headers is not None else {}):
+            self.send_header(key, extra_headers[key])
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply_json(self, code, dict_to_send):
+        self._reply(code, json.dumps(dict_to_send).encode("utf-8"), "application/json")
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply_json(200, {"status": "ok",
+                                   "n_classes": self.server.cnn3d.num_classes,
+                                   "n_jobs_waiting": self.server.get_n_jobs_waiting()})
+        else:
+            self._reply_json(404, {"error": "Unknown endpoint: " + str(self.path)})
+
+    def _read_job_json(self):
+        # Returns: paths_per_chan, path_to_roi_mask, name_for_saving (path in out_folder_preds or None)
+        try:
+            job = json.loads(self._read_body().decode("utf-8"))
+        except ValueError as e:
+            raise InvalidRequestError("Body should be JSON: " + str(e))
+        if not isinstance(job, dict) or not isinstance(job.get("channels"), list) or len(job["channels"]) == 0 \
+                or not all([isinstance(path, str) for path in job["channels"]]) \
+                or not isinstance(job.get("roi_mask", ""), (str, type(None))):
+            raise InvalidRequestError("JSON should have \"channels\" (list of paths), and optionally \"roi_mask\" (path).")
+        paths_per_chan = [os.path.abspath(path) for path in job["channels"]]
+        path_to_roi_mask = os.path.abspath(job["roi_mask"]) if job.get("roi_mask") is not None else None
+        name_for_saving = self.server.make_path_for_saving(job["output"]) if job.get("output") is not None else None
+        return paths_per_chan, path_to_roi_mask, name_for_saving
+
+    def _read_job_npz(self):
+        # Returns: channels, roi_mask, affine, name_for_saving (path in out_folder_preds or None)
+        try:
+            arrays = np.load(io.BytesIO(self._read_body()), allow_pickle=False)
+            channels = np.asarray(arrays["channels"], dtype="float32")
+            roi_mask = arrays["roi_mask"] if "roi_mask" in arrays.files else None
+            affine = np.asarray(arrays["affine"], dtype="float64") if "affine" in arrays.files else None
+            name = str(arrays["output"]) if "output" in arrays.files else None
+        except Exception as e:
+            raise InvalidRequestError("Body should be an npz with array \"channels\": " + str(e))
+        if channels.ndim != 4:
+            raise InvalidRequestError("Array [channels] should have 4 dimensions, [channels, r, c, z]. " +
+                                      "Given shape: " + str(list(channels.shape)))
+        if roi_mask is not None and list(roi_mask.shape) != list(channels.shape[1:]):
+            raise InvalidRequestError("Array [roi_mask] should have shape " + str(list(channels.shape[1:])) +
+                                      ". Given shape: " + str(list(roi_mask.shape)))
+        if affine is not None and (affine.shape != (4, 4) or not np.all(np.isfinite(affine))):
+            raise InvalidRequestError("Array [affine] should be a 4x4 matrix of finite numbers.")
+        name_for_saving = self.server.make_path_for_saving(name) if name is not None else None
+        return channels, roi_mask, affine, name_for_saving
+
+    def do_POST(self):
+        try:
+            if self.path == "/segment":
+                (paths_per_chan, path_to_roi_mask, name_for_saving) = self._read_job_json()
+                self._reply_json(200, self.server.segment_files(paths_per_chan, path_to_roi_mask, name_for_saving))
+            elif self.path == "/segment_arrays":
+                (channels, roi_mask, affine, name_for_saving) = self._read_job_npz()
+                (pred_seg, outputs, timing) = self.server.segment_arrays(channels, roi_mask, affine, name_for_saving)
+                arrays_to_send = {"segmentation": pred_seg}
+                if affine is not None:
+                    arrays_to_send["affine"] = affine
+                buffer = io.BytesIO()
+                np.savez_compressed(buffer, **arrays_to_send)
+                self._reply(200, buffer.getvalue(), "application/octet-stream",
+                            {"X-Timing-Secs": json.dumps(timing), "X-Outputs": json.dumps(outputs)})
+            else:
+                self._reply_json(404, {"error": "Unknown endpoint: " + str(self.path)})
+        except InvalidRequestError as e:
+            self.server.log.print3("SERVER: ERROR: Invalid request: " + str(e))
+            self._reply_json(400, {"error": str(e)})
+        except Exception as e:
+            self.server.log.print3("SERVER: ERROR: Request failed with exception: " + str(e))
+            self.server.log.print3(traceback.format_exc())
+            self._reply_json(500, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        self.server.log.print3("SERVER: " + self.address_string() + " " + (format % args))
+
+
+def serve_segmentation(log, sessionTf, cnn3d, inp_shapes_per_path, port, out_folder_preds,
+                       savePredictedSegmAndProbsDict, suffixForSegmAndProbsDict,
+                       batchsize, run_input_checks, pad_input, norm_prms, infer_prms, host="127.0.0.1"):
+    # Serve segmentation requests until interrupted. The model must have been loaded in sessionTf.
+    server = SegmentationServer(log, host, port, sessionTf, cnn3d, inp_shapes_per_path, out_folder_preds,
+                                savePredictedSegmAndProbsDict, suffixForSegmAndProbsDict,
+                                batchsize, run_input_checks, pad_input, norm_prms, infer_prms)
+    log.print3("")
+    log.print3("=========== Serving segmentation requests at http://" + str(host) + ":" + str(port) + " ===========")
+    log.print3("Endpoints: POST /segment (json), POST /segment_arrays (npz), GET /health. Stop with Ctrl+C.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.print3("Server interrupted.")
+    finally:
+        server.server_close()
+    log.print3("=========== Server stopped ===========")
@@ -10,18 +10,53 @@ from __future__ import absolute_import, print_function, division
 import time
 import numpy as np
 import math
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 from deepmedic.logging.accuracyMonitor import AccuracyMonitorForEpSegm
 from deepmedic.dataManagement.sampling import load_imgs_of_subject, preproc_imgs_of_subj
 from deepmedic.dataManagement.sampling import get_slice_coords_of_all_img_tiles
-from deepmedic.dataManagement.sampling import extractSegmentsGivenSliceCoords
+from deepmedic.dataManagement.sampling import extractSegmentsGivenSliceCoords, check_gt_vs_num_classes
+from deepmedic.dataManagement.sampling import calc_context_of_subsampl_segments
 from deepmedic.dataManagement.io import savePredImgToNiiWithOriginalHdr, saveFmImgToNiiWithOriginalHdr, \
     save4DImgWithAllFmsToNiiWithOriginalHdr
-from deepmedic.dataManagement.preprocessing import unpad_3d_img
+from deepmedic.dataManagement.preprocessing import unpad_3d_img, calc_crop_coords_of_roi, crop_3d_img, \
+    paste_crop_in_3d_img, calc_border_int_of_3d_img
 from deepmedic.neuralnet.pathwayTypes import PathwayTypes as pt
 from deepmedic.logging.utils import strListFl4fNA, getMeanPerColOf2dListExclNA, print_progress_step_test
 
 
+# When shapes are bucketed, slabs have a multiple of this many tiles per axis. Bigger gives fewer different shapes...
+# ... for XLA to compile, but more voxels of padding to predict.
+N_TILES_PER_SLAB_BUCKET = 4
+
+
+def warmup_compiled_test_op(log, sessionTf, cnn3d, inp_shapes_per_path, batchsize):
+    # XLA compiles the forward pass at its first run for each shape of input. Run it on a dummy batch, so that...
+    # ... compilation is not part of the timing of the first subject.
+    # If made (xla_time_uncompiled), the same forward pass uncompiled is timed on the same batch, to report the speedup by XLA.
+    # inp_shapes_per_path: Input dims per pathway of the tiles that will be segmented.
+    n_chans = cnn3d.pathways[0].get_n_fms_in()
+    channs_of_tiles_per_path = [[np.zeros([n_chans] + list(inp_shape), dtype="float32")] * batchsize
+                                for inp_shape in inp_shapes_per_path[:cnn3d.getNumPathwaysThatRequireInput()]]
+    feeds_dict = prepare_feeds_dict(cnn3d.get_main_feeds('test'), channs_of_tiles_per_path)
+    times = []
+    for _ in range(3):  # Shapes after the first may compile at their second run.
+        start_time = time.time()
+        sessionTf.run(fetches=cnn3d.get_main_ops('test')['pred_probs'], feed_dict=feeds_dict)
+        times.append(time.time() - start_time)
+    log.print3("TIMING: Warm-up of compiled (XLA) forward pass on a dummy batch: First runs (incl. compilation) " +
+               "{0:.2f}".format(sum(times[:-1])) + " secs. Then " + "{0:.3f}".format(times[-1]) + " secs.")
+    op_uncompiled = cnn3d.get_main_ops('test')['pred_probs_uncompiled']
+    if op_uncompiled is not None:
+        times_uncompiled = []
+        for _ in range(2):  # The first run also sets up the kernels.
+            start_time = time.time()
+            sessionTf.run(fetches=op_uncompiled, feed_dict=feeds_dict)
+            times_uncompiled.append(time.time() - start_time)
+        log.print3("TIMING: Same forward pass not compiled: " + "{0:.3f}".format(times_uncompiled[-1]) + " secs. " +
+                   "Speedup by XLA: x" + "{0:.2f}".format(times_uncompiled[-1] / max(times[-1], 1e-9)))
+
 
 def calc_num_fms_to_save(cnn_pathways, fm_idxs):
     fm_num = 0
@@ -39,27 +74,55 @@ def calc_num_fms_to_save(cnn_pathways, fm_idxs):
     return fm_num
 
 
+def calc_idxs_of_tiles_in_vol(slice_coords_of_tiles, unpred_margin, stride):
+    # Index arrays that place the central (predicted) part of each tile in the whole volume, all tiles at once.
+    # slice_coords_of_tiles: list of tiles, each [[r_low, r_high], [c_low, c_high], [z_low, z_high]]
+    # Returns: (r, c, z) index arrays, of shapes [n_tiles, str-r, 1, 1], [n_tiles, 1, str-c, 1], [n_tiles, 1, 1, str-z]
+    #          They broadcast together to [n_tiles, str-r, str-c, str-z], the shape of the predicted part of a batch.
+    top_left = np.asarray(slice_coords_of_tiles, dtype="int64")[:, :, 0]  # [n_tiles, 3]
+    idxs_per_axis = []
+    for axis in range(3):
+        idxs_axis = top_left[:, axis:axis + 1] + unpred_margin[axis][0] + np.arange(stride[axis])  # [n_tiles, str]
+        shape_axis = [len(top_left), 1, 1, 1]
+        shape_axis[axis + 1] = stride[axis]
+        idxs_per_axis.append(idxs_axis.reshape(shape_axis))
+    return tuple(idxs_per_axis)
+
+
 def stitch_predicted_to_prob_maps(prob_maps_per_class, idx_next_tile_in_pred_vols, 
                                   prob_maps_batch, batch_size, slice_coords, unpred_margin, stride):
     # prob_maps_per_class: The whole volume that is going to be the final output of the system.
     # prob_maps_batch: the predictions of the cnn for tiles/segments in a batch. Must be stitched together.
 
-    for tile_i in range(batch_size):
-        # Now put the label-cube in the new-label-segmentation-image, at the correct position.
-        # The very first label goes not in index 0,0,0 but half-patch further away!
-        # At the position of the central voxel of the top-left patch!
-        slice_coords_tile = slice_coords[idx_next_tile_in_pred_vols]
-        top_left = [slice_coords_tile[0][0], slice_coords_tile[1][0], slice_coords_tile[2][0]]
-        prob_maps_per_class[:,
-                            top_left[0] + unpred_margin[0][0]: top_left[0] + unpred_margin[0][0] + stride[0],
-                            top_left[1] + unpred_margin[1][0]: top_left[1] + unpred_margin[1][0] + stride[1],
-                            top_left[2] + unpred_margin[2][0]: top_left[2] + unpred_margin[2][0] + stride[2]
-                            ] = prob_maps_batch[tile_i]
-        idx_next_tile_in_pred_vols += 1
+    # Put the label-cubes of all tiles in the batch in the whole volume, at the correct position, with one scatter.
+    # The very first label goes not in index 0,0,0 but half-patch further away!
+    # At the position of the central voxel of the top-left patch!
+    slice_coords_batch = slice_coords[idx_next_tile_in_pred_vols: idx_next_tile_in_pred_vols + batch_size]
+    (idxs_r, idxs_c, idxs_z) = calc_idxs_of_tiles_in_vol(slice_coords_batch, unpred_margin, stride)
+    # Advanced indexing gives [classes, tiles, r, c, z]. Bring the batch to the same order.
+    prob_maps_per_class[:, idxs_r, idxs_c, idxs_z] = np.swapaxes(prob_maps_batch, 0, 1)
+    idx_next_tile_in_pred_vols += batch_size
 
     return idx_next_tile_in_pred_vols, prob_maps_per_class
 
 
+def stitch_predicted_to_labels(pred_seg, max_prob_vol, idx_next_tile_in_pred_vols,
+                               prob_maps_batch, batch_size, slice_coords, unpred_margin, stride):
+    # For inference of labels only. Instead of the prob maps of all classes, only the predicted label ...
+    # ... (and optionally its probability) is kept per voxel. Their memory does not grow with the number of classes.
+    # pred_seg: The whole segmentation volume. max_prob_vol: The whole max-probability volume, or None.
+    # prob_maps_batch: the predictions of the cnn for tiles/segments in a batch, [tiles, classes, r, c, z].
+    slice_coords_batch = slice_coords[idx_next_tile_in_pred_vols: idx_next_tile_in_pred_vols + batch_size]
+    (idxs_r, idxs_c, idxs_z) = calc_idxs_of_tiles_in_vol(slice_coords_batch, unpred_margin, stride)
+    # Same labels as argmax of the stitched prob maps. Voxels of no tile stay 0, as argmax of zero prob maps.
+    pred_seg[idxs_r, idxs_c, idxs_z] = np.argmax(prob_maps_batch, axis=1)
+    if max_prob_vol is not None:
+        max_prob_vol[idxs_r, idxs_c, idxs_z] = np.max(prob_maps_batch, axis=1)
+    idx_next_tile_in_pred_vols += batch_size
+
+    return idx_next_tile_in_pred_vols, pred_seg, max_prob_vol
+
+
 def calculate_num_voxels_sub(num_central_voxels, pathway):
     num_voxels_sub = np.zeros(3)
     for i in range(3):
@@ -69,16 +132,28 @@ def calculate_num_voxels_sub(num_central_voxels, pathway):
     return [int(a) for a in num_voxels_sub]
 
 
-def calculate_num_central_voxels_dir(num_central_voxels, pathway):
-    num_voxels_dir = np.zeros(3)
-    # the math.ceil / subsamplingFactor is a trick to make it work for even subsamplingFactor too.
-    # Eg 9/2=4.5 => Get 5. Combined with the trick at repeat,
-    # I get my correct number of central voxels hopefully.
-    for i in range(3):
-        num_voxels_dir[i] = int(math.ceil((num_central_voxels[i] * 1.0) / pathway.subs_factor()[i])) \
-            if pathway.pType() == pt.SUBS else int(num_central_voxels[i])
-
-    return [int(a) for a in num_voxels_dir]
+def calc_idxs_of_central_voxels_in_fms(fms_shape, outp_pred_dims, pathway):
+    # Index arrays that gather the central voxels of a layer's FMs, brought to the normal resolution.
+    # fms_shape: Shape of the fms of the layer, [batch_size, fms, r, c, z].
+    # Returns: (r, c, z) index arrays that broadcast to [str-r, str-c, str-z] (str == outp_pred_dims).
+    #          For the subsampled pathway, each low-res voxel is indexed subs_factor times, which upsamples by
+    #          repetition only the part that is stitched, instead of repeating the whole FMs of the batch.
+    num_voxels_sub = calculate_num_voxels_sub(outp_pred_dims, pathway)
+    subs_factor = pathway.subs_factor() if pathway.pType() == pt.SUBS else [1, 1, 1]
+    idxs_per_axis = []
+    for axis in range(3):
+        # This is essentially the width of the patch left after the convolutions.
+        patch_dim = fms_shape[2 + axis] - num_voxels_sub[axis]
+        # the -1 so that if width is even, I'll get the left voxel from the centre as 1st,
+        # which I THINK is how I am getting the patches from the original image.
+        top_left_central_voxel = int((patch_dim - 1) // 2)
+        # The // subs_factor gives correct number of voxels even when subsampling factor is
+        # even or not exact divisor of the number of central voxels.
+        idxs_axis = top_left_central_voxel + np.arange(outp_pred_dims[axis]) // subs_factor[axis]
+        shape_axis = [1, 1, 1]
+        shape_axis[axis] = outp_pred_dims[axis]
+        idxs_per_axis.append(idxs_axis.reshape(shape_axis))
+    return tuple(idxs_per_axis)
 
 
 def stitch_predicted_to_fms(array_fms_to_save, idx_next_tile_in_fm_vols,
@@ -93,6 +168,10 @@ def stitch_predicted_to_fms(array_fms_to_save, idx_next_tile_in_fm_vols,
     # ... I will work only with the ones specified to visualise.
     layer_idx = 0
 
+    # Where the central-predicted-voxels of each tile of the batch go. Same for all layers and pathways.
+    slice_coords_batch = slice_coords[idx_next_tile_in_fm_vols: idx_next_tile_in_fm_vols + batch_size]
+    (idxs_r, idxs_c, idxs_z) = calc_idxs_of_tiles_in_vol(slice_coords_batch, unpred_margin, stride)
+
     for pathway in cnn_pathways:
         for layer_i in range(len(pathway.get_blocks())):
             if idxs_fms_to_save[pathway.pType()] == [] or idxs_fms_to_save[pathway.pType()][layer_i] == []:
@@ -103,92 +182,18 @@ def stitch_predicted_to_fms(array_fms_to_save, idx_next_tile_in_fm_vols,
             # curr_idx : fms_to_fill_high_idx defines were to put them in the multidimensional-image-array.
             fms_to_fill_high_idx = idx_curr + fms_to_extract_idxs[1] - fms_to_extract_idxs[0]
 
-            fm_to_reconstruct = array_fms_to_save[idx_curr:fms_to_fill_high_idx]
-
-            # ========================================================================================
-            # ====the following calculations could be move OUTSIDE THE FOR LOOPS, by using the kernel-size
-            # parameter (from the cnn instance) instead of the shape of the returned value.
-            # ====fmsReturnedForATestBatchForCertainLayer.shape[2] - (outp_pred_dims[0]-1)
-            # is essentially the width of the patch left after the convolutions.
-            # ====These calculations are pathway and layer-specific. So they could be done once, prior to
-            # image processing, and results cached in a list to be accessed during the loop.
-
-            (num_voxels_sub_r,
-             num_voxels_sub_c,
-             num_voxels_sub_z) = calculate_num_voxels_sub(outp_pred_dims, pathway)
-
-            r_patch_dim = fms_layer.shape[2] - num_voxels_sub_r
-            c_patch_dim = fms_layer.shape[3] - num_voxels_sub_c
-            z_patch_dim = fms_layer.shape[4] - num_voxels_sub_z
-
-            # the -1 so that if width is even, I'll get the left voxel from the centre as 1st,
-            # which I THINK is how I am getting the patches from the original image.
-            r_top_left_central_voxel = int((r_patch_dim - 1) // 2)
-            c_top_left_central_voxel = int((c_patch_dim - 1) // 2)
-            z_top_left_central_voxel = int((z_patch_dim - 1) // 2)
-
-            (num_central_voxels_r,
-             num_central_voxels_c,
-             num_central_voxels_z) = calculate_num_central_voxels_dir(outp_pred_dims, pathway)
-
-            # ============================================================================================
-
-            # Grab the central voxels of the predicted fms from the cnn in this batch.
-            central_voxels_all_fms = fms_layer[:,  # batchsize
-                                               :,  # number of featuremaps
-                                               r_top_left_central_voxel:r_top_left_central_voxel + num_central_voxels_r,
-                                               c_top_left_central_voxel:c_top_left_central_voxel + num_central_voxels_c,
-                                               z_top_left_central_voxel:z_top_left_central_voxel + num_central_voxels_z]
-
-            # If the pathway that is visualised currently is the subsampled,
-            # I need to upsample the central voxels to the normal resolution,
-            # before reconstructing the image-fm.
-
-            # subsampled layer. Remember that this returns smaller dimension outputs,
-            # because it works in the subsampled space.
-            # I need to repeat it, to bring it to the dimensions of the normal-voxel-space.
-            if pathway.pType() == pt.SUBS:
-                expanded_output_r = np.repeat(central_voxels_all_fms, pathway.subs_factor()[0], axis=2)
-                expanded_output_rc = np.repeat(expanded_output_r, pathway.subs_factor()[1], axis=3)
-                expanded_output_rcz = np.repeat(expanded_output_rc, pathway.subs_factor()[2], axis=4)
-                # The below is a trick to get correct number of voxels even when subsampling factor is
-                # even or not exact divisor of the number of central voxels.
-                # ...This trick is coupled with the ceil() when getting the
-                # numberOfCentralVoxelsToGetInDirectionR above.
-                central_voxels_all_fms_batch = expanded_output_rcz[:,
-                                                                   :,
-                                                                   0:outp_pred_dims[0],
-                                                                   0:outp_pred_dims[1],
-                                                                   0:outp_pred_dims[2]
-                                                                   ]
-            else:
-                central_voxels_all_fms_batch = central_voxels_all_fms
-
-            # ----For every image part within this batch, reconstruct the corresponding part of the feature
-            # maps of the layer we are currently visualising in this loop.
-            for tile_batch_idx in range(batch_size):
-                # Now put the label-cube in the new-label-segmentation-image, at the correct position.
-                # The very first label goes not in index 0,0,0 but half-patch further away! At the position
-                # of the central voxel of the top-left patch!
-                slice_coords_tile = slice_coords[idx_next_tile_in_fm_vols + tile_batch_idx]
-                coords_top_left_voxel = [slice_coords_tile[0][0],
-                                         slice_coords_tile[1][0],
-                                         slice_coords_tile[2][0]]
-
-                # I put the central-predicted-voxels of all FMs to the corresponding,
-                # newly created images all at once.
-                fm_to_reconstruct[:,  # last dimension is the number-of-Fms, I create an image for each.
-
-                                  coords_top_left_voxel[0] + unpred_margin[0][0]:
-                                  coords_top_left_voxel[0] + unpred_margin[0][0] + stride[0],
-
-                                  coords_top_left_voxel[1] + unpred_margin[1][0]:
-                                  coords_top_left_voxel[1] + unpred_margin[1][0] + stride[1],
-
-                                  coords_top_left_voxel[2] + unpred_margin[2][0]:
-                                  coords_top_left_voxel[2] + unpred_margin[2][0] + stride[2]
+            # Grab the central voxels of the predicted fms from the cnn in this batch, at the normal resolution.
+            # Subsampled layers return smaller dimension outputs, because they work in the subsampled space.
+            # Their central voxels are upsampled by the gather itself.
+            (idxs_central_r,
+             idxs_central_c,
+             idxs_central_z) = calc_idxs_of_central_voxels_in_fms(fms_layer.shape, outp_pred_dims, pathway)
+            central_voxels_all_fms_batch = fms_layer[:, :, idxs_central_r, idxs_central_c, idxs_central_z]
 
-                                  ] = central_voxels_all_fms_batch[tile_batch_idx]
+            # Put the central-predicted-voxels of all FMs of all tiles in the batch to the corresponding,
+            # newly created images all at once. Advanced indexing gives [fms, tiles, r, c, z].
+            array_fms_to_save[idx_curr:fms_to_fill_high_idx, idxs_r, idxs_c, idxs_z] = \
+                np.swapaxes(central_voxels_all_fms_batch, 0, 1)
 
             idx_curr = fms_to_fill_high_idx
 
@@ -201,6 +206,28 @@ def stitch_predicted_to_fms(array_fms_to_save, idx_next_tile_in_fm_vols,
     return idx_next_tile_in_fm_vols, array_fms_to_save
 
 
+def alloc_output_vols(shape, memmap_dir, dtype="float32"):
+    # Zero-initialized array for outputs of the size of the whole volume, eg prob maps or FMs.
+    # memmap_dir: If None, array is in RAM. Otherwise, it is backed by a scratch file in this folder, so that
+    #             it is paged to disk instead of held in RAM. The file is deleted when the array is released.
+    if memmap_dir is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(tempfile.TemporaryFile(dir=memmap_dir), dtype=dtype, mode="w+", shape=tuple(shape))
+
+
+def calc_seg_from_prob_maps(prob_maps_vols, memmap_dir, n_vox_per_chunk=2**20):
+    # Segmentation as the argmax of the prob maps [classes, r, c, z]. In chunks of the first spatial axis (contiguous...
+    # ... in memory), so that the int64 output of np.argmax is never made for the whole volume.
+    # memmap_dir: If given, the segmentation is backed by a scratch file in this folder. See alloc_output_vols.
+    pred_seg = alloc_output_vols(prob_maps_vols.shape[1:], memmap_dir,
+                                 "uint8" if prob_maps_vols.shape[0] <= 256 else "uint16")
+    n_slices_per_chunk = int(max(1, n_vox_per_chunk // np.prod(prob_maps_vols.shape[2:])))
+    for r_start in range(0, prob_maps_vols.shape[1], n_slices_per_chunk):
+        pred_seg[r_start: r_start + n_slices_per_chunk] = np.argmax(prob_maps_vols[:, r_start: r_start + n_slices_per_chunk],
+                                                                    axis=0)
+    return pred_seg
+
+
 def prepare_feeds_dict(feeds, channs_of_tiles_per_path):
     # TODO: Can we rename the input feeds so that they are easier to deal with?
     feeds_dict = {feeds['x']: np.asarray(channs_of_tiles_per_path[0], dtype='float32')}
@@ -213,8 +240,16 @@ def prepare_feeds_dict(feeds, channs_of_tiles_per_path):
 
 def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
                                    channels, roi_mask, inp_shapes_per_path, unpred_margin,
-                                   batchsize, save_fms_flag, idxs_fms_to_save):
+                                   batchsize, save_fms_flag, idxs_fms_to_save, memmap_dir=None,
+                                   labels_only=False, max_prob=False, bucket_shapes=False, border_int_per_chan=None):
     # One of the main routines. Segment whole volume tile-by-tile.
+    # memmap_dir: If given, the output prob maps and FMs are backed by scratch files in this folder. See alloc_output_vols.
+    # labels_only: If True, prob maps per class are not made. Instead, the segmentation is made while stitching.
+    # max_prob: In labels_only mode, also make a volume with the probability of the predicted class.
+    # bucket_shapes: If True, the last batch is filled up to batchsize, so that all batches have the same shape...
+    #                ... and a forward pass compiled by XLA is not recompiled for it.
+    # border_int_per_chan: For subsampled pathways, out of the image. See extractSegmentsGivenSliceCoords.
+    # Returns: prob_maps_vols, array_fms_to_save, pred_seg, max_prob_vol. Those not made are None.
     
     # For tiling the volume: Stride is how much I move in each dimension to get the next tile.
     # I stride exactly the number of voxels that are predicted per forward pass.
@@ -230,17 +265,27 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
     inp_chan_dims = list(channels.shape[1:]) # Dimensions of (padded) input channels.
     # The main output. Predicted probability-maps for the whole volume, one per class.
     # Will be constructed by stitching together the predictions from each tile.
-    prob_maps_vols = np.zeros([cnn3d.num_classes]+inp_chan_dims, dtype="float32")
+    # In labels_only mode, the segmentation (and max prob) is constructed instead.
+    prob_maps_vols = None
+    pred_seg = None
+    max_prob_vol = None
+    if not labels_only:
+        prob_maps_vols = alloc_output_vols([cnn3d.num_classes] + inp_chan_dims, memmap_dir)
+    else:
+        pred_seg = alloc_output_vols(inp_chan_dims, memmap_dir, "uint8" if cnn3d.num_classes <= 256 else "uint16")
+        max_prob_vol = alloc_output_vols(inp_chan_dims, memmap_dir) if max_prob else None
     # create the big array that will hold all the fms (for feature extraction).
-    array_fms_to_save = np.zeros([n_fms_to_save] + inp_chan_dims, dtype="float32") if save_fms_flag else None
+    array_fms_to_save = alloc_output_vols([n_fms_to_save] + inp_chan_dims, memmap_dir) if save_fms_flag else None
 
     # Tile the image and get all slices of the tiles that it fully breaks down to.
+    # Probability maps are masked by the ROI afterwards, so tiles that do not predict any ROI voxel can be skipped.
+    # FMs are not masked, so in that case keep every tile whose input touches the ROI, as before.
     slice_coords_all_tiles = get_slice_coords_of_all_img_tiles(log,
                                                                inp_shapes_per_path[0],
                                                                stride_of_tiling,
-                                                               batchsize,
                                                                inp_chan_dims,
-                                                               roi_mask)
+                                                               roi_mask,
+                                                               unpred_margin if not save_fms_flag else None)
 
     n_tiles_for_subj = len(slice_coords_all_tiles)
     log.print3("Ready to make predictions for all image segments (parts).")
@@ -248,7 +293,8 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
     
     idx_next_tile_in_pred_vols = 0
     idx_next_tile_in_fm_vols = 0
-    n_batches = n_tiles_for_subj // batchsize
+    # The last batch may be smaller. The batch dimension of the graph is not fixed, so no tile is processed twice.
+    n_batches = int(math.ceil(n_tiles_for_subj / batchsize))
     t_fwd_pass_subj = 0 # time it took for forward pass over all tiles of subject.
     print_progress_step_test(log, n_batches, 0, batchsize, n_tiles_for_subj)    
     for batch_i in range(n_batches):
@@ -261,7 +307,12 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
                                                                    slice_coords_of_tiles_batch,
                                                                    channels,
                                                                    inp_shapes_per_path,
-                                                                   outp_pred_dims)
+                                                                   outp_pred_dims,
+                                                                   border_int_per_chan)
+        n_tiles_batch = len(slice_coords_of_tiles_batch)
+        if bucket_shapes and n_tiles_batch < batchsize: # Repeat the last tile. Its extra predictions are discarded.
+            channs_of_tiles_per_path = [channs_of_tiles + [channs_of_tiles[-1]] * (batchsize - n_tiles_batch)
+                                        for channs_of_tiles in channs_of_tiles_per_path]
 
         # ============================== Perform forward pass ====================================
         t_fwd_start = time.time()
@@ -270,6 +321,7 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
         feeds_dict = prepare_feeds_dict(cnn3d.get_main_feeds('test'), channs_of_tiles_per_path)
         # Forward pass
         out_val_of_ops = sessionTf.run(fetches=list_of_ops, feed_dict=feeds_dict)
+        out_val_of_ops = [out_val_of_op[:n_tiles_batch] for out_val_of_op in out_val_of_ops]
         prob_maps_batch = out_val_of_ops[0]
         fms_per_layer_and_path_for_batch = out_val_of_ops[1:] # [] if no FMs specified.
         t_fwd_pass_subj += time.time() - t_fwd_start
@@ -277,14 +329,26 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
         # ================ Construct probability maps (volumes) by Stitching  ====================
         # Stitch predictions for tiles of this batch, to create the probability maps for whole volume.
         # Each prediction for a tile needs to be placed in the correct location in the volume.
-        (idx_next_tile_in_pred_vols,
-         prob_maps_vols) = stitch_predicted_to_prob_maps(prob_maps_vols,
-                                                         idx_next_tile_in_pred_vols,
-                                                         prob_maps_batch,
-                                                         batchsize,
-                                                         slice_coords_all_tiles,
-                                                         unpred_margin,
-                                                         stride_of_tiling)
+        if not labels_only:
+            (idx_next_tile_in_pred_vols,
+             prob_maps_vols) = stitch_predicted_to_prob_maps(prob_maps_vols,
+                                                             idx_next_tile_in_pred_vols,
+                                                             prob_maps_batch,
+                                                             len(slice_coords_of_tiles_batch),
+                                                             slice_coords_all_tiles,
+                                                             unpred_margin,
+                                                             stride_of_tiling)
+        else:
+            (idx_next_tile_in_pred_vols,
+             pred_seg,
+             max_prob_vol) = stitch_predicted_to_labels(pred_seg,
+                                                        max_prob_vol,
+                                                        idx_next_tile_in_pred_vols,
+                                                        prob_maps_batch,
+                                                        len(slice_coords_of_tiles_batch),
+                                                        slice_coords_all_tiles,
+                                                        unpred_margin,
+                                                        stride_of_tiling)
 
         # ============== Construct feature maps (volumes) by Stitching =====================
         if save_fms_flag:
@@ -292,7 +356,7 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
              array_fms_to_save) = stitch_predicted_to_fms(array_fms_to_save,
                                                           idx_next_tile_in_fm_vols,
                                                           fms_per_layer_and_path_for_batch,
-                                                          batchsize,
+                                                          len(slice_coords_of_tiles_batch),
                                                           slice_coords_all_tiles,
                                                           unpred_margin,
                                                           stride_of_tiling,
@@ -304,7 +368,140 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
         
     log.print3("TIMING: Segmentation of subject: [Forward Pass:] {0:.2f}".format(t_fwd_pass_subj) + " secs.")
 
-    return prob_maps_vols, array_fms_to_save
+    return prob_maps_vols, array_fms_to_save, pred_seg, max_prob_vol
+
+
+def calc_bytes_per_inp_voxel(cnn3d):
+    # Rough estimate of the memory a forward pass needs per voxel of the (high-res) input segment.
+    # Counts float32 activations of inputs, every layer's FMs and the output. Subsampled pathways hold fewer voxels.
+    n_fms_per_voxel = cnn3d.pathways[0].get_n_fms_in() * (1 + cnn3d.numSubsPaths) + cnn3d.num_classes
+    for pathway in cnn3d.pathways:
+        n_fms_in_pathway = sum([block.get_n_fms_out() for block in pathway.get_blocks()])
+        n_fms_per_voxel += n_fms_in_pathway / np.prod(pathway.subs_factor())
+    # x2, for temporaries that are alive at the same time (eg transposes before convs, BN, activations).
+    return 4 * 2 * n_fms_per_voxel
+
+
+def calc_slab_dims(log, cnn3d, inp_shapes_per_path, inp_chan_dims, mem_budget_mb, n_tiles_per_bucket=1):
+    # Find the largest slab that can be segmented in one forward pass.
+    # A slab covers the whole (padded) volume in r and c, and as many tiles along z as fit the memory budget.
+    # The predicted part of a slab is a multiple of the predicted part of a tile, so slabs are unions of tiles.
+    # inp_shapes_per_path: Input dims per pathway for a tile. [0] is used as unit to build slabs.
+    # inp_chan_dims: dims of the (padded) input channels.
+    # mem_budget_mb: Memory budget for the forward pass of a slab. If None, the whole volume is one slab.
+    # n_tiles_per_bucket: The tiles per axis of the volume are rounded up to a multiple of this. Volumes of ...
+    #                     ... similar size then give slabs of the same dims, so XLA does not recompile for each.
+    # Returns: slab_dims: dims of the input of the slab for the high-res pathway [r, c, z]
+    #          vol_dims_multiple_of_slabs: dims that the volume should be padded to, so that slabs tile it exactly.
+    tile_outp_dims = cnn3d.calc_outp_dims_given_inp(inp_shapes_per_path[0])
+    n_unpred_vox = [inp_shapes_per_path[0][d] - tile_outp_dims[d] for d in range(3)]
+    n_tiles_per_axis = [max(1, int(math.ceil((inp_chan_dims[d] - n_unpred_vox[d]) / tile_outp_dims[d])))
+                        for d in range(3)]
+    n_tiles_per_axis = [int(math.ceil(n_tiles / n_tiles_per_bucket)) * n_tiles_per_bucket
+                        for n_tiles in n_tiles_per_axis]
+
+    n_tiles_z_per_slab = n_tiles_per_axis[2]
+    if mem_budget_mb is not None:
+        n_vox_slab_rc = np.prod([n_tiles_per_axis[d] * tile_outp_dims[d] + n_unpred_vox[d] for d in range(2)])
+        n_bytes_per_inp_z_slice = n_vox_slab_rc * calc_bytes_per_inp_voxel(cnn3d)
+        n_inp_z_slices_fit = int(mem_budget_mb * 1024 * 1024 // n_bytes_per_inp_z_slice)
+        n_tiles_z_fit = (n_inp_z_slices_fit - n_unpred_vox[2]) // tile_outp_dims[2]
+        if n_tiles_z_fit < 1:
+            log.print3("WARN: Memory budget for slabs (" + str(mem_budget_mb) + " MB) is too small for even one row "
+                       "of tiles along z. Using slabs that are one tile thick.")
+        n_tiles_z_per_slab = int(min(max(1, n_tiles_z_fit), n_tiles_per_axis[2]))
+    n_slabs_z = int(math.ceil(n_tiles_per_axis[2] / n_tiles_z_per_slab))
+
+    slab_dims = [n_tiles_per_axis[0] * tile_outp_dims[0] + n_unpred_vox[0],
+                 n_tiles_per_axis[1] * tile_outp_dims[1] + n_unpred_vox[1],
+                 n_tiles_z_per_slab * tile_outp_dims[2] + n_unpred_vox[2]]
+    vol_dims_multiple_of_slabs = [slab_dims[0],
+                                  slab_dims[1],
+                                  n_slabs_z * n_tiles_z_per_slab * tile_outp_dims[2] + n_unpred_vox[2]]
+    return slab_dims, vol_dims_multiple_of_slabs
+
+
+def predict_whole_volume_by_slabs(log, sessionTf, cnn3d,
+                                  channels, roi_mask, inp_shapes_per_path, unpred_margin,
+                                  mem_budget_mb, save_fms_flag, idxs_fms_to_save, memmap_dir=None,
+                                  labels_only=False, max_prob=False, bucket_shapes=False):
+    # Segment whole volume by feeding the largest slabs that fit in memory, instead of many small tiles.
+    # The net is fully convolutional, so a slab gives the same predictions as the tiles it is made of,
+    # without recomputing the overlapping margins of neighbouring tiles.
+    # Only for models without subsampled pathways. Their low-res input is extracted on a grid aligned per tile...
+    # ... (and the last tile of an axis is shifted back), which a slab cannot reproduce.
+    # Requires the test graph to have been built with placeholders of dynamic dims.
+    assert cnn3d.numSubsPaths == 0
+    # inp_shapes_per_path: Input dims per pathway of a tile. Slabs are built of these.
+    # bucket_shapes: If True, dims of slabs are rounded up to buckets of N_TILES_PER_SLAB_BUCKET tiles per axis.
+    inp_chan_dims = list(channels.shape[1:])
+    (slab_dims,
+     vol_dims_multiple_of_slabs) = calc_slab_dims(log, cnn3d, inp_shapes_per_path, inp_chan_dims, mem_budget_mb,
+                                                  N_TILES_PER_SLAB_BUCKET if bucket_shapes else 1)
+    log.print3("Segmenting by slabs. Dimensions of slabs (input to normal pathway): " + str(slab_dims))
+
+    # Pad the end of each axis so that the slabs tile the volume exactly, without the last one shifting back.
+    # What is predicted in the extra voxels is cropped away below.
+    pad_end_per_axis = [max(0, vol_dims_multiple_of_slabs[d] - inp_chan_dims[d]) for d in range(3)]
+    channels = np.pad(channels, [[0, 0]] + [[0, pad_end] for pad_end in pad_end_per_axis], mode='edge')
+    if roi_mask is not None:
+        roi_mask = np.pad(roi_mask, [[0, pad_end] for pad_end in pad_end_per_axis], mode='constant')
+
+    (prob_maps_vols,
+     array_fms_to_save,
+     pred_seg,
+     max_prob_vol) = predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
+                                                    channels, roi_mask,
+                                                    cnn3d.calc_inp_dims_of_paths_from_hr_inp(slab_dims),
+                                                    unpred_margin,
+                                                    1, save_fms_flag, idxs_fms_to_save, memmap_dir,
+                                                    labels_only, max_prob)
+
+    # Crop back. Voxels within the unpredicted margin at the end of the original volume were predicted
+    # from the padding. Zero them, as they are when tiling.
+    prob_maps_vols = crop_and_zero_end_margin(prob_maps_vols, inp_chan_dims, unpred_margin)
+    pred_seg = crop_and_zero_end_margin(pred_seg, inp_chan_dims, unpred_margin)
+    max_prob_vol = crop_and_zero_end_margin(max_prob_vol, inp_chan_dims, unpred_margin)
+    if array_fms_to_save is not None:
+        array_fms_to_save = array_fms_to_save[:, :inp_chan_dims[0], :inp_chan_dims[1], :inp_chan_dims[2]]
+
+    return prob_maps_vols, array_fms_to_save, pred_seg, max_prob_vol
+
+
+def predict_whole_volume(log, sessionTf, cnn3d,
+                         channels, roi_mask, inp_shapes_per_path, unpred_margin,
+                         batchsize, save_fms_flag, idxs_fms_to_save, infer_prms, border_int_per_chan=None):
+    # Segment whole volume by tiles or by slabs, as specified by infer_prms. See inference_on_whole_volumes.
+    # border_int_per_chan: If channels are a crop, the border intensity of the whole image. See preproc_subject.
+    # Returns: prob_maps_vols, array_fms_to_save, pred_seg, max_prob_vol. Those not made are None.
+    if infer_prms['slabs']:
+        return predict_whole_volume_by_slabs(log, sessionTf, cnn3d,
+                                             channels, roi_mask, inp_shapes_per_path, unpred_margin,
+                                             infer_prms['slab_mem_budget_mb'],
+                                             save_fms_flag, idxs_fms_to_save,
+                                             infer_prms['memmap_dir'],
+                                             infer_prms['labels_only'], infer_prms['max_prob'],
+                                             infer_prms['bucket_shapes'])
+    else:
+        return predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
+                                              channels, roi_mask, inp_shapes_per_path, unpred_margin,
+                                              batchsize, save_fms_flag, idxs_fms_to_save,
+                                              infer_prms['memmap_dir'],
+                                              infer_prms['labels_only'], infer_prms['max_prob'],
+                                              infer_prms['bucket_shapes'], border_int_per_chan)
+
+
+def crop_and_zero_end_margin(vol, inp_chan_dims, unpred_margin):
+    # Crop the last 3 axes of vol (eg prob maps [classes, r, c, z] or segmentation [r, c, z]) to inp_chan_dims ...
+    # ... and zero its unpredicted margin at the end of each axis. Deals with None.
+    if vol is None:
+        return None
+    vol = vol[..., :inp_chan_dims[0], :inp_chan_dims[1], :inp_chan_dims[2]]
+    for d in range(3):
+        idxs_margin_end = [slice(None)] * vol.ndim
+        idxs_margin_end[vol.ndim - 3 + d] = slice(inp_chan_dims[d] - unpred_margin[d][1], None)
+        vol[tuple(idxs_margin_end)] = 0
+    return vol
 
 
 def unpad_img(img, unpad_input, pad_left_right_per_axis):
@@ -340,13 +537,17 @@ def save_pred_seg(pred_seg, save_pred_seg_bool, suffix_seg, seg_names, filepaths
                                         log)
 
 
-def save_prob_maps(prob_maps, save_prob_maps_bool, suffix_prob_map, prob_names, filepaths, subj_i, log):
+def save_prob_maps(prob_maps, save_prob_maps_bool, suffix_prob_map, prob_names, filepaths, subj_i, log,
+                   crop_coords=None, full_dims=None):
     # filepaths: list of all filepaths to each channel img of each subject. To get header.
     # Save the image. Pass the filename paths of the normal image to duplicate the header info.
+    # crop_coords: If not None, prob_maps are of a crop of the image. Pasted in full_dims, one at a time, for saving.
+    if prob_maps is None:  # Not made, eg in labels-only mode.
+        return
     for class_i in range(len(prob_maps)):
         if (len(save_prob_maps_bool) >= class_i + 1) and save_prob_maps_bool[class_i]:
             suffix = suffix_prob_map + str(class_i)
-            prob_map = prob_maps[class_i]
+            prob_map = paste_crop_in_3d_img(prob_maps[class_i], crop_coords, full_dims)
             savePredImgToNiiWithOriginalHdr(prob_map,
                                             prob_names,
                                             filepaths,
@@ -356,7 +557,21 @@ def save_prob_maps(prob_maps, save_prob_maps_bool, suffix_prob_map, prob_names,
                                             log)
 
 
-def save_fms_individual(save_flag, multidim_fm_array, cnn_pathways, fm_idxs, fms_names, filepaths, subj_i, log):
+def save_max_prob_map(max_prob_vol, suffix_prob_map, prob_names, filepaths, subj_i, log):
+    # Save the probability of the predicted class of each voxel. Made in labels-only mode, if asked. Deals with None.
+    if max_prob_vol is not None:
+        savePredImgToNiiWithOriginalHdr(max_prob_vol,
+                                        prob_names,
+                                        filepaths,
+                                        subj_i,
+                                        suffix_prob_map + "Max",
+                                        np.dtype(np.float32),
+                                        log)
+
+
+def save_fms_individual(save_flag, multidim_fm_array, cnn_pathways, fm_idxs, fms_names, filepaths, subj_i, log,
+                        crop_coords=None, full_dims=None):
+    # crop_coords: If not None, FMs are of a crop of the image. Pasted in full_dims, one at a time, for saving.
     if not save_flag:
         return
     
@@ -369,7 +584,7 @@ def save_fms_individual(save_flag, multidim_fm_array, cnn_pathways, fm_idxs, fms
                 fms_idx_layer_pathway = fms_idx_pathway[layer_i]
                 if fms_idx_layer_pathway:
                     for fmActualNumber in range(fms_idx_layer_pathway[0], fms_idx_layer_pathway[1]):
-                        fm_to_save = multidim_fm_array[idx_curr]
+                        fm_to_save = paste_crop_in_3d_img(multidim_fm_array[idx_curr], crop_coords, full_dims)
                         
                         saveFmImgToNiiWithOriginalHdr(fm_to_save,
                                                       fms_names,
@@ -476,6 +691,161 @@ def report_mean_metrics(log, mean_metrics, na_pattern, val_test_print):
 
 
 # Main routine for testing.
+def load_and_preproc_subject(subj_i, log,
+                             paths_per_chan_per_subj, paths_to_lbls_per_subj, paths_to_masks_per_subj,
+                             run_input_checks, n_classes, pad_input, unpred_margin, norm_prms,
+                             crop_to_roi=False, tile_outp_dims=None, tile_context=None):
+    # Load the images of a subject and pre-process them for inference.
+    # crop_to_roi: If True and ROI given, crop the subject to the ROI's bounding box plus the receptive field's margin,
+    #              after pre-processing (so normalization uses the stats of the whole image). Then everything up to ...
+    #              ... saving runs on the crop.
+    # tile_outp_dims: Predicted dims of a tile. The crop is aligned to the grid of tiles. Needed if crop_to_roi.
+    # tile_context: Voxels around a tile read by subsampled pathways, included in the crop. None if no such pathway.
+    #               See calc_crop_coords_of_roi.
+    # Returns: channels, gt_lbl_img, roi_mask, pad_left_right_per_axis, crop_coords, full_dims, border_int_per_chan
+    #          crop_coords: None if not cropped. Else [[low, high]]*3 of the crop in the image. See crop_3d_img.
+    #                       If cropped, gt_lbl_img is of the full image and not padded, for evaluation, and ...
+    #                       ... pad_left_right_per_axis is the part of the crop in the padding of the image.
+    #          full_dims: Dimensions of the (full, not padded) image.
+    #          border_int_per_chan: None if not cropped. Else the border intensity of the whole (pre-processed) ...
+    #                               ... image, per channel. For predict_whole_volume. See get_subsampl_segment.
+    (channels,  # nparray [channels,dim0,dim1,dim2]
+     gt_lbl_img,
+     roi_mask,
+     _) = load_imgs_of_subject(log, "",
+                               subj_i,
+                               paths_per_chan_per_subj,
+                               paths_to_lbls_per_subj,
+                               None, # weightmaps, not for test
+                               paths_to_masks_per_subj)
+    return preproc_subject(log, channels, gt_lbl_img, roi_mask,
+                           run_input_checks, n_classes, pad_input, unpred_margin, norm_prms,
+                           crop_to_roi, tile_outp_dims, tile_context)
+
+
+def preproc_subject(log, channels, gt_lbl_img, roi_mask,
+                    run_input_checks, n_classes, pad_input, unpred_margin, norm_prms,
+                    crop_to_roi=False, tile_outp_dims=None, tile_context=None):
+    # Pre-process the (loaded) images of a subject for inference. See load_and_preproc_subject.
+    full_dims = list(channels.shape[1:])
+    crop_coords = None
+    border_int_per_chan = None
+    gt_lbl_img_to_preproc = gt_lbl_img
+    if crop_to_roi and roi_mask is not None and np.any(roi_mask > 0):
+        (crop_coords,
+         margin_out_of_img) = calc_crop_coords_of_roi(roi_mask, unpred_margin, tile_outp_dims, pad_input, tile_context)
+        log.print3("Cropping subject to the bounding box of the ROI plus the receptive field's margin: " +
+                   str(crop_coords) + ". Dimensions of image: " + str(full_dims))
+        if run_input_checks:
+            check_gt_vs_num_classes(log, "", gt_lbl_img, n_classes)
+        gt_lbl_img_to_preproc = None  # GT is kept whole, only for evaluation.
+    # The whole image is pre-processed, and cropped after. Normalization may use stats of the whole image...
+    # ... (eg cutoff_below_mean), and padding is then as for the whole image.
+    (channels,
+    gt_lbl_img_pp,
+    roi_mask,
+    _,
+    pad_left_right_per_axis) = preproc_imgs_of_subj(log, "",
+                                                    channels, gt_lbl_img_to_preproc, roi_mask, None,
+                                                    run_input_checks, n_classes, # checks
+                                                    pad_input, unpred_margin,
+                                                    norm_prms)
+    if crop_coords is None:
+        gt_lbl_img = gt_lbl_img_pp
+    else:
+        # Context of subsampled pathways out of the (padded) image is filled with the border intensity of the whole.
+        border_int_per_chan = [calc_border_int_of_3d_img(channel) for channel in channels]
+        crop_coords_in_padded = [[crop_coords[d][0] - margin_out_of_img[d][0] + pad_left_right_per_axis[d][0],
+                                  crop_coords[d][1] + margin_out_of_img[d][1] + pad_left_right_per_axis[d][0]]
+                                 for d in range(3)]
+        channels = crop_3d_img(channels, crop_coords_in_padded)
+        roi_mask = crop_3d_img(roi_mask, crop_coords_in_padded)
+        pad_left_right_per_axis = margin_out_of_img
+    return channels, gt_lbl_img, roi_mask, pad_left_right_per_axis, crop_coords, full_dims, border_int_per_chan
+
+
+def postproc_save_and_eval_subject(log, cnn3d, subj_i,
+                                   prob_maps_vols, array_fms_to_save, pred_seg, max_prob_vol, gt_lbl_img, roi_mask,
+                                   pad_input, pad_left_right_per_axis, crop_coords, full_dims,
+                                   savePredictedSegmAndProbsDict, suffixForSegmAndProbsDict,
+                                   namesForSavingSegmAndProbs, paths_per_chan_per_subj,
+                                   save_fms_flag, idxs_fms_to_save, namesForSavingFms,
+                                   paths_to_lbls_per_subj, metrics_per_subj_per_c, NA_PATTERN, val_test_print,
+                                   memmap_dir=None):
+    # Post-process the predictions for a subject, save them, and evaluate them if GT was given.
+    # Fills in the entries of metrics_per_subj_per_c for this subject. Returns it.
+    # pred_seg, max_prob_vol: Given in labels-only mode, in which prob_maps_vols is None. Otherwise None.
+    # memmap_dir: If given, label volumes made here are backed by scratch files in this folder, as the prob maps.
+    # crop_coords, full_dims: See load_and_preproc_subject. If cropped, predictions are pasted in the full image ...
+    #                         ... only for saving and evaluation. Nothing is predicted outside the crop.
+    n_classes = cnn3d.num_classes
+    # ========================== Post-Processing =========================
+    if pred_seg is None:
+        pred_seg = calc_seg_from_prob_maps(prob_maps_vols, memmap_dir)  # The segmentation.
+
+    # Unpad all images.        
+    pred_seg_u          = unpad_img(pred_seg, pad_input, pad_left_right_per_axis)
+    gt_lbl_u            = unpad_img(gt_lbl_img, pad_input, pad_left_right_per_axis) if crop_coords is None else gt_lbl_img
+    roi_mask_u          = unpad_img(roi_mask, pad_input, pad_left_right_per_axis)
+    prob_maps_vols_u    = unpad_list_of_imgs(prob_maps_vols, pad_input, pad_left_right_per_axis)
+    max_prob_vol_u      = unpad_img(max_prob_vol, pad_input, pad_left_right_per_axis)
+    array_fms_to_save_u = unpad_list_of_imgs(array_fms_to_save, pad_input, pad_left_right_per_axis)
+    
+    # Poster-process outside the ROI, e.g. by deleting any predictions outside it.
+    # In place, so that no copy is made, eg of disk-backed volumes. The labels keep their dtype.
+    if roi_mask_u is None:
+        pred_seg_u_in_roi = pred_seg_u
+    elif paths_to_lbls_per_subj is None:  # The segmentation outside the ROI is only needed for evaluation.
+        pred_seg_u_in_roi = np.multiply(pred_seg_u, roi_mask_u, out=pred_seg_u, casting='unsafe')
+    else:
+        pred_seg_u_in_roi = alloc_output_vols(pred_seg_u.shape, memmap_dir, pred_seg_u.dtype)
+        np.multiply(pred_seg_u, roi_mask_u, out=pred_seg_u_in_roi, casting='unsafe')
+    if roi_mask_u is not None:
+        for c in range(n_classes if prob_maps_vols_u is not None else 0):
+            prob_maps_vols_u[c] *= roi_mask_u
+        if max_prob_vol_u is not None:
+            max_prob_vol_u *= roi_mask_u
+    prob_maps_vols_u_in_roi = prob_maps_vols_u # Just to follow naming convention for clarity.
+    
+    # Paste the segmentation in the full image, if cropped. Prob maps and FMs are pasted one by one when saved.
+    pred_seg_u_is_in_roi = pred_seg_u_in_roi is pred_seg_u
+    pred_seg_u          = paste_crop_in_3d_img(pred_seg_u, crop_coords, full_dims)
+    pred_seg_u_in_roi   = pred_seg_u if pred_seg_u_is_in_roi else paste_crop_in_3d_img(pred_seg_u_in_roi, crop_coords, full_dims)
+    roi_mask_u          = paste_crop_in_3d_img(roi_mask_u, crop_coords, full_dims)
+    max_prob_vol_u      = paste_crop_in_3d_img(max_prob_vol_u, crop_coords, full_dims)
+    gt_lbl_u_in_roi = gt_lbl_u if (gt_lbl_u is None or roi_mask_u is None) else gt_lbl_u * roi_mask_u
+    
+    # ======================= Save Output Volumes ========================
+    # Save predicted segmentations
+    save_pred_seg(pred_seg_u_in_roi,
+                  savePredictedSegmAndProbsDict["segm"], suffixForSegmAndProbsDict["segm"],
+                  namesForSavingSegmAndProbs, paths_per_chan_per_subj, subj_i, log)
+
+    # Save probability maps
+    save_prob_maps(prob_maps_vols_u_in_roi,
+                   savePredictedSegmAndProbsDict["prob"], suffixForSegmAndProbsDict["prob"],
+                   namesForSavingSegmAndProbs, paths_per_chan_per_subj, subj_i, log,
+                   crop_coords, full_dims)
+    save_max_prob_map(max_prob_vol_u, suffixForSegmAndProbsDict["prob"],
+                      namesForSavingSegmAndProbs, paths_per_chan_per_subj, subj_i, log)
+
+    # Save feature maps
+    save_fms_individual(save_fms_flag, array_fms_to_save_u, cnn3d.pathways, idxs_fms_to_save,
+                        namesForSavingFms, paths_per_chan_per_subj, subj_i, log,
+                        crop_coords, full_dims)
+    
+    
+    # ================= Evaluate DSC for this subject ========================
+    if paths_to_lbls_per_subj is not None:  # GT was provided.
+        metrics_per_subj_per_c = calc_metrics_for_subject(metrics_per_subj_per_c, subj_i,
+                                                          pred_seg_u, pred_seg_u_in_roi,
+                                                          gt_lbl_u, gt_lbl_u_in_roi,
+                                                          n_classes, NA_PATTERN)
+        report_metrics_for_subject(log, metrics_per_subj_per_c, subj_i, NA_PATTERN, val_test_print)
+    
+    return metrics_per_subj_per_c
+
+
 def inference_on_whole_volumes(sessionTf,
                                cnn3d,
                                log,
@@ -498,11 +868,24 @@ def inference_on_whole_volumes(sessionTf,
                                idxs_fms_to_save,
                                namesForSavingFms,
                                # Sampling
-                               inp_shapes_per_path):
+                               inp_shapes_per_path,
+                               # Inference
+                               infer_prms=None,
+                               return_metrics_per_subj=False):
     # save_fms_flag: should contain an entry per pathwayType, even if just []...
     #       ... If not [], the list should contain one entry per layer of the pathway, even if just [].
     #       ... The layer entries, if not [], they should have to integers, lower and upper FM to visualise.
     #       ... Excluding the highest index.
+    # infer_prms: None for default (tiling). Otherwise dictionary, see TestSessionParameters:
+    #       ... 'slabs': If True, segment by whole-volume slabs instead of tiles. Requires graph with dynamic dims.
+    #       ... 'slab_mem_budget_mb': Max memory for the forward pass of a slab. None: One slab per volume.
+    #       ... 'pipelined': If True, load next and save previous subject in background, while predicting current.
+    #       ... 'memmap_dir': If not None, output prob maps and FMs are backed by scratch files in this folder.
+    #       ... 'labels_only': If True, only the segmentation is made while stitching, no prob maps per class.
+    #       ... 'max_prob': In labels_only mode, also make and save the probability of the predicted class.
+    #       ... 'crop_to_roi': If True, each subject is cropped to the bounding box of its ROI (plus receptive field).
+    #       ... 'bucket_shapes': If True, shapes given to the net are padded to few sizes. For a net compiled by XLA.
+    # return_metrics_per_subj: If True, also return the metrics of each subject, eg to merge them over processes.
 
     val_test_print = "Validation" if val_or_test == "val" else "Testing"
     
@@ -513,6 +896,10 @@ def inference_on_whole_volumes(sessionTf,
 
     t_start = time.time()
 
+    if infer_prms is None:
+        infer_prms = {'slabs': False, 'slab_mem_budget_mb': None, 'pipelined': False, 'memmap_dir': None,
+                      'labels_only': False, 'max_prob': False, 'crop_to_roi': False, 'bucket_shapes': False}
+
     NA_PATTERN = AccuracyMonitorForEpSegm.NA_PATTERN
     n_classes = cnn3d.num_classes
     n_subjects = len(paths_per_chan_per_subj)
@@ -527,83 +914,96 @@ def inference_on_whole_volumes(sessionTf,
                               "dice2": [[-1] * n_classes for _ in range(n_subjects)],
                               "dice3": [[-1] * n_classes for _ in range(n_subjects)]}
     
-    for subj_i in range(n_subjects):
-        log.print3("")
-        log.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        log.print3("~~~~~~~~\t Segmenting subject with index #" + str(subj_i) + " \t~~~~~~~~")
-        
-        (channels,  # nparray [channels,dim0,dim1,dim2]
-         gt_lbl_img,
-         roi_mask,
-         _) = load_imgs_of_subject(log, "",
-                                   subj_i,
-                                   paths_per_chan_per_subj,
-                                   paths_to_lbls_per_subj,
-                                   None, # weightmaps, not for test
-                                   paths_to_masks_per_subj)
-        (channels,
-        gt_lbl_img,
-        roi_mask,
-        _,
-        pad_left_right_per_axis) = preproc_imgs_of_subj(log, "",
-                                                        channels, gt_lbl_img, roi_mask, None,
-                                                        run_input_checks, n_classes, # checks
-                                                        pad_input, unpred_margin,
-                                                        norm_prms)
+    # Pipelining: While subject k is predicted, subject k+1 is loaded and subject k-1 is saved and evaluated.
+    # Threads rather than processes, so that volumes are not pickled between them. Loading (gzip) and saving
+    # mostly run in numpy, zlib and nibabel, and the forward pass in TF, which all release the GIL.
+    mp_pool_load = None
+    mp_pool_save = None
+    if infer_prms['pipelined']:
+        mp_pool_load = ThreadPool(processes=1)  # Or multiprocessing.Pool(...), same API.
+        mp_pool_save = ThreadPool(processes=1)
+    args_for_loading = [log, paths_per_chan_per_subj, paths_to_lbls_per_subj, paths_to_masks_per_subj,
+                        run_input_checks, n_classes, pad_input, unpred_margin, norm_prms,
+                        infer_prms['crop_to_roi'], cnn3d.calc_outp_dims_given_inp(inp_shapes_per_path[0]),
+                        calc_context_of_subsampl_segments(cnn3d, inp_shapes_per_path[0])]
+    loading_job = None
+    saving_jobs = []  # Submitted and not yet finished. At most one waits, while another is being saved.
     
-        # ============== Augmentation ==================
-        # TODO: Add augmentation here. And aggregate results after prediction of the whole volumes
-        
-        # ============== Predict whole volume ==================
-        # array_fms_to_save will be None if not saving them.
-        (prob_maps_vols,
-         array_fms_to_save) = predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
-                                                             channels, roi_mask, inp_shapes_per_path, unpred_margin, 
-                                                             batchsize, save_fms_flag, idxs_fms_to_save )
-        
-        # ========================== Post-Processing =========================
-        pred_seg = np.argmax(prob_maps_vols, axis=0)  # The segmentation.
-
-        # Unpad all images.        
-        pred_seg_u          = unpad_img(pred_seg, pad_input, pad_left_right_per_axis)
-        gt_lbl_u            = unpad_img(gt_lbl_img, pad_input, pad_left_right_per_axis)
-        roi_mask_u          = unpad_img(roi_mask, pad_input, pad_left_right_per_axis)
-        prob_maps_vols_u    = unpad_list_of_imgs(prob_maps_vols, pad_input, pad_left_right_per_axis)
-        array_fms_to_save_u = unpad_list_of_imgs(array_fms_to_save, pad_input, pad_left_right_per_axis)
-        
-        # Poster-process outside the ROI, e.g. by deleting any predictions outside it.
-        pred_seg_u_in_roi = pred_seg_u if roi_mask_u is None else pred_seg_u * roi_mask_u
-        gt_lbl_u_in_roi = gt_lbl_u if (gt_lbl_u is None or roi_mask_u is None) else gt_lbl_u * roi_mask_u
-        for c in range(n_classes):
-            prob_map = prob_maps_vols_u[c]
-            prob_maps_vols_u[c] = prob_map if roi_mask_u is None else prob_map * roi_mask_u
-        prob_maps_vols_u_in_roi = prob_maps_vols_u # Just to follow naming convention for clarity.
-        
-        # ======================= Save Output Volumes ========================
-        # Save predicted segmentations
-        save_pred_seg(pred_seg_u_in_roi,
-                      savePredictedSegmAndProbsDict["segm"], suffixForSegmAndProbsDict["segm"],
-                      namesForSavingSegmAndProbs, paths_per_chan_per_subj, subj_i, log)
-
-        # Save probability maps
-        save_prob_maps(prob_maps_vols_u_in_roi,
-                       savePredictedSegmAndProbsDict["prob"], suffixForSegmAndProbsDict["prob"],
-                       namesForSavingSegmAndProbs, paths_per_chan_per_subj, subj_i, log)
-
-        # Save feature maps
-        save_fms_individual(save_fms_flag, array_fms_to_save_u, cnn3d.pathways, idxs_fms_to_save,
-                            namesForSavingFms, paths_per_chan_per_subj, subj_i, log)
-        
-        
-        # ================= Evaluate DSC for this subject ========================
-        if paths_to_lbls_per_subj is not None:  # GT was provided.
-            metrics_per_subj_per_c = calc_metrics_for_subject(metrics_per_subj_per_c, subj_i,
-                                                              pred_seg_u, pred_seg_u_in_roi,
-                                                              gt_lbl_u, gt_lbl_u_in_roi,
-                                                              n_classes, NA_PATTERN)
-            report_metrics_for_subject(log, metrics_per_subj_per_c, subj_i, NA_PATTERN, val_test_print)
+    try:
+        if mp_pool_load is not None and n_subjects > 0:
+            loading_job = mp_pool_load.apply_async(load_and_preproc_subject, [0] + args_for_loading)
+        for subj_i in range(n_subjects):
+            log.print3("")
+            log.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+            log.print3("~~~~~~~~\t Segmenting subject with index #" + str(subj_i) + " \t~~~~~~~~")
+            
+            if mp_pool_load is None:  # Sequential processing.
+                (channels,  # nparray [channels,dim0,dim1,dim2]
+                 gt_lbl_img,
+                 roi_mask,
+                 pad_left_right_per_axis,
+                 crop_coords,
+                 full_dims,
+                 border_int_per_chan) = load_and_preproc_subject(*([subj_i] + args_for_loading))
+            else:
+                (channels,
+                 gt_lbl_img,
+                 roi_mask,
+                 pad_left_right_per_axis,
+                 crop_coords,
+                 full_dims,
+                 border_int_per_chan) = loading_job.get()
+                if subj_i + 1 < n_subjects:  # Load next subject while this one is predicted.
+                    loading_job = mp_pool_load.apply_async(load_and_preproc_subject, [subj_i + 1] + args_for_loading)
+            
+            # ============== Augmentation ==================
+            # TODO: Add augmentation here. And aggregate results after prediction of the whole volumes
+            
+            # ============== Predict whole volume ==================
+            # array_fms_to_save will be None if not saving them.
+            (prob_maps_vols,
+             array_fms_to_save,
+             pred_seg,
+             max_prob_vol) = predict_whole_volume(log, sessionTf, cnn3d,
+                                                  channels, roi_mask, inp_shapes_per_path, unpred_margin,
+                                                  batchsize, save_fms_flag, idxs_fms_to_save, infer_prms,
+                                                  border_int_per_chan)
+            del channels
+            
+            # ============== Post-process, save and evaluate ==================
+            args_for_saving = [log, cnn3d, subj_i,
+                               prob_maps_vols, array_fms_to_save, pred_seg, max_prob_vol, gt_lbl_img, roi_mask,
+                               pad_input, pad_left_right_per_axis, crop_coords, full_dims,
+                               savePredictedSegmAndProbsDict, suffixForSegmAndProbsDict,
+                               namesForSavingSegmAndProbs, paths_per_chan_per_subj,
+                               save_fms_flag, idxs_fms_to_save, namesForSavingFms,
+                               paths_to_lbls_per_subj, metrics_per_subj_per_c, NA_PATTERN, val_test_print,
+                               infer_prms['memmap_dir']]
+            if mp_pool_save is None:  # Sequential processing.
+                postproc_save_and_eval_subject(*args_for_saving)
+            else:
+                saving_jobs.append(mp_pool_save.apply_async(postproc_save_and_eval_subject, args_for_saving))
+                if len(saving_jobs) > 1:  # Bound the subjects in flight. Wait for previous before next prediction.
+                    saving_jobs.pop(0).get()
+            # Done with subject.
+            
+        for saving_job in saving_jobs:
+            saving_job.get()
             
-        # Done with subject.
+    except (Exception, KeyboardInterrupt) as e:
+        if mp_pool_load is not None:
+            log.print3("Terminating worker pools of inference.")
+            mp_pool_load.terminate()
+            mp_pool_save.terminate()
+            mp_pool_load.join()  # Will wait. A KeybInt will kill this (py3)
+            mp_pool_save.join()
+        raise e
+    else:
+        if mp_pool_load is not None:
+            mp_pool_load.close()
+            mp_pool_save.close()
+            mp_pool_load.join()
+            mp_pool_save.join()
         
     # ==================== Report average Dice Coefficient over all subjects ==================
     mean_metrics = None # To return something even if ground truth has not been given (in testing)
@@ -616,4 +1016,6 @@ def inference_on_whole_volumes(sessionTf,
     log.print3("#\t\t  Finished full Segmentation of " + str(val_test_print) + " subjects   \t\t\t#")
     log.print3("##########################################################################################")
 
+    if return_metrics_per_subj:
+        return mean_metrics, metrics_per_subj_per_c
     return mean_metrics
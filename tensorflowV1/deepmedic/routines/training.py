@@ -28,72 +28,64 @@ def process_in_batches(log,
                        train_or_val,
                        n_batches,
                        batchsize,
+                       n_steps_per_run,
                        cnn3d,
                        acc_monitor_ep,
                        channs_samples_per_path,
                        lbls_samples_per_path):
     # Processes batches of subepoch. Performs training or validation. Collects performance metrics.
+    # n_steps_per_run: Training only. Batches processed by each session run, in a loop in the graph (see Cnn3d).
 
     costs_of_batches = []
-    # Each row of array below holds number of:
-    #     Real Positives, Real Neg, True Predicted Pos, True Predicted Neg in subepoch, in this order.
-    arr_RpRnTpTn_per_class_in_subep = np.zeros([cnn3d.num_classes, 4], dtype="int32")
     
     prefix_progress_str = '[TRAINING]' if train_or_val == 'train' else '[VALIDATION]'
+    
+    # Give the samples of the subepoch to the input pipeline, once. Steps then read prefetched batches from it.
+    # Also reset the counts of real pos, real neg, true pred pos, true pred neg, that the steps accumulate in the graph.
+    feeds = cnn3d.get_main_feeds(train_or_val)
+    feeds_dict = {feeds['x']: channs_samples_per_path[0]}
+    for subs_path_i in range(cnn3d.numSubsPaths):
+        feeds_dict.update({feeds['x_sub_' + str(subs_path_i)]: channs_samples_per_path[subs_path_i + 1]})
+    feeds_dict.update({feeds['y_gt']: lbls_samples_per_path})
+    feeds_dict.update({feeds['batchsize']: batchsize})
+    sessionTf.run(fetches=[cnn3d.get_main_ops(train_or_val)['init_inp_pipeline'],
+                           cnn3d.get_main_ops(train_or_val)['reset_rp_rn_tp_tn_subep']], feed_dict=feeds_dict)
+    
     print_progress_step_tr_val(log, n_batches, 0, batchsize, prefix_progress_str)
-    for batch_i in range(n_batches):
+    for batch_i in range(0, n_batches, n_steps_per_run):
+        n_steps = min(n_steps_per_run, n_batches - batch_i)  # Last run of subepoch may do fewer steps.
 
         if train_or_val == "train":
             ops_to_fetch = cnn3d.get_main_ops('train')
-            list_of_ops = [ops_to_fetch['cost']] + ops_to_fetch['list_rp_rn_tp_tn'] +\
-                            [ops_to_fetch['updates_grouped_op']]
-
-            min_idx_batch = batch_i * batchsize
-            max_idx_batch = (batch_i + 1) * batchsize
-
-            feeds = cnn3d.get_main_feeds('train')
-            feeds_dict = {feeds['x']: channs_samples_per_path[0][min_idx_batch: max_idx_batch]}
-            for subs_path_i in range(cnn3d.numSubsPaths):
-                x_batch_sub_path = channs_samples_per_path[subs_path_i + 1][min_idx_batch: max_idx_batch]
-                feeds_dict.update({feeds['x_sub_' + str(subs_path_i)]: x_batch_sub_path})
-            feeds_dict.update({feeds['y_gt']: lbls_samples_per_path[min_idx_batch: max_idx_batch]})
-            # Training step. Returns a list containing the results of fetched ops.
-            results_of_run = sessionTf.run(fetches=list_of_ops, feed_dict=feeds_dict)
+            list_of_ops = [ops_to_fetch['cost'], ops_to_fetch['updates_grouped_op']]
+            # Steps per run are fixed in the graph, unless fed.
+            feeds_dict = {feeds['n_steps']: n_steps} if 'n_steps' in feeds else {}
 
-            cnn3d.update_arrays_of_bn_moving_avg(sessionTf)  # I should put this inside the model.
+            # Training step(s). Returns a list containing the results of fetched ops.
+            # Also updates the rolling averages of BN and the counts of the subepoch.
+            results_of_run = sessionTf.run(fetches=list_of_ops, feed_dict=feeds_dict)
 
-            cost_this_batch = results_of_run[0]
-            list_RpRnPpPn_per_class = results_of_run[1:-1]  # [-1] is from updates_grouped_op, returns nothing
+            cost_this_batch = results_of_run[0]  # Mean over the steps. [1] is from updates_grouped_op, returns nothing
             
         else:  # validation
             ops_to_fetch = cnn3d.get_main_ops('val')
-            list_of_ops = ops_to_fetch['list_rp_rn_tp_tn']
-
-            min_idx_batch = batch_i * batchsize
-            max_idx_batch = (batch_i + 1) * batchsize
-
-            feeds = cnn3d.get_main_feeds('val')
-            feeds_dict = {feeds['x']: channs_samples_per_path[0][min_idx_batch: max_idx_batch]}
-            for subs_path_i in range(cnn3d.numSubsPaths):
-                x_batch_sub_path = channs_samples_per_path[subs_path_i + 1][min_idx_batch: max_idx_batch]
-                feeds_dict.update({feeds['x_sub_' + str(subs_path_i)]: x_batch_sub_path})
-            feeds_dict.update({feeds['y_gt']: lbls_samples_per_path[min_idx_batch: max_idx_batch]})
-            # Validation step. Returns a list containing the results of fetched ops.
-            results_of_run = sessionTf.run(fetches=list_of_ops, feed_dict=feeds_dict)
+
+            # Validation step. Only updates the counts of the subepoch.
+            sessionTf.run(fetches=ops_to_fetch['acc_rp_rn_tp_tn'])
 
             cost_this_batch = 999  # placeholder in case of validation.
-            list_RpRnPpPn_per_class = results_of_run
         
-        # list_RpRnPpPn_per_class holds Real Pos, Real Neg, True Pred Pos, True Pred Neg ...
-        # ... for all classes, in this order, flattened. First RpRnTpTn are for 'WHOLE' class.
-        arr_RpRnTpTn_per_class = np.asarray(list_RpRnPpPn_per_class, dtype="int32")
-        arr_RpRnTpTn_per_class = arr_RpRnTpTn_per_class.reshape(arr_RpRnTpTn_per_class_in_subep.shape, order='C')
-
         # To later calculate the mean error and cost over the subepoch
-        costs_of_batches.append(cost_this_batch)  # only really used in training.
-        arr_RpRnTpTn_per_class_in_subep += arr_RpRnTpTn_per_class
+        costs_of_batches += [cost_this_batch] * n_steps  # only really used in training.
 
-        print_progress_step_tr_val(log, n_batches, batch_i + 1, batchsize, prefix_progress_str)
+        print_progress_step_tr_val(log, n_batches, batch_i + n_steps, batchsize, prefix_progress_str)
+    
+    if train_or_val == "train":  # Rolling averages of BN changed. Once per subepoch, rather than every batch.
+        cnn3d.refresh_bn_inference_stats(sessionTf)
+    
+    # Each row of array below holds number of:
+    #     Real Positives, Real Neg, True Predicted Pos, True Predicted Neg in subepoch, in this order.
+    arr_RpRnTpTn_per_class_in_subep = sessionTf.run(fetches=cnn3d.get_main_ops(train_or_val)['arr_rp_rn_tp_tn_subep'])
         
     # ======== Calculate and Report accuracy over subepoch
     # In case of validation, mean_cost_subep is just a placeholder.
@@ -146,6 +138,7 @@ def do_training(sessionTf,
                 # Instance of the deepmedic/samplingType.SamplingType class for training and validation
                 sampling_type_inst_val,
                 batchsize_train,
+                n_steps_per_run_train,  # Optimization steps per session run, in a loop in the graph.
                 batchsize_val_samples,
                 batchsize_val_whole,
 
@@ -168,6 +161,8 @@ def do_training(sessionTf,
                 # -------- Pre-processing ------
                 pad_input,
                 norm_prms,
+                # -------- Compilation ------
+                use_xla,
                 #--------- Sampling Hyperparamas -----
                 inp_shapes_per_path_train,
                 inp_shapes_per_path_val,
@@ -178,6 +173,9 @@ def do_training(sessionTf,
     # I cannot pass cnn3d to the sampling function, because the pp module used to reload theano. 
     # This created problems in the GPU when cnmem is used. Not sure this is needed with Tensorflow. Probably.
     cnn3dWrapper = CnnWrapperForSampling(cnn3d)
+    # Validation on whole volumes tiles by default. If the net is compiled, pad shapes of batches to few sizes.
+    infer_prms_val_whole = {'slabs': False, 'slab_mem_budget_mb': None, 'pipelined': False, 'memmap_dir': None,
+                            'labels_only': False, 'max_prob': False, 'crop_to_roi': False, 'bucket_shapes': use_xla}
 
     args_for_sampling_tr = (log,
                             "train",
@@ -299,6 +297,7 @@ def do_training(sessionTf,
                                        "val",
                                        n_batches_val,
                                        batchsize_val_samples,
+                                       1,
                                        cnn3d,
                                        acc_monitor_ep_val,
                                        channs_samples_per_path_val,
@@ -348,10 +347,13 @@ def do_training(sessionTf,
                                    "train",
                                    n_batches_train,
                                    batchsize_train,
+                                   n_steps_per_run_train,
                                    cnn3d,
                                    acc_monitor_ep_tr,
                                    channs_samples_per_path_tr,
                                    lbls_samples_per_path_tr)
+                # Batches of gradient accumulation left from this subepoch update now, not with the next one's.
+                trainer.run_flush_accum_grads(sessionTf)
                 log.print3("TIMING: Training on batches of this subepoch #" + str(subep) +\
                            " lasted: {0:.1f}".format(time.time() - start_time_train_subep) + " secs.")
 
@@ -401,7 +403,8 @@ def do_training(sessionTf,
                                                                          save_fms_flag,
                                                                          idxs_fms_to_save,
                                                                          namesForSavingFms,
-                                                                         inp_shapes_per_path_test)
+                                                                         inp_shapes_per_path_test,
+                                                                         infer_prms_val_whole)
                 
                 acc_monitor_ep_val.report_metrics_whole_vols(mean_metrics_val_whole_vols)
 
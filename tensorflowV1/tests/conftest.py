@@ -0,0 +1,152 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+# Fixtures shared by the tests. They build small models on cpu, with tf.compat.v1 graphs as the rest of deepmedic.
+# Run from the folder of setup.py with: python -m pytest tests
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # To import deepmedic uninstalled.
+tf.compat.v1.disable_eager_execution()
+
+from deepmedic.logging.loggers import Logger
+from deepmedic.frontEnd.configParsing.modelConfig import ModelConfig
+from deepmedic.frontEnd.configParsing.modelParams import ModelParameters
+from deepmedic.neuralnet.cnn3d import Cnn3d
+from deepmedic.neuralnet.trainer import Trainer
+
+# A model small enough to train in a few secs on cpu. No dropout, so that training is deterministic.
+SMALL_MODEL_CFG = """
+modelName = "testModel"
+numberOfOutputClasses = 3
+numberOfInputChannels = 2
+numberFMsPerLayerNormal = [4, 5, 6]
+kernelDimPerLayerNormal = [[3,3,3], [3,3,3], [3,3,3]]
+useSubsampledPathway = True
+numberFMsPerLayerSubsampled = [4, 5, 6]
+subsampleFactor = [3,3,3]
+numberFMsPerLayerFC = [7]
+dropoutRatesFc = [0.0, 0.0]
+segmentsDimTrain = [13,13,13]
+segmentsDimVal = [13,13,13]
+segmentsDimInference = [13,13,13]
+"""
+
+
+@pytest.fixture
+def log(tmp_path):
+    return Logger(str(tmp_path / "log.txt"))
+
+
+@pytest.fixture
+def make_model_params(log, tmp_path):
+    # Returns a function that makes the parameters of the small model. Lines in extra_cfg override its config.
+    def make(extra_cfg=""):
+        path_cfg = tmp_path / "modelConfig.cfg"
+        path_cfg.write_text(SMALL_MODEL_CFG + extra_cfg)
+        return ModelParameters(log, ModelConfig(str(path_cfg)))
+    return make
+
+
+@pytest.fixture
+def build_train_graph(log):
+    # Returns a function that builds the training graph of a model as trainSession does, in its own graph and session.
+    # optimizer: 0 for SGD, 1 for Adam, 2 for RmsProp. Learning rate and momentum are the defaults of the config.
+    # Returns: sessionTf, cnn3d, trainer, inp_shapes_per_path. All variables are initialized.
+    def build(model_params, n_steps_per_run=1, n_batches_per_update=1, optimizer=0, fused_ops=False):
+        graphTf = tf.Graph()
+        with graphTf.as_default():
+            cnn3d = Cnn3d()
+            with tf.compat.v1.variable_scope("net"):
+                cnn3d.make_cnn_model(*model_params.get_args_for_arch())
+                inp_pipeline, inp_shapes_per_path = cnn3d.create_inp_pipeline(model_params.get_inp_dims_hr_path('train'), 'train')
+            with tf.compat.v1.variable_scope("trainer"):
+                trainer = Trainer(log, [[], [], []], {"xentr": 1., "iou": None, "dsc": None}, 0.000001, 0.0001,
+                                  {"type": None, "prms": None, "schedule": [0, 1]}, n_batches_per_update, cnn3d)
+                trainer.create_optimizer(log, optimizer, {'type': 'stable'}, 0.001, 0.6, 1, 1, 0.9, 0.999, 1e-8, 0.9, 1e-4,
+                                         fused_ops)
+
+            def make_train_step(batch):
+                (p_y_given_x, logits) = cnn3d.apply(batch, 'train', 'train', verbose=False, log=log, ret_logits=True)
+                trainer.compute_costs(log, p_y_given_x, logits, batch['y_gt'])
+                return p_y_given_x, trainer.get_total_cost(), trainer.get_param_updates_wrt_total_cost()
+
+            cnn3d.setup_ops_n_feeds_to_train(log, inp_pipeline, make_train_step, n_steps_per_run)
+            # Net before trainer, as in trainSession, because the initial state of the optimizer reads the net's params.
+            init_ops = [tf.compat.v1.variables_initializer(var_list=graphTf.get_collection(key, scope=scope))
+                        for key in [tf.compat.v1.GraphKeys.GLOBAL_VARIABLES, tf.compat.v1.GraphKeys.LOCAL_VARIABLES]
+                        for scope in ["net", "trainer"]]
+        sessionTf = tf.compat.v1.Session(graph=graphTf)
+        for init_op in init_ops:
+            sessionTf.run(init_op)
+        cnn3d.refresh_bn_inference_stats(sessionTf)
+        return sessionTf, cnn3d, trainer, inp_shapes_per_path
+    return build
+
+
+def get_net_vars(sessionTf):
+    return sessionTf.graph.get_collection(tf.compat.v1.GraphKeys.GLOBAL_VARIABLES, scope="net")
+
+
+@pytest.fixture
+def copy_net_vars():
+    # Returns a function that copies the values of the net's variables between two sessions of the same model.
+    def copy(sess_from, sess_to):
+        for var_from, var_to in zip(get_net_vars(sess_from), get_net_vars(sess_to)):
+            assert var_from.op.name == var_to.op.name
+            var_to.load(sess_from.run(var_from), sess_to)
+    return copy
+
+
+@pytest.fixture
+def read_net_vars():
+    # Returns a function that returns a dictionary with the values of the net's variables, by name.
+    def read(sessionTf):
+        return {var.op.name: sessionTf.run(var) for var in get_net_vars(sessionTf)}
+    return read
+
+
+@pytest.fixture
+def make_train_samples():
+    # Returns a function that makes random samples for training, as fed to the input pipeline of cnn3d.
+    def make(cnn3d, inp_shapes_per_path, n_samples, seed=0):
+        rng = np.random.RandomState(seed)
+        n_chans = cnn3d.pathways[0].get_n_fms_in()
+        channs_per_path = [rng.normal(size=[n_samples, n_chans] + list(inp_shapes_per_path[path_i])).astype("float32")
+                           for path_i in range(1 + cnn3d.numSubsPaths)]
+        outp_dims = cnn3d.calc_outp_dims_given_inp(inp_shapes_per_path[0])
+        lbls = rng.randint(0, cnn3d.num_classes, size=[n_samples] + list(outp_dims)).astype("int32")
+        return channs_per_path, lbls
+    return make
+
+
+@pytest.fixture
+def run_train_subepoch():
+    # Returns a function that trains on the given samples, as training.process_in_batches(), and returns the mean cost.
+    def run(sessionTf, cnn3d, channs_per_path, lbls, batchsize, n_steps_per_run=1):
+        feeds = cnn3d.get_main_feeds('train')
+        ops = cnn3d.get_main_ops('train')
+        feeds_dict = {feeds['x']: channs_per_path[0], feeds['y_gt']: lbls, feeds['batchsize']: batchsize}
+        for subs_path_i in range(cnn3d.numSubsPaths):
+            feeds_dict[feeds['x_sub_' + str(subs_path_i)]] = channs_per_path[subs_path_i + 1]
+        sessionTf.run([ops['init_inp_pipeline'], ops['reset_rp_rn_tp_tn_subep']], feed_dict=feeds_dict)
+        n_batches = len(lbls) // batchsize
+        costs_of_batches = []
+        for batch_i in range(0, n_batches, n_steps_per_run):
+            n_steps = min(n_steps_per_run, n_batches - batch_i)
+            feeds_dict = {feeds['n_steps']: n_steps} if 'n_steps' in feeds else {}
+            (cost, _) = sessionTf.run([ops['cost'], ops['updates_grouped_op']], feed_dict=feeds_dict)
+            costs_of_batches += [cost] * n_steps
+        return np.mean(costs_of_batches)
+    return run
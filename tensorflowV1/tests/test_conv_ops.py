@@ -0,0 +1,70 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+# Depthwise and grouped convs must equal conv_3d with the equivalent dense weights.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from deepmedic.neuralnet import ops
+
+N_CHANS = 6
+KERN_DIMS = [3, 2, 3] # Even dim too, for uneven zero-padding.
+INP_SHAPE = [2, 9, 8, 7, N_CHANS] # Channels-last.
+
+
+def run_ops_static_and_dynamic(make_op, inp):
+    # Applies the op on the input given as a constant (static shape) and fed to a placeholder of unknown dims.
+    # Returns: Output on the constant, output on the placeholder, static shape of the output on the constant.
+    with tf.Graph().as_default():
+        inp_plchldr = tf.compat.v1.placeholder(dtype="float32", shape=[None, None, None, None, N_CHANS])
+        outp_static = make_op(tf.constant(inp))
+        outp_dynamic = make_op(inp_plchldr)
+        with tf.compat.v1.Session() as sessionTf:
+            (outp_static_val, outp_dynamic_val) = sessionTf.run([outp_static, outp_dynamic], feed_dict={inp_plchldr: inp})
+    return outp_static_val, outp_dynamic_val, outp_static.shape.as_list()
+
+
+@pytest.mark.parametrize("padding", ["VALID", "ZERO", "MIRROR"])
+def test_depthwise_conv_equals_dense_conv(padding):
+    rng = np.random.RandomState(0)
+    inp = rng.normal(size=INP_SHAPE).astype("float32")
+    w_dw = rng.normal(size=[N_CHANS, 1] + KERN_DIMS).astype("float32")
+    w_dense = np.zeros([N_CHANS, N_CHANS] + KERN_DIMS, dtype="float32") # Diagonal: Each output channel from its input.
+    for chan_i in range(N_CHANS):
+        w_dense[chan_i, chan_i] = w_dw[chan_i, 0]
+    
+    (outp_dw, outp_dw_dyn, shape_dw) = run_ops_static_and_dynamic(lambda x: ops.depthwise_conv_3d(x, tf.constant(w_dw), padding), inp)
+    (outp_dense, _, shape_dense) = run_ops_static_and_dynamic(lambda x: ops.conv_3d(x, tf.constant(w_dense), padding), inp)
+    assert shape_dw == shape_dense # Static shape is kept.
+    np.testing.assert_allclose(outp_dw, outp_dense, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(outp_dw_dyn, outp_dense, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("padding", ["VALID", "ZERO", "MIRROR"])
+@pytest.mark.parametrize("n_groups", [2, 3])
+def test_grouped_conv_equals_dense_conv(padding, n_groups):
+    rng = np.random.RandomState(0)
+    inp = rng.normal(size=INP_SHAPE).astype("float32")
+    n_fms_out = 4 * n_groups
+    n_chans_per_group = N_CHANS // n_groups
+    n_fms_out_per_group = n_fms_out // n_groups
+    w_grouped = rng.normal(size=[n_fms_out, n_chans_per_group] + KERN_DIMS).astype("float32")
+    w_dense = np.zeros([n_fms_out, N_CHANS] + KERN_DIMS, dtype="float32") # Block diagonal: Groups of outputs from their inputs.
+    for group_i in range(n_groups):
+        fms_out_of_group = slice(group_i * n_fms_out_per_group, (group_i + 1) * n_fms_out_per_group)
+        w_dense[fms_out_of_group, group_i * n_chans_per_group: (group_i + 1) * n_chans_per_group] = w_grouped[fms_out_of_group]
+    
+    (outp_gr, outp_gr_dyn, shape_gr) = run_ops_static_and_dynamic(
+        lambda x: ops.grouped_conv_3d(x, tf.constant(w_grouped), n_groups, padding), inp)
+    (outp_dense, _, shape_dense) = run_ops_static_and_dynamic(lambda x: ops.conv_3d(x, tf.constant(w_dense), padding), inp)
+    assert shape_gr == shape_dense
+    np.testing.assert_allclose(outp_gr, outp_dense, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(outp_gr_dyn, outp_dense, rtol=1e-5, atol=1e-5)
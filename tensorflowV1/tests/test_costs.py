@@ -0,0 +1,84 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+# Cross entropy from the logits must equal the one from the log of the probabilities, in cost and gradients.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import tensorflow as tf
+
+from deepmedic.neuralnet import cost_functions as cfs
+from deepmedic.neuralnet.cnn3d import Cnn3d
+
+WEIGHT_PER_CLASS = [0.5, 1., 2.]
+
+
+def x_entr_from_probs(p_y_given_x, y_gt, weightPerClass):
+    # Reference: Weighted cross entropy from the log of the probabilities, channels-first [batch, classes, r, c, z].
+    y_one_hot = tf.one_hot(indices=y_gt, depth=tf.shape(p_y_given_x)[1], axis=1, dtype="float32")
+    weightPerClass5D = tf.reshape(weightPerClass, shape=[1, -1, 1, 1, 1])
+    return - tf.reduce_mean(tf.reduce_sum(tf.math.log(p_y_given_x) * weightPerClass5D * y_one_hot, axis=1))
+
+
+def test_x_entr_from_logits_equals_numpy():
+    rng = np.random.RandomState(0)
+    logits = rng.normal(scale=3., size=[2, 4, 5, 6, 3]).astype("float32")
+    y_gt = rng.randint(0, 3, size=[2, 4, 5, 6]).astype("int32")
+    logits[0, 0, 0, 0] = [60., 0., 0.] # Probabilities far below the eps of log(p + eps). Cost must not be clipped.
+    y_gt[0, 0, 0, 0] = 1
+    with tf.Graph().as_default():
+        logits_tf = tf.constant(logits)
+        cost = cfs.x_entr(logits_tf, tf.constant(y_gt), tf.constant(WEIGHT_PER_CLASS))
+        grad = tf.gradients(cost, logits_tf)[0]
+        with tf.compat.v1.Session() as sessionTf:
+            (cost_val, grad_val) = sessionTf.run([cost, grad])
+    
+    logits_64 = logits.astype("float64")
+    log_p = logits_64 - logits_64.max(axis=-1, keepdims=True)
+    log_p = log_p - np.log(np.exp(log_p).sum(axis=-1, keepdims=True))
+    y_one_hot = np.eye(3)[y_gt]
+    w_per_voxel = np.array(WEIGHT_PER_CLASS)[y_gt]
+    cost_np = - np.mean(w_per_voxel * (log_p * y_one_hot).sum(axis=-1))
+    grad_np = w_per_voxel[..., np.newaxis] * (np.exp(log_p) - y_one_hot) / y_gt.size
+    np.testing.assert_allclose(cost_val, cost_np, rtol=1e-5)
+    np.testing.assert_allclose(grad_val, grad_np, rtol=1e-4, atol=1e-8)
+
+
+def test_x_entr_of_net_from_logits_equals_from_probs(log, make_model_params):
+    model_params = make_model_params()
+    with tf.Graph().as_default():
+        cnn3d = Cnn3d()
+        with tf.compat.v1.variable_scope("net"):
+            cnn3d.make_cnn_model(*model_params.get_args_for_arch())
+            (inp_plchldrs, inp_shapes_per_path) = cnn3d.create_inp_plchldrs(model_params.get_inp_dims_hr_path('train'), 'train')
+        (p_y_given_x, logits) = cnn3d.apply(inp_plchldrs, 'train', 'train', verbose=False, log=log, ret_logits=True)
+        outp_dims = cnn3d.calc_outp_dims_given_inp(inp_shapes_per_path[0])
+        y_gt = tf.constant(np.random.RandomState(1).randint(0, 3, size=[2] + list(outp_dims)).astype("int32"))
+        weightPerClass = tf.constant(WEIGHT_PER_CLASS)
+        cost_logits = cfs.x_entr(logits, y_gt, weightPerClass)
+        cost_probs = x_entr_from_probs(p_y_given_x, y_gt, weightPerClass)
+        params = cnn3d.params_for_L1_L2_reg() # Conv weights of all blocks.
+        grads_logits = tf.gradients(cost_logits, params)
+        grads_probs = tf.gradients(cost_probs, params)
+        
+        rng = np.random.RandomState(0)
+        feeds_dict = {inp_plchldrs[key]: rng.normal(size=[2, cnn3d.pathways[0].get_n_fms_in()] + list(shape)).astype("float32")
+                      for key, shape in zip(['x'] + ['x_sub_' + str(i) for i in range(cnn3d.numSubsPaths)], inp_shapes_per_path)}
+        with tf.compat.v1.Session() as sessionTf:
+            sessionTf.run(tf.compat.v1.global_variables_initializer())
+            sessionTf.run(tf.compat.v1.local_variables_initializer())
+            (p_val, logits_val, cost_logits_val, cost_probs_val) = sessionTf.run([p_y_given_x, logits, cost_logits, cost_probs],
+                                                                                 feed_dict=feeds_dict)
+            (grads_logits_val, grads_probs_val) = sessionTf.run([grads_logits, grads_probs], feed_dict=feeds_dict)
+    
+    # Logits are channels-last, probabilities channels-first.
+    p_from_logits = np.exp(logits_val) / np.exp(logits_val).sum(axis=-1, keepdims=True)
+    np.testing.assert_allclose(np.moveaxis(p_from_logits, -1, 1), p_val, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(cost_logits_val, cost_probs_val, rtol=1e-5)
+    for grad_logits_val, grad_probs_val in zip(grads_logits_val, grads_probs_val):
+        np.testing.assert_allclose(grad_logits_val, grad_probs_val, rtol=1e-3, atol=1e-7)
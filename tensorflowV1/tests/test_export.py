@@ -0,0 +1,96 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+# The frozen graph for inference, with BN, biases and dropout folded, must predict as the model.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from deepmedic.neuralnet.cnn3d import Cnn3d
+from deepmedic.routines.export import export_frozen_inference_graph, load_frozen_inference_graph_def, \
+    import_frozen_inference_graph
+from deepmedic.routines.testing import prepare_feeds_dict
+
+# Lines added to the config of the small model.
+CONFIGS = { "default": "",
+            "relu": 'activationFunction = "relu"\n',
+            "residual_prelu": "layersWithResidualConnNormal = [2, 3]\nlayersWithResidualConnFC = [2]\n" +
+                              "numberFMsPerLayerFC = [7, 8]\ndropoutRatesFc = [0.0, 0.0, 0.0]\n",
+            "dropout": "dropoutRatesNormal = [0.1, 0.2, 0.3]\ndropoutRatesSubsampled = [0.1, 0.2, 0.5]\n" +
+                       "dropoutRatesFc = [0.5, 0.5]\n",
+            "no_subsampled": "useSubsampledPathway = False\n",
+            "no_bn": "rollAverageForBNOverThatManyBatches = 0\n",
+            "fused_bn": "useFusedBatchNorm = True\n",
+            "temperature": "softmaxTemperature = 2.\n",
+            # Convs of several weights. BN of the next block is folded only in the weights that give the outputs.
+            "depthwise_separable": "depthwiseSeparableLayersNormal = [2, 3]\ndepthwiseSeparableLayersSubsampled = [1]\n",
+            "grouped": "numberFMsPerLayerNormal = [4, 6, 8]\nnumberFMsPerLayerSubsampled = [4, 6, 8]\n" +
+                       "numberFMsPerLayerFC = [8]\ngroupedConvLayersNormal = [1, 2, 3]\ngroupedConvLayersFC = [1]\n" +
+                       "numberOfGroupsInGroupedConvs = 2\n",
+            "depthwise_grouped_residual_dropout": "numberFMsPerLayerNormal = [4, 6, 8]\nnumberFMsPerLayerSubsampled = [4, 6, 8]\n" +
+                                                  "depthwiseSeparableLayersNormal = [2]\ngroupedConvLayersNormal = [3]\n" +
+                                                  "numberOfGroupsInGroupedConvs = 2\nlayersWithResidualConnNormal = [2]\n" +
+                                                  "dropoutRatesNormal = [0.1, 0.2, 0.3]\n" }
+
+
+def randomize_net_vars(sessionTf, rng):
+    # Random params and BN statistics, so that folding them is not trivial. Negative PReLU slopes too.
+    for var in sessionTf.graph.get_collection(tf.compat.v1.GraphKeys.GLOBAL_VARIABLES, scope="net"):
+        shape = var.shape.as_list()
+        if "varBns" in var.op.name or "gBn" in var.op.name:
+            val = rng.uniform(0.3, 2., shape)
+        elif "aPrelu" in var.op.name:
+            val = rng.uniform(-0.2, 1.5, shape)
+        else:
+            val = rng.normal(0, 0.3, shape)
+        var.load(val.astype(var.dtype.as_numpy_dtype), sessionTf)
+
+
+def check_frozen_graph_predicts_as_model(log, model_params, path_frozen):
+    graphTf = tf.Graph()
+    with graphTf.as_default():
+        cnn3d = Cnn3d()
+        with tf.compat.v1.variable_scope("net"):
+            cnn3d.make_cnn_model(*model_params.get_args_for_arch())
+            (inp_plchldrs, _) = cnn3d.create_inp_plchldrs(model_params.get_inp_dims_hr_path('test'), 'test', dynamic_dims=True)
+            p_y_given_x = cnn3d.apply(inp_plchldrs, 'infer', 'test', verbose=False, log=log)
+        init_ops = [tf.compat.v1.variables_initializer(graphTf.get_collection(key, scope="net"))
+                    for key in [tf.compat.v1.GraphKeys.GLOBAL_VARIABLES, tf.compat.v1.GraphKeys.LOCAL_VARIABLES]]
+    sessionTf = tf.compat.v1.Session(graph=graphTf)
+    sessionTf.run(init_ops)
+    rng = np.random.RandomState(0)
+    randomize_net_vars(sessionTf, rng)
+    cnn3d.refresh_bn_inference_stats(sessionTf)
+    export_frozen_inference_graph(log, sessionTf, cnn3d, path_frozen)
+    
+    graph_frozen = tf.Graph()
+    with graph_frozen.as_default():
+        n_chans = cnn3d.pathways[0].get_n_fms_in()
+        inp_plchldrs_frozen = {key: tf.compat.v1.placeholder(dtype="float32", shape=[None, n_chans, None, None, None])
+                               for key in inp_plchldrs}
+        p_y_given_x_frozen = import_frozen_inference_graph(log, load_frozen_inference_graph_def(log, path_frozen),
+                                                           inp_plchldrs_frozen)
+    sessionTf_frozen = tf.compat.v1.Session(graph=graph_frozen)
+    
+    # Segments of inference size, and larger ones, as of inference by slabs.
+    for inp_dims in [model_params.get_inp_dims_hr_path('test'), [19, 17, 21]]:
+        inp_shapes_per_path = cnn3d.calc_inp_dims_of_paths_from_hr_inp(inp_dims)
+        channs_per_path = [rng.normal(size=[2, n_chans] + list(inp_shapes_per_path[path_i])).astype("float32")
+                           for path_i in range(1 + cnn3d.numSubsPaths)]
+        p_model = sessionTf.run(p_y_given_x, prepare_feeds_dict(inp_plchldrs, channs_per_path))
+        p_frozen = sessionTf_frozen.run(p_y_given_x_frozen, prepare_feeds_dict(inp_plchldrs_frozen, channs_per_path))
+        assert p_frozen.shape == p_model.shape
+        np.testing.assert_allclose(p_frozen, p_model, rtol=1e-4, atol=1e-5)
+        assert p_model.std() > 1e-2 # Predictions vary, so the comparison is not trivial.
+
+
+@pytest.mark.parametrize("config", sorted(CONFIGS))
+def test_frozen_graph_predicts_as_model(config, log, make_model_params, tmp_path):
+    check_frozen_graph_predicts_as_model(log, make_model_params(CONFIGS[config]), str(tmp_path / "frozen.pb"))
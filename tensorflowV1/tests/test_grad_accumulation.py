@@ -0,0 +1,59 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+# Accumulating the gradients of K batches per update must give the same model as one K times larger batch.
+# Without BN, whose batch statistics depend on the size of the batch.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+
+NO_BN_CFG = """
+rollAverageForBNOverThatManyBatches = 0
+"""
+
+
+def assert_net_vars_close(vars_a, vars_b):
+    assert sorted(vars_a) == sorted(vars_b)
+    for name in vars_a:
+        np.testing.assert_allclose(vars_a[name], vars_b[name], rtol=1e-4, atol=1e-6, err_msg=name)
+
+
+def test_accum_k_batches_equals_one_large_batch(make_model_params, build_train_graph, copy_net_vars, read_net_vars,
+                                                make_train_samples, run_train_subepoch):
+    model_params = make_model_params(NO_BN_CFG)
+    (sess_1, cnn3d_1, _, inp_shapes_per_path) = build_train_graph(model_params, n_batches_per_update=1)
+    (sess_k, cnn3d_k, trainer_k, _) = build_train_graph(model_params, n_batches_per_update=3)
+    copy_net_vars(sess_1, sess_k)
+    (channs_per_path, lbls) = make_train_samples(cnn3d_1, inp_shapes_per_path, n_samples=12)
+    
+    # 2 updates per subepoch. Momentum carries over between them, so its state must also advance per update.
+    for subep_i in range(2):
+        cost_1 = run_train_subepoch(sess_1, cnn3d_1, channs_per_path, lbls, batchsize=6)
+        cost_k = run_train_subepoch(sess_k, cnn3d_k, channs_per_path, lbls, batchsize=2)
+        trainer_k.run_flush_accum_grads(sess_k) # Nothing left accumulated. Must not update.
+        np.testing.assert_allclose(cost_k, cost_1, rtol=1e-5)
+    
+    assert_net_vars_close(read_net_vars(sess_k), read_net_vars(sess_1))
+
+
+def test_flush_updates_with_batches_left_accumulated(make_model_params, build_train_graph, copy_net_vars,
+                                                     read_net_vars, make_train_samples, run_train_subepoch):
+    model_params = make_model_params(NO_BN_CFG)
+    (sess_1, cnn3d_1, _, inp_shapes_per_path) = build_train_graph(model_params, n_batches_per_update=1)
+    (sess_k, cnn3d_k, trainer_k, _) = build_train_graph(model_params, n_batches_per_update=2)
+    copy_net_vars(sess_1, sess_k)
+    (channs_per_path, lbls) = make_train_samples(cnn3d_1, inp_shapes_per_path, n_samples=6)
+    
+    # 3 batches of 2: The first 2 make an update. The last is left accumulated, and the flush updates with it alone.
+    run_train_subepoch(sess_k, cnn3d_k, channs_per_path, lbls, batchsize=2)
+    trainer_k.run_flush_accum_grads(sess_k)
+    # Same updates without accumulation: A batch of the first 4 samples, then a batch of the last 2.
+    run_train_subepoch(sess_1, cnn3d_1, [channs[:4] for channs in channs_per_path], lbls[:4], batchsize=4)
+    run_train_subepoch(sess_1, cnn3d_1, [channs[4:] for channs in channs_per_path], lbls[4:], batchsize=2)
+    
+    assert_net_vars_close(read_net_vars(sess_k), read_net_vars(sess_1))
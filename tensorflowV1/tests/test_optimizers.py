@@ -0,0 +1,84 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+# The fused update ops of the optimizers must update params and optimizer's state as the unfused.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from deepmedic.neuralnet import optimizers as optimizers_dm
+
+PARAM_SHAPES = [[3, 4], [5]]
+N_STEPS = 5
+
+# Optimizer's args after params_to_opt and fused: [sgd0orAdam1orRmsProp2, args]
+CONFIGS = { "sgd_classic": [0, [0.01, 0.6, 0, 0]],
+            "sgd_nesterov_normalized": [0, [0.01, 0.6, 1, 1]],
+            "adam": [1, [0.01, 0.9, 0.999, 1e-8]],
+            "rmsprop_classic": [2, [0.01, 0.6, 0, 0, 0.9, 1e-4]],
+            "rmsprop_nesterov_normalized": [2, [0.01, 0.6, 1, 1, 0.9, 1e-4]] }
+
+
+def run_optimizer(sgd0orAdam1orRmsProp2, args, fused, params_init, grads_per_step):
+    # Returns: the values of all variables (params and optimizer's state) after the steps, by name.
+    graphTf = tf.Graph()
+    with graphTf.as_default():
+        with tf.compat.v1.variable_scope("net"):
+            params = [tf.Variable(param_init, dtype="float32", name="param") for param_init in params_init]
+        args_tf = [tf.constant(arg, dtype="float32") for arg in args[:2]] + args[2:] # lr and momentum or b1 are tf.
+        optimizer_class = [optimizers_dm.SgdOptimizer, optimizers_dm.AdamOptimizer, optimizers_dm.RmsPropOptimizer]
+        optimizer = optimizer_class[sgd0orAdam1orRmsProp2](params, *args_tf, fused=fused)
+        grads = [tf.compat.v1.placeholder(dtype="float32", shape=shape) for shape in PARAM_SHAPES]
+        updates_grouped_op = tf.group(*optimizer.get_update_ops_given_grads(grads))
+        all_vars = tf.compat.v1.global_variables()
+        with tf.compat.v1.Session() as sessionTf:
+            # Params first, because the initial state of the optimizer reads them.
+            sessionTf.run(tf.compat.v1.variables_initializer(params))
+            sessionTf.run(tf.compat.v1.global_variables_initializer())
+            for grads_of_step in grads_per_step:
+                sessionTf.run(updates_grouped_op, feed_dict=dict(zip(grads, grads_of_step)))
+            return {var.op.name: sessionTf.run(var) for var in all_vars}
+
+
+@pytest.mark.parametrize("config", sorted(CONFIGS))
+def test_fused_updates_equal_unfused(config):
+    rng = np.random.RandomState(0)
+    params_init = [rng.normal(size=shape).astype("float32") for shape in PARAM_SHAPES]
+    grads_per_step = [[rng.normal(size=shape).astype("float32") for shape in PARAM_SHAPES] for _ in range(N_STEPS)]
+    (sgd0orAdam1orRmsProp2, args) = CONFIGS[config]
+    
+    vars_unfused = run_optimizer(sgd0orAdam1orRmsProp2, args, False, params_init, grads_per_step)
+    vars_fused = run_optimizer(sgd0orAdam1orRmsProp2, args, True, params_init, grads_per_step)
+    assert sorted(vars_fused) == sorted(vars_unfused)
+    for name in vars_unfused:
+        np.testing.assert_allclose(vars_fused[name], vars_unfused[name], rtol=1e-5, atol=1e-7, err_msg=name)
+    for param_init, name in zip(params_init, ["net/param", "net/param_1"]):
+        assert np.abs(vars_unfused[name] - param_init).max() > 1e-3 # The steps did update.
+
+
+@pytest.mark.parametrize("sgd0orAdam1orRmsProp2", [0, 1, 2])
+def test_training_with_fused_ops_equals_unfused(sgd0orAdam1orRmsProp2, make_model_params, build_train_graph,
+                                                copy_net_vars, read_net_vars, make_train_samples, run_train_subepoch):
+    # The bias at the input of the first block, followed by linear activation and conv, is cancelled by the BN of the...
+    # ... next block. Its grads are float noise.
+    # Adam normalizes them to steps as large as lr, that differ between fused and unfused. So no BN for Adam.
+    model_params = make_model_params("rollAverageForBNOverThatManyBatches = 0" if sgd0orAdam1orRmsProp2 == 1 else "")
+    (sess_u, cnn3d_u, _, inp_shapes_per_path) = build_train_graph(model_params, optimizer=sgd0orAdam1orRmsProp2)
+    (sess_f, cnn3d_f, _, _) = build_train_graph(model_params, optimizer=sgd0orAdam1orRmsProp2, fused_ops=True)
+    copy_net_vars(sess_u, sess_f)
+    (channs_per_path, lbls) = make_train_samples(cnn3d_u, inp_shapes_per_path, n_samples=6)
+    
+    cost_u = run_train_subepoch(sess_u, cnn3d_u, channs_per_path, lbls, batchsize=2)
+    cost_f = run_train_subepoch(sess_f, cnn3d_f, channs_per_path, lbls, batchsize=2)
+    np.testing.assert_allclose(cost_f, cost_u, rtol=1e-5)
+    vars_u = read_net_vars(sess_u)
+    vars_f = read_net_vars(sess_f)
+    for name in vars_u:
+        np.testing.assert_allclose(vars_f[name], vars_u[name], rtol=1e-4, atol=1e-6, err_msg=name)
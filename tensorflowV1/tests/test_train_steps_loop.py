@@ -0,0 +1,37 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+# Training with many steps per session run (tf.while_loop) must give the same model as one step per run.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+
+
+def test_k_steps_per_run_equal_single_steps(make_model_params, build_train_graph, copy_net_vars, read_net_vars,
+                                            make_train_samples, run_train_subepoch):
+    model_params = make_model_params()
+    (sess_1, cnn3d_1, _, inp_shapes_per_path) = build_train_graph(model_params, n_steps_per_run=1)
+    (sess_k, cnn3d_k, _, _) = build_train_graph(model_params, n_steps_per_run=3)
+    copy_net_vars(sess_1, sess_k)
+    # 5 batches: A run of 3 steps and a shorter one of 2, as at the end of a subepoch.
+    (channs_per_path, lbls) = make_train_samples(cnn3d_1, inp_shapes_per_path, n_samples=10)
+    
+    for subep_i in range(2):
+        cost_1 = run_train_subepoch(sess_1, cnn3d_1, channs_per_path, lbls, batchsize=2, n_steps_per_run=1)
+        cost_k = run_train_subepoch(sess_k, cnn3d_k, channs_per_path, lbls, batchsize=2, n_steps_per_run=3)
+        np.testing.assert_allclose(cost_k, cost_1, rtol=1e-5)
+        
+        rp_rn_tp_tn_1 = sess_1.run(cnn3d_1.get_main_ops('train')['arr_rp_rn_tp_tn_subep'])
+        rp_rn_tp_tn_k = sess_k.run(cnn3d_k.get_main_ops('train')['arr_rp_rn_tp_tn_subep'])
+        np.testing.assert_array_equal(rp_rn_tp_tn_k, rp_rn_tp_tn_1)
+        assert rp_rn_tp_tn_1[0, 0] + rp_rn_tp_tn_1[0, 1] == lbls.size # Accumulated over all batches of the subepoch.
+    
+    vars_1 = read_net_vars(sess_1)
+    vars_k = read_net_vars(sess_k)
+    for name in vars_1:
+        np.testing.assert_allclose(vars_k[name], vars_1[name], rtol=1e-4, atol=1e-6, err_msg=name)